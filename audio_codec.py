@@ -0,0 +1,85 @@
+# audio_codec.py
+# クライアントとやり取りする音声の形式（サンプリングレート・エンコーディング）の検証と変換
+
+import io
+import numpy as np
+from munch import Munch
+
+# FLACはsoundfileが入っている場合のみ対応する
+try:
+    import soundfile as sf
+    FLAC_ENABLED = True
+except ImportError:
+    FLAC_ENABLED = False
+
+ENCODINGS = ('pcm16', 'float16', 'flac')
+SAMPLE_RATES = (16000, 22050, 24000, 32000, 44100, 48000)
+BYTES_PER_SAMPLE = {'pcm16': 2, 'float16': 2}
+
+# 形式を指定しないクライアント（v1を含む）は、入出力とも48kHzのint16
+DEFAULT_FORMAT = Munch(sample_rate=48000, encoding='pcm16', output_sample_rate=48000, output_encoding='pcm16')
+
+
+def _sample_rate(options, key, default):
+    """サンプリングレートを整数として取り出す（null・リスト・オブジェクトなどはValueErrorにする）"""
+    value = options.get(key, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key}には整数を指定してください。({value!r})") from None
+
+
+def negotiate(options):
+    """
+    ハンドシェイクで要求された形式を検証する。出力の形式を省略した場合は入力と同じにする
+
+    Args:
+        options (dict): sample_rate, encoding, output_sample_rate, output_encoding（いずれも省略可）
+    Returns:
+        Munch: DEFAULT_FORMATと同じキーを持つ入出力の形式
+    """
+    if not isinstance(options, dict):
+        raise ValueError("ハンドシェイクにはJSONオブジェクトを指定してください。")
+    fmt = Munch(
+        sample_rate=_sample_rate(options, 'sample_rate', DEFAULT_FORMAT.sample_rate),
+        encoding=options.get('encoding', DEFAULT_FORMAT.encoding),
+    )
+    fmt.output_sample_rate = _sample_rate(options, 'output_sample_rate', fmt.sample_rate)
+    fmt.output_encoding = options.get('output_encoding', fmt.encoding)
+    for rate in (fmt.sample_rate, fmt.output_sample_rate):
+        if rate not in SAMPLE_RATES:
+            raise ValueError(f"サンプリングレート {rate} は未対応です。({', '.join(map(str, SAMPLE_RATES))} のいずれか)")
+    for encoding in (fmt.encoding, fmt.output_encoding):
+        if not isinstance(encoding, str) or encoding not in ENCODINGS:
+            raise ValueError(f"エンコーディング '{encoding}' は未対応です。({', '.join(ENCODINGS)} のいずれか)")
+        if encoding == 'flac' and not FLAC_ENABLED:
+            raise ValueError("サーバーにsoundfileがインストールされていないため、FLACは使えません。")
+    return fmt
+
+
+def decode(data, encoding):
+    """音声データをfloat32の配列に変換する"""
+    if encoding == 'pcm16':
+        return np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+    if encoding == 'float16':
+        return np.frombuffer(data, dtype='<f2').astype(np.float32)
+    wave, _ = sf.read(io.BytesIO(data), dtype='float32')
+    return wave if wave.ndim == 1 else wave.mean(axis=1)
+
+
+def encode(wave, encoding, sample_rate):
+    """float32の配列を音声データに変換する"""
+    if encoding == 'pcm16':
+        return (wave * 32767.0).astype('<i2').tobytes()
+    if encoding == 'float16':
+        return wave.astype('<f2').tobytes()
+    buf = io.BytesIO()
+    sf.write(buf, np.clip(wave, -1.0, 1.0), sample_rate, format='FLAC', subtype='PCM_16')
+    return buf.getvalue()
+
+
+def duration(data, encoding, sample_rate):
+    """音声データの長さ（秒）。FLACはヘッダーだけを読む"""
+    if encoding in BYTES_PER_SAMPLE:
+        return len(data) / BYTES_PER_SAMPLE[encoding] / sample_rate
+    return sf.info(io.BytesIO(data)).duration
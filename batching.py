@@ -0,0 +1,92 @@
+# batching.py
+# 複数クライアントの変換要求をまとめてバッチ推論するスケジューラ
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import converter
+import audio_codec
+
+
+class BatchScheduler:
+    """
+    短い時間窓の間に届いた変換要求を集め、長さのバケットと目標話者ごとに
+    converter.convert_voice_batch でまとめて変換する
+
+    最初の要求が届いてから max_wait_ms 経つか、max_batch 件集まった時点でバッチを実行するため、
+    バッチ化による待ち時間は最大でも max_wait_ms に抑えられる。
+    バッチ内の短い要求は最長の要求に合わせて無音でパディングされ、生成器のInstanceNormが発話全体の統計を使うため、
+    1件ずつ変換した場合と完全には一致しない。パディングの量は bucket_seconds 未満に抑えられる。
+    """
+
+    def __init__(self, max_batch=4, max_wait_ms=20, bucket_seconds=0.25, vc=None):
+        self.converter = vc or converter # 変換に使うconverter（ホットリロードではconverter.new_instance()の結果）
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.bucket_seconds = bucket_seconds
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, audio_data_bytes, speaker_key, fmt=None):
+        """変換要求を登録し、変換後の音声バイトデータを受け取るFutureを返す"""
+        future = Future()
+        self._queue.put((future, audio_data_bytes, speaker_key, time.perf_counter(), fmt or audio_codec.DEFAULT_FORMAT))
+        return future
+
+    def convert_voice(self, audio_data_bytes, speaker_key, fmt=None):
+        """converter.convert_voiceと同じ形で呼べる同期版"""
+        return self.submit(audio_data_bytes, speaker_key, fmt).result()
+
+    def shutdown(self):
+        """受け付け済みの要求を変換し終えたら、スケジューラのスレッドを終了する"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """最初の要求から時間窓が閉じるまで要求を集める。shutdown()後はNoneを返す"""
+        first = self._queue.get()
+        if first is None: return None
+        requests = [first]
+        deadline = first[3] + self.max_wait
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0: break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # 集めた分を変換してから終了する
+                self._queue.put(None)
+                break
+            requests.append(request)
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None: return
+            groups = {}
+            for request in requests:
+                _, audio_data_bytes, speaker_key, _, fmt = request
+                # 入出力の形式は発話ごとに変換できるため、長さ（秒）と話者だけでまとめる
+                seconds = audio_codec.duration(audio_data_bytes, fmt.encoding, fmt.sample_rate)
+                groups.setdefault((int(seconds // self.bucket_seconds), speaker_key), []).append(request)
+            for group in groups.values():
+                self._run_batch(group)
+
+    def _run_batch(self, group):
+        group = [r for r in group if r[0].set_running_or_notify_cancel()]
+        if not group: return
+        try:
+            outputs = self.converter.convert_voice_batch([r[1] for r in group], [r[2] for r in group], [r[4] for r in group])
+        except Exception as e:
+            for r in group:
+                r[0].set_exception(e)
+            return
+        print(f"バッチ変換: {len(group)}件をまとめて処理しました。")
+        for r, output in zip(group, outputs):
+            r[0].set_result(output)
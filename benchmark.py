@@ -0,0 +1,195 @@
+# benchmark.py
+# 変換処理の各段の処理時間を、合成した発話で計測する
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import torch
+import yaml
+from munch import Munch
+
+import converter
+import resample_plan
+import precision
+from style_table import StyleTable
+from hifigan_fix.models import Generator as Hifigan
+from starganv2_vc.Utils.JDC.model import JDCNet
+
+BENCH_SPEAKER_KEY = 'bench'
+
+
+def install_random_models(config, use_denoiser=False):
+    """
+    チェックポイントを使わず、ランダムに初期化したモデルをconverterに組み込む
+    処理時間はモデルの構造だけで決まるため、CPUのみのマシンでもコミット間の比較ができる
+    """
+    device = torch.device('cpu')
+    with open(config['hifigan_config'], 'r') as f:
+        hps = Munch(json.load(f))
+    hifigan = Hifigan(hps).to(device).eval()
+    hifigan.remove_weight_norm()
+
+    vc_dir_path = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(vc_dir_path, 'starganv2_vc', 'Configs', 'config.yml')) as f:
+        model_params = yaml.safe_load(f)['model_params']
+    starganv2 = converter.build_model(model_params)
+    _ = [starganv2[key].eval().to(device) for key in starganv2]
+    F0_model = JDCNet(num_class=1, seq_len=192).to(device).eval()
+
+    style = torch.randn(1, model_params['style_dim'], device=device)
+    converter.install_model_set(Munch(
+        device=device, hps_hifigan=hps, F0_model=F0_model, starganv2=starganv2, hifigan=hifigan,
+        reference_embeddings=StyleTable.from_dict({BENCH_SPEAKER_KEY: (style, torch.LongTensor([1]).to(device))}, model_params['style_dim'], device),
+        use_denoiser=use_denoiser, lazy_styles=False, style_lru_size=1, pinned_styles=set(),
+        speaker_dicts={}, style_cache_dir=None, style_model_key=None,
+        resample_plan=resample_plan.make_plan(
+            converter.client_rate, hps.sampling_rate, converter.denoise_samplerate, use_denoiser,
+            config.get('resample_quality'), config.get('resample_plan', 'direct')
+        ),
+        resample_options=Munch(qualities=config.get('resample_quality'), mode=config.get('resample_plan', 'direct')),
+        window_options=converter.WINDOW_DEFAULTS,
+        denoise_tile_seconds=config.get('denoise_tile_seconds', converter.denoise_tile_seconds),
+        denoise_tile_batch=config.get('denoise_tile_batch', converter.denoise_tile_batch),
+        style_dim=model_params['style_dim'], checkpoint_paths=[], compiled_dir=None,
+        precision=precision.parse(config.get('inference_precision', 'fp32')),
+    ))
+
+
+def run_stages(audio_data_bytes, speaker_key):
+    """convert_voiceと同じ処理を段ごとに分けて実行し、各段の処理時間（秒）を返す"""
+    timings = {}
+
+    def timed(name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+        return result
+
+    plan = converter._resample_plan
+    with torch.no_grad():
+        wave = timed('decode', lambda b: np.frombuffer(b, dtype=np.int16).astype(np.float32) / 32768.0, audio_data_bytes)
+        for step in plan.front:
+            name = 'denoise' if step[0] == 'denoise' else f'resample_{step[4]}'
+            wave = timed(name, resample_plan.run_steps, wave, [step], converter.denoise)
+        wave_tensor = torch.from_numpy(wave).unsqueeze(0).to(converter._device)
+        mel = timed('mel_spectrogram', converter._mel_spectrogram, wave_tensor)
+        f0_feat = timed('get_feature_GAN', converter._f0_features, mel)
+        style = converter._get_reference(speaker_key)[0]
+        converted_mel = timed('generator', converter._generate, mel, style, f0_feat)
+        output = timed('hifigan', converter._vocode, converted_mel).squeeze().cpu().numpy()
+        for step in plan.back:
+            output = timed(f'resample_{step[4]}', resample_plan.run_steps, output, [step])
+        timed('encode', lambda w: (w * 32767.0).astype(np.int16).tobytes(), output)
+    return timings
+
+
+def _thread_count():
+    """OSから見たこのプロセスのスレッド数"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Threads:'): return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(speaker_key, lengths, repeat, warmup=2):
+    """各長さの合成発話について、段ごとのp50/p99処理時間と実時間比を求める"""
+    rng = np.random.default_rng(0)
+    results = []
+    for seconds in lengths:
+        audio = (rng.standard_normal(int(seconds * converter.client_rate)) * 3000).astype(np.int16).tobytes()
+        for _ in range(warmup):
+            run_stages(audio, speaker_key)
+        runs = [run_stages(audio, speaker_key) for _ in range(repeat)]
+        stages = {}
+        for name in runs[0]:
+            values = [r[name] for r in runs]
+            stages[name] = {
+                'p50_ms': 1000 * float(np.percentile(values, 50)),
+                'p99_ms': 1000 * float(np.percentile(values, 99)),
+                'rtf': float(np.median(values)) / seconds,
+            }
+        totals = [sum(r.values()) for r in runs]
+        results.append({
+            'seconds': seconds,
+            'stages': stages,
+            'total': {
+                'p50_ms': 1000 * float(np.percentile(totals, 50)),
+                'p99_ms': 1000 * float(np.percentile(totals, 99)),
+                'rtf': float(np.median(totals)) / seconds,
+            },
+        })
+        print(f"{seconds:.1f}秒: p50 {results[-1]['total']['p50_ms']:.1f}ms, RTF {results[-1]['total']['rtf']:.3f}", file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="変換処理の段ごとのベンチマーク（結果はJSONで出力）")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[1.0, 2.0, 4.0, 8.0], help='合成する発話の長さ（秒）')
+    parser.add_argument('--repeat', type=int, default=10, help='各長さの計測回数')
+    parser.add_argument('--random-init', action='store_true', help='チェックポイントを使わず、ランダムに初期化したモデルで計測する')
+    parser.add_argument('--denoise', action='store_true', help='--random-init時にFRCRNノイズ除去も計測する（モデルのダウンロードが必要）')
+    parser.add_argument('--threads', type=int, help='torchのスレッド数')
+    parser.add_argument('-o', '--output', type=str, help='結果を書き出すJSONファイル（省略時は標準出力）')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    if args.threads: torch.set_num_threads(args.threads)
+
+    if args.random_init:
+        install_random_models(config, use_denoiser=args.denoise)
+        speaker_key = BENCH_SPEAKER_KEY
+    else:
+        config['lazy_styles'] = True
+        converter.initialize_models(config)
+        speaker_key = config['target_speaker_key']
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'torch': torch.__version__,
+            'device': str(converter._device),
+            'torch_threads': torch.get_num_threads(),
+            'random_init': args.random_init,
+            'denoiser': converter.use_denoiser,
+            'compiled': converter._compiled is not None,
+            'precision': converter._precision,
+            'resample_plan': resample_plan.describe(converter._resample_plan),
+        },
+        'results': benchmark(speaker_key, args.lengths, args.repeat),
+    }
+    report['peak_rss_mb'] = _peak_rss_mb()
+    report['threads'] = _thread_count()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
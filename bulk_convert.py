@@ -0,0 +1,196 @@
+# bulk_convert.py
+# ディレクトリまたはマニフェストに列挙した録音をまとめて変換する（夜間バッチ向け）
+# 入力のデコードはプロセスプールで並列に行い、長さの近い録音同士を1回のバッチで変換する
+# 書き出し済みの出力はスキップするため、中断しても同じコマンドで再開できる
+
+import os
+import sys
+import json
+import time
+import wave
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import torch
+from munch import Munch
+
+import converter
+import audio_codec
+from reference_loader import load_wave_batch, audio_duration, length_buckets
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.m4a')
+
+
+def _output_path(path, base_dir, output_dir):
+    rel = os.path.relpath(path, base_dir)
+    if rel.startswith('..'): rel = os.path.basename(path)
+    return os.path.join(output_dir, os.path.splitext(rel)[0] + '.wav')
+
+
+def list_inputs(input_path, output_dir, speaker_key):
+    """
+    変換する録音の一覧を作る
+
+    Args:
+        input_path (str): 音声ファイルを含むディレクトリ（サブディレクトリも含む）か、マニフェスト
+                          マニフェストは1行に「入力のパス[<TAB>目標話者キー[<TAB>出力のパス]]」を書く（#以降はコメント）
+        speaker_key (str): 目標話者キーを省略した行に使う話者
+    Returns:
+        list: Munch(path, speaker_key, output) のリスト
+    """
+    items = []
+    if os.path.isdir(input_path):
+        output_abs = os.path.abspath(output_dir)
+        for root, dirs, files in os.walk(input_path):
+            # 出力先が入力のディレクトリの中にある場合、書き出した録音を入力として拾わないよう除く
+            dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_abs)
+            for name in sorted(files):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    items.append(Munch(path=path, speaker_key=speaker_key, output=_output_path(path, input_path, output_dir)))
+        return items
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].strip().split('\t')
+            if not fields[0]: continue
+            path = os.path.join(base_dir, fields[0])
+            output = os.path.join(output_dir, fields[2]) if len(fields) > 2 else _output_path(path, base_dir, output_dir)
+            items.append(Munch(path=path, speaker_key=fields[1] if len(fields) > 1 and fields[1] else speaker_key, output=output))
+    return items
+
+
+def plan_batches(items, batch_size, bucket_seconds, max_batch_seconds):
+    """
+    長さの近い録音同士をまとめたバッチに分け、短い順に並べる
+    パディング込みの長さ（最長の録音 × 件数）がmax_batch_secondsを超えないよう、長い録音ほど件数を減らす
+    """
+    batches = []
+    for bucket in length_buckets([item.seconds for item in items], batch_size, bucket_seconds):
+        longest = max(items[i].seconds for i in bucket)
+        size = max(1, min(batch_size, int(max_batch_seconds // max(longest, 1e-3))))
+        batches.extend([items[i] for i in bucket[j:j + size]] for j in range(0, len(bucket), size))
+    return batches
+
+
+def write_wav(path, wave_float, sr):
+    """int16のWAVとして書き出す。途中で中断しても壊れた出力が残らないよう、一時ファイルから置き換える"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + '.tmp'
+    with wave.open(tmp, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2) # 16bit
+        wf.setframerate(sr)
+        wf.writeframes((np.clip(wave_float, -1.0, 1.0) * 32767.0).astype(np.int16).tobytes())
+    os.replace(tmp, path)
+
+
+def _convert_batch(waves, speaker_keys):
+    """1バッチを変換する。失敗した場合は1件ずつ変換し直し、失敗した録音はNoneにする"""
+    try:
+        return converter._convert_model_waves(waves, speaker_keys)
+    except Exception as e:
+        if len(waves) == 1:
+            print(f"変換に失敗しました: {e}", file=sys.stderr)
+            return [None]
+        print(f"バッチの変換に失敗したため、1件ずつ変換します: {e}", file=sys.stderr)
+        return [_convert_batch([w], [k])[0] for w, k in zip(waves, speaker_keys)]
+
+
+def bulk_convert(items, workers=None, batch_size=8, bucket_seconds=0.25, max_batch_seconds=120.0, prefetch=4):
+    """
+    録音の一覧をまとめて変換し、変換できたバッチから順に出力を書き出す
+
+    Returns:
+        dict: 件数・変換した音声の長さ・経過時間・スループット（実時間1時間あたりに変換できる音声の時間）
+    """
+    start = time.perf_counter()
+    model_rate = converter._hps_hifigan.sampling_rate
+    # ノイズ除去を使う場合はクライアントと同じレートで読み込み、converterのリサンプリング経路に通す
+    decode_rate = converter.client_rate if converter.use_denoiser else model_rate
+    stats = Munch(files=len(items), converted=0, failed=0, audio_seconds=0.0)
+
+    workers = workers or multiprocessing.cpu_count()
+    # torchのスレッドを抱えたプロセスをforkしないよう、spawnでワーカーを起動する
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        # 1. 長さをヘッダーから読み、短い順のバッチに分ける
+        chunksize = max(1, len(items) // (workers * 4))
+        for item, seconds in zip(items, executor.map(audio_duration, [item.path for item in items], chunksize=chunksize)):
+            item.seconds = seconds
+        readable = [item for item in items if item.seconds is not None]
+        stats.failed += len(items) - len(readable)
+        batches = plan_batches(readable, batch_size, bucket_seconds, max_batch_seconds)
+        print(f"{len(readable)}件 ({sum(item.seconds for item in readable) / 3600:.2f}時間) を{len(batches)}バッチで変換します。")
+
+        # 2. 先のprefetchバッチ分のデコードをワーカーに任せながら、順に変換して書き出す
+        decode = partial(load_wave_batch, sr=decode_rate)
+        pending = deque()
+        for index, batch in enumerate(batches):
+            while len(pending) < prefetch and index + len(pending) < len(batches):
+                pending.append(executor.submit(decode, [item.path for item in batches[index + len(pending)]]))
+            waves = pending.popleft().result()
+
+            ok = [(item, w) for item, w in zip(batch, waves) if w is not None]
+            stats.failed += len(batch) - len(ok)
+            if not ok: continue
+            model_waves = [w if decode_rate == model_rate else converter._front(w, audio_codec.DEFAULT_FORMAT) for _, w in ok]
+            outputs = _convert_batch(model_waves, [item.speaker_key for item, _ in ok])
+            for (item, _), output in zip(ok, outputs):
+                if output is None:
+                    stats.failed += 1
+                    continue
+                write_wav(item.output, output, model_rate)
+                stats.converted += 1
+                stats.audio_seconds += item.seconds
+
+            elapsed = time.perf_counter() - start
+            print(f"[{index + 1}/{len(batches)}] {stats.converted}件 {stats.audio_seconds / 3600:.2f}時間 変換済み "
+                  f"({stats.audio_seconds / elapsed:.1f} 音声時間/実時間)")
+
+    stats.wall_seconds = time.perf_counter() - start
+    stats.audio_hours_per_hour = stats.audio_seconds / stats.wall_seconds if stats.wall_seconds > 0 else 0.0
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="録音をまとめて変換する（書き出し済みの出力はスキップして再開する）")
+    parser.add_argument('input', type=str, help='音声ファイルを含むディレクトリ、またはマニフェストファイル')
+    parser.add_argument('-o', '--output-dir', type=str, required=True, help='変換後のWAVファイルを書き出すディレクトリ')
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('-s', '--speaker', type=str, help='目標話者のキー（省略時はconfig.jsonのtarget_speaker_key）')
+    parser.add_argument('--workers', type=int, help='デコードするプロセス数（省略時は論理コア数）')
+    parser.add_argument('--batch-size', type=int, default=8, help='1バッチの最大件数')
+    parser.add_argument('--bucket-seconds', type=float, default=0.25, help='1バッチ内で許容する録音の長さの差（秒）。大きくすると速くなるが、短い録音の変換結果が変わる')
+    parser.add_argument('--max-batch-seconds', type=float, default=120.0, help='1バッチのパディング込みの長さの上限（秒）')
+    parser.add_argument('--prefetch', type=int, default=4, help='先にデコードしておくバッチ数')
+    parser.add_argument('--overwrite', action='store_true', help='書き出し済みの出力も変換し直す')
+    parser.add_argument('--threads', type=int, help='torchのスレッド数')
+    parser.add_argument('--report', type=str, help='集計結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    if args.threads: torch.set_num_threads(args.threads)
+    speaker_key = args.speaker or config['target_speaker_key']
+
+    items = list_inputs(args.input, args.output_dir, speaker_key)
+    todo = items if args.overwrite else [item for item in items if not os.path.exists(item.output)]
+    print(f"入力 {len(items)}件のうち、{len(items) - len(todo)}件は変換済みのためスキップします。")
+    if not todo: sys.exit(0)
+
+    # 使う話者の参照スタイルだけを計算する
+    config['lazy_styles'] = True
+    config['target_speaker_key'] = speaker_key
+    converter.initialize_models(config)
+
+    stats = bulk_convert(todo, args.workers, args.batch_size, args.bucket_seconds, args.max_batch_seconds, args.prefetch)
+    print(f"完了: {stats.converted}件 (失敗 {stats.failed}件), 音声 {stats.audio_seconds / 3600:.2f}時間 / "
+          f"実時間 {stats.wall_seconds / 3600:.2f}時間, スループット {stats.audio_hours_per_hour:.1f} 音声時間/実時間")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(dict(stats), f, indent=2, ensure_ascii=False)
@@ -7,6 +7,11 @@ import sys
 import numpy as np
 import struct
 import queue
+import threading
+import collections
+
+import protocol
+import audio_codec
 
 # --- ▼▼▼ 設定 ▼▼▼ ---
 # 使用するデバイス名を部分的に指定してください (例: "Focusrite", "MacBook Pro Microphone")
@@ -17,17 +22,26 @@ OUTPUT_DEVICE_NAME = "Voicemeeter AUX Input (VB-Audio Voicemeeter VAIO)"
 # サーバー設定
 SERVER_IP = 'localhost'
 SERVER_PORT = 8080
+PROTOCOL_VERSION = 2 # 2: 接続を維持して発話ごとに要求IDを付けて送る / 1: 発話ごとに接続する（旧サーバー用）
 
 # 音声設定
-SAMPLING_RATE = 48000
+SAMPLING_RATE = 48000 # 録音・送信するサンプリングレート（プロトコルv2では24000なども指定できる）
 CHANNELS = 1
 DTYPE = 'int16'
+ENCODING = 'pcm16' # 送信時のエンコーディング（pcm16 / float16 / flac）。v2のみ変更できる
+OUTPUT_SAMPLE_RATE = None # 受信する音声のサンプリングレート（Noneなら録音と同じ）
+OUTPUT_ENCODING = None # 受信する音声のエンコーディング（Noneなら送信と同じ）
 CHUNK = 1024
+STREAM = False # v2で、変換できた部分から順に受信して再生する（サーバーが対応している場合）。生成器がウィンドウごとに正規化するため、出力は一括変換と一致しない
+JITTER_BUFFER_MS = 150 # ストリーミング受信時、再生を始める前に溜めておく長さ（ミリ秒）
+MAX_INFLIGHT = 2 # 同時に変換待ちにできる発話の数（変換・再生中も次の発話を録音して送る）
 
 # 発話検出（VAD）設定
 VAD_THRESHOLD = 300  # 環境に合わせて調整してください
 SILENCE_CHUNKS = int(1.0 * SAMPLING_RATE / CHUNK)
 MAX_RECORD_CHUNKS = int(10 * SAMPLING_RATE / CHUNK)
+PRE_ROLL_MS = 300 # 発話の開始を検知する前から録音に含める長さ（ミリ秒）。語頭が欠けないようにする
+TRIM_MARGIN_MS = 200 # 送信前に末尾の無音を切り詰める際、最後の発話部分の後に残す長さ（ミリ秒）
 # --- ▲▲▲ 設定ここまで ▲▲▲
 
 # 録音データを保持するキュー
@@ -44,21 +58,281 @@ def find_device_id(name, kind):
             return i
     raise ValueError(f"'{name}' に一致する{kind}デバイスが見つかりませんでした。")
 
+def _ms_to_chunks(ms):
+    return int(np.ceil(ms / 1000 * SAMPLING_RATE / CHUNK))
+
 def audio_callback(indata, frames, time, status):
     """マイクからの入力をキューに入れるコールバック関数"""
     if status:
         print(status, file=sys.stderr)
     q.put(indata.copy())
 
+class JitterBufferPlayer:
+    """
+    受信したチャンクを順に再生するプレーヤー
+    play()で再生の順番が来たことを知らされた後、prebuffer秒分のチャンクが溜まった時点
+    （または最後のチャンクを受信した時点）で再生を始め、以降は受信と並行して再生する。
+    再生が受信に追いついた場合は無音を挟んで次のチャンクを待つ
+    """
+
+    def __init__(self, samplerate, device, prebuffer):
+        self.samplerate = samplerate
+        self.device = device
+        self._prebuffer = int(prebuffer * samplerate)
+        self._chunks = collections.deque()
+        self._offset = 0 # 先頭のチャンクの再生済みサンプル数
+        self._buffered = 0
+        self._released = False
+        self._ended = False
+        self._starting = False
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._stream = None
+        self.received = 0 # 受信したサンプル数
+        self.underruns = 0
+        self.failed = False # 接続が失われて応答を受信できなかったか
+
+    def put(self, wave):
+        with self._lock:
+            self._chunks.append(wave.astype(np.float32))
+            self._buffered += len(wave)
+            self.received += len(wave)
+        self._maybe_start()
+
+    def end(self):
+        """最後のチャンクを受信したことを知らせる"""
+        with self._lock:
+            self._ended = True
+        self._maybe_start()
+
+    def play(self):
+        """再生の順番が来たことを知らせる"""
+        with self._lock:
+            self._released = True
+        self._maybe_start()
+
+    def wait(self):
+        """再生が終わるまで待つ"""
+        self._finished.wait()
+        if self._stream is not None: self._stream.close()
+        if self.underruns: print(f"受信が再生に間に合わず、{self.underruns}回無音を挟みました。")
+
+    def _maybe_start(self):
+        with self._lock:
+            if self._starting or not self._released: return
+            if self._ended and self.received == 0:
+                self._finished.set() # 再生するものが無い
+                return
+            if not self._ended and self._buffered < self._prebuffer: return
+            self._starting = True
+        print("変換後の音声を再生します...")
+        self._stream = sd.OutputStream(samplerate=self.samplerate, device=self.device, channels=CHANNELS, dtype='float32',
+                                       callback=self._callback, finished_callback=self._finished.set)
+        self._stream.start()
+
+    def _callback(self, outdata, frames, time, status):
+        filled = 0
+        with self._lock:
+            while filled < frames and self._chunks:
+                chunk = self._chunks[0]
+                n = min(frames - filled, len(chunk) - self._offset)
+                outdata[filled:filled + n, 0] = chunk[self._offset:self._offset + n]
+                filled += n
+                self._offset += n
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+            self._buffered -= filled
+            ended = self._ended and not self._chunks
+        outdata[filled:] = 0
+        if ended: raise sd.CallbackStop
+        if filled < frames: self.underruns += 1
+
+def request_conversion_v1(recorded_data):
+    """発話ごとに接続して変換する。サーバーが応答しなければNoneを返す"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect((SERVER_IP, SERVER_PORT))
+        s.sendall(struct.pack('>I', len(recorded_data)))
+        s.sendall(recorded_data)
+        print("音声データをサーバーに送信しました。")
+
+        response_len_data = protocol.recv_exact(s, 4)
+        if response_len_data is None: return None
+        response_len = struct.unpack('>I', response_len_data)[0]
+        if response_len == 0: return b''
+        print(f"変換済みデータ({response_len}バイト)を受信します。")
+        return protocol.recv_exact(s, response_len)
+
+def _connect_v2():
+    s = socket.create_connection((SERVER_IP, SERVER_PORT))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    options = {'sample_rate': SAMPLING_RATE, 'encoding': ENCODING, 'stream': STREAM}
+    if OUTPUT_SAMPLE_RATE: options['output_sample_rate'] = OUTPUT_SAMPLE_RATE
+    if OUTPUT_ENCODING: options['output_encoding'] = OUTPUT_ENCODING
+    reply = protocol.client_handshake(s, options)
+    print(f"サーバーに接続しました。(プロトコルv{reply['version']}, 受信: {reply['output_sample_rate']}Hz {reply['output_encoding']}, "
+          f"ストリーミング: {'有効' if reply.get('stream') else '無効'})")
+    return s, reply
+
+class _Session:
+    """v2の1つの接続と、その接続で応答を受信中のプレーヤー"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = {} # 要求ID -> 応答を受信中のプレーヤー
+        self.closed = False # 受信スレッドが接続の切断を検知したか
+
+class ConversionPipeline:
+    """
+    録音した発話をサーバーに送り、変換結果を録音した順に再生するパイプライン
+
+    submit()は送信だけを行ってすぐに戻るため、変換・再生の間も次の発話を録音できる。
+    同時に変換待ちにできる発話はmax_inflight件までで、それを超えると空きができるまでsubmit()が待つ。
+    v2では1つの接続で要求IDを付けて並行して送り、受信スレッドが応答を各発話のプレーヤーに振り分ける。
+    サーバーがアイドル状態の接続を閉じていた場合は、次のsubmit()で1度だけ接続し直す
+    （切断時に応答を待っていた発話だけが失敗する）。
+    v1では発話ごとに接続するスレッドを立てる。
+    """
+
+    def __init__(self, output_device_id, max_inflight):
+        self.output_device_id = output_device_id
+        self.error = None # v1でサーバーとの接続が失われた場合の例外
+        self._playback = queue.Queue() # 録音した順のプレーヤー
+        self._lock = threading.Lock()
+        self._next_request_id = 0
+        self._session = None
+        if PROTOCOL_VERSION >= 2:
+            reply = self._connect()
+            max_inflight = min(max_inflight, reply.get('max_inflight', max_inflight))
+        self.max_inflight = max_inflight
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        threading.Thread(target=self._play, name='player', daemon=True).start()
+
+    def _connect(self):
+        """v2: 接続して受信スレッドを起動する"""
+        conn, reply = _connect_v2()
+        session = _Session(conn)
+        with self._lock:
+            self._session = session
+        threading.Thread(target=self._receive, args=(session,), name='receiver', daemon=True).start()
+        return reply
+
+    def submit(self, recorded_data):
+        """発話を送信する。再生は前の発話の再生が終わってから行われる"""
+        if not self._inflight.acquire(blocking=False):
+            print(f"変換待ちの発話が{self.max_inflight}件あるため、空きを待っています...")
+            self._inflight.acquire()
+        if self._session is None and self.error is not None:
+            self._inflight.release()
+            raise self.error
+        player = JitterBufferPlayer(OUTPUT_SAMPLE_RATE or SAMPLING_RATE, self.output_device_id, JITTER_BUFFER_MS / 1000)
+        self._playback.put(player)
+        if self._session is None:
+            threading.Thread(target=self._request_v1, args=(recorded_data, player), daemon=True).start()
+            return
+
+        # サーバーがアイドル状態の接続を閉じていた場合に備え、切断されていたら1度だけ接続し直す
+        for attempt in range(2):
+            request_id = None
+            try:
+                if self._session.closed:
+                    print("サーバーとの接続が切れていたため、接続し直します...")
+                    self._connect()
+                with self._lock:
+                    session = self._session
+                    request_id = self._next_request_id
+                    self._next_request_id = (request_id + 1) % 2**32
+                    session.pending[request_id] = player
+                    pending = len(session.pending)
+                protocol.send_frame(session.conn, request_id, recorded_data)
+                print(f"発話{request_id}をサーバーに送信しました。(変換待ち: {pending}件)")
+                return
+            except OSError as e:
+                # 受信スレッドがまだ切断を検知していなければ、この発話は送り直す
+                with self._lock:
+                    retry = request_id is None or self._session.pending.pop(request_id, None) is not None
+                    self._session.closed = True
+                self._session.conn.close() # 受信スレッドを止め、残りの変換待ちの発話を失敗させる
+                if not retry: return # 受信スレッドが既にこの発話を失敗させた
+                if attempt == 1:
+                    player.failed = True
+                    player.end()
+                    self._inflight.release()
+                    raise e
+
+    def close(self):
+        self._playback.put(None)
+        if self._session is not None: self._session.conn.close()
+
+    def _request_v1(self, recorded_data, player):
+        try:
+            converted_data_bytes = request_conversion_v1(recorded_data)
+            if converted_data_bytes is None:
+                raise ConnectionResetError("サーバーから応答がありません。")
+            if converted_data_bytes:
+                player.put(audio_codec.decode(converted_data_bytes, OUTPUT_ENCODING or ENCODING))
+        except OSError as e:
+            self.error = e
+            player.failed = True
+        finally:
+            player.end()
+            self._inflight.release()
+
+    def _receive(self, session):
+        """v2: 応答フレームを受信し、要求IDに対応するプレーヤーに渡す（接続ごとの受信スレッド）"""
+        try:
+            while True:
+                frame = protocol.recv_frame(session.conn)
+                if frame is None: raise ConnectionResetError("サーバーが接続を閉じました。")
+                request_id, flags, payload = frame
+                with self._lock:
+                    player = session.pending.get(request_id)
+                if player is None: continue
+                if flags & protocol.FLAG_ERROR:
+                    print(f"サーバーで発話{request_id}の変換に失敗しました: {payload.decode(errors='replace')}")
+                elif payload:
+                    player.put(audio_codec.decode(payload, OUTPUT_ENCODING or ENCODING))
+                if flags & protocol.FLAG_END:
+                    with self._lock:
+                        del session.pending[request_id]
+                    player.end()
+                    self._inflight.release()
+        except OSError as e:
+            with self._lock:
+                session.closed = True
+                players, session.pending = list(session.pending.values()), {}
+            session.conn.close()
+            if players: print(f"サーバーとの接続が切れたため、変換待ちの発話{len(players)}件を破棄しました: {e}")
+            for player in players:
+                player.failed = True
+                player.end()
+                self._inflight.release()
+
+    def _play(self):
+        """録音した順に再生する（再生スレッド）"""
+        while True:
+            player = self._playback.get()
+            if player is None: return
+            player.play()
+            player.wait() # 再生が完了するまで待つ
+            if player.received == 0 and not player.failed:
+                print("サーバーから再生不要の信号を受信しました。")
+
 def main():
+    pipeline = None
     try:
         # デバイスIDを検索
         input_device_id = find_device_id(INPUT_DEVICE_NAME, 'input')
         output_device_id = find_device_id(OUTPUT_DEVICE_NAME, 'output')
 
-        print("\nクライアント起動完了。Ctrl+Cで終了します。")
+        pipeline = ConversionPipeline(output_device_id, MAX_INFLIGHT)
+        print(f"\nクライアント起動完了。(同時に変換待ちにできる発話: {pipeline.max_inflight}件) Ctrl+Cで終了します。")
+
+        pre_roll = collections.deque(maxlen=_ms_to_chunks(PRE_ROLL_MS))
+        trim_margin = _ms_to_chunks(TRIM_MARGIN_MS)
 
         # マイクからの入力ストリームを開始
+        # 変換・再生は別スレッドで行うため、その間も録音は止めずに次の発話を待つ
         with sd.InputStream(samplerate=SAMPLING_RATE, device=input_device_id,
                             channels=CHANNELS, dtype=DTYPE, callback=audio_callback):
 
@@ -66,19 +340,18 @@ def main():
                 print("\n-----------------------------------------")
                 print("発話の開始を待っています...")
 
-                # キューをクリア
-                while not q.empty():
-                    q.get()
-
-                # 発話開始を待つ
+                # 発話開始を待つ。直近の入力はプリロールとして保持しておき、語頭が欠けないよう録音に含める
                 while True:
                     data = q.get()
                     rms = np.sqrt(np.mean(np.square(data.astype(np.float64))))
                     if rms > VAD_THRESHOLD:
                         break
+                    pre_roll.append(data)
 
                 print("発話を検知しました！ 録音中...")
-                frames = [data]
+                frames = list(pre_roll) + [data]
+                pre_roll.clear()
+                last_voiced = len(frames) - 1 # 最後にしきい値を超えたチャンク
                 silent_count = 0
                 while True:
                     data = q.get()
@@ -89,42 +362,22 @@ def main():
                         silent_count += 1
                     else:
                         silent_count = 0
+                        last_voiced = len(frames) - 1
 
                     if silent_count > SILENCE_CHUNKS or len(frames) > MAX_RECORD_CHUNKS:
                         break
 
+                # 発話の終わりの判定に使った末尾の無音は、マージンを残して送らない
+                recorded_chunks = len(frames)
+                frames = frames[:last_voiced + 1 + trim_margin]
+                print(f"末尾の無音を{(recorded_chunks - len(frames)) * CHUNK / SAMPLING_RATE:.2f}秒切り詰めました。")
                 recorded_data = np.concatenate(frames).tobytes()
+                if ENCODING != 'pcm16':
+                    recorded_data = audio_codec.encode(audio_codec.decode(recorded_data, 'pcm16'), ENCODING, SAMPLING_RATE)
 
                 try:
-                    print(f"録音終了。サーバーに接続して変換します...")
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.connect((SERVER_IP, SERVER_PORT))
-                        s.sendall(struct.pack('>I', len(recorded_data)))
-                        s.sendall(recorded_data)
-                        print("音声データをサーバーに送信しました。")
-
-                        response_len_data = s.recv(4)
-                        if not response_len_data:
-                            print("サーバーから応答がありません。終了します。")
-                            break
-
-                        response_len = struct.unpack('>I', response_len_data)[0]
-
-                        if response_len > 0:
-                            print(f"変換済みデータ({response_len}バイト)を受信します。")
-                            converted_data_bytes = b''
-                            while len(converted_data_bytes) < response_len:
-                                packet = s.recv(4096)
-                                if not packet: break
-                                converted_data_bytes += packet
-
-                            print("変換後の音声を再生します...")
-                            converted_data_np = np.frombuffer(converted_data_bytes, dtype=DTYPE)
-                            sd.play(converted_data_np, samplerate=SAMPLING_RATE, device=output_device_id)
-                            sd.wait() # 再生が完了するまで待つ
-                        else:
-                            print("サーバーから再生不要の信号を受信しました。次の発話に移ります。")
-
+                    print(f"録音終了。サーバーで変換します...")
+                    pipeline.submit(recorded_data)
                 except (ConnectionRefusedError, ConnectionResetError, socket.error) as e:
                     print(f"\n[エラー] サーバーとの接続が失われました: {e}")
                     print("サーバーが停止したため、クライアントを終了します。")
@@ -135,13 +388,30 @@ def main():
     except Exception as e:
         print(f"\n[エラー] 予期せぬエラーが発生しました: {e}")
     finally:
+        if pipeline is not None: pipeline.close()
         print("クライアントを終了しました。")
 
 if __name__ == '__main__':
     # 利用可能なデバイス一覧を表示する機能
     parser = argparse.ArgumentParser(description="発話単位で音声を変換するクライアント (sounddevice版)")
     parser.add_argument('--list-devices', action='store_true', help='利用可能なオーディオデバイスの一覧を表示して終了します。')
+    parser.add_argument('--protocol', type=int, choices=[1, 2], default=PROTOCOL_VERSION, help='通信プロトコルのバージョン（1は旧サーバー用）')
+    parser.add_argument('--sample-rate', type=int, default=SAMPLING_RATE, help='録音・送信するサンプリングレート（v2のみ変更可）')
+    parser.add_argument('--encoding', choices=audio_codec.ENCODINGS, default=ENCODING, help='送信時のエンコーディング（v2のみ変更可）')
+    parser.add_argument('--output-sample-rate', type=int, help='受信する音声のサンプリングレート（省略時は録音と同じ）')
+    parser.add_argument('--output-encoding', choices=audio_codec.ENCODINGS, help='受信する音声のエンコーディング（省略時は送信と同じ）')
+    parser.add_argument('--stream', action='store_true', default=STREAM, help='ストリーミング応答を使い、変換できた部分から順に受信して再生する')
+    parser.add_argument('--max-inflight', type=int, default=MAX_INFLIGHT, help='同時に変換待ちにできる発話の数')
     args = parser.parse_args()
+    MAX_INFLIGHT = args.max_inflight
+    STREAM = args.stream
+    PROTOCOL_VERSION = args.protocol
+    SAMPLING_RATE, ENCODING = args.sample_rate, args.encoding
+    OUTPUT_SAMPLE_RATE, OUTPUT_ENCODING = args.output_sample_rate, args.output_encoding
+    if PROTOCOL_VERSION == 1 and (SAMPLING_RATE != 48000 or ENCODING != 'pcm16' or OUTPUT_SAMPLE_RATE or OUTPUT_ENCODING):
+        parser.error("プロトコルv1では48kHzのpcm16しか使えません。")
+    SILENCE_CHUNKS = int(1.0 * SAMPLING_RATE / CHUNK)
+    MAX_RECORD_CHUNKS = int(10 * SAMPLING_RATE / CHUNK)
 
     if args.list_devices:
         print("利用可能なオーディオデバイス:")
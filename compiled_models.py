@@ -0,0 +1,153 @@
+# compiled_models.py
+# JDC・HiFi-GANを、メルの長さのバケットごとにトレースして保存・読み込みする
+# StarGANの生成器はInstanceNorm・AdaINが時間軸全体の統計を使い、パディングで出力全体が変わるため対象外（常にeagerモードで実行する）
+
+import os
+import json
+import hashlib
+import argparse
+import torch
+import torch.nn.functional as F
+
+import style_cache
+
+MANIFEST_FILE = 'manifest.json'
+DEFAULT_BUCKETS = [64, 128, 256, 512, 800] # メルのフレーム数（hop 300, 24kHzで約0.8秒〜10秒）
+MEL_PAD_VALUE = -11.512925 # log(1e-5)。メルスペクトログラムの無音に相当する値
+NAMES = ('f0', 'vocoder')
+
+
+class _F0Feature(torch.nn.Module):
+    """JDCNet.get_feature_GANをトレースするためのラッパー"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, mel):
+        return self.model.get_feature_GAN(mel)
+
+
+class _StarGANGenerator(torch.nn.Module):
+    """F0をキーワード引数で受け取るGeneratorをトレースするためのラッパー"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, mel, style, f0):
+        return self.model(mel, style, F0=f0)
+
+
+class BucketedModule:
+    """
+    入力の時間長以上で最も短いバケットのトレース済みモジュールを選んで実行する
+
+    time_argsで指定した引数の時間軸（最後の次元）をバケットの長さまでパディングし、
+    出力を元の長さ（×out_scale）に切り戻す。バッチサイズが1でない入力や、
+    最大のバケットより長い入力はfallback（eagerモード）で実行する。
+    """
+
+    def __init__(self, modules, fallback, time_args=(0,), pad_values=(MEL_PAD_VALUE,), out_scale=1):
+        if len(pad_values) != len(time_args):
+            raise ValueError("pad_valuesはtime_argsと同じ数だけ指定してください。")
+        self.modules = modules
+        self.buckets = sorted(modules)
+        self.fallback = fallback
+        self.time_args = time_args
+        self.pad_values = pad_values
+        self.out_scale = out_scale
+
+    def __call__(self, *args):
+        length = args[self.time_args[0]].shape[-1]
+        if args[0].shape[0] != 1 or length > self.buckets[-1]:
+            return self.fallback(*args)
+        bucket = next(b for b in self.buckets if b >= length)
+        padded = list(args)
+        for i, value in zip(self.time_args, self.pad_values):
+            padded[i] = F.pad(args[i], (0, bucket - length), value=value)
+        return self.modules[bucket](*padded)[..., :length * self.out_scale]
+
+
+def artifact_key(checkpoint_paths, device):
+    """チェックポイントの内容・torchのバージョン・デバイスの種類から成果物のキーを作る"""
+    h = hashlib.sha256()
+    for path in checkpoint_paths:
+        h.update(style_cache.file_digest(path).encode())
+    h.update(torch.__version__.encode())
+    h.update(torch.device(device).type.encode())
+    return h.hexdigest()[:16]
+
+
+def export(cache_dir, key, F0_model, generator, hifigan, num_mels, style_dim, device, buckets=None):
+    """各バケットの長さでトレース・フリーズし、cache_dir/key/ に保存する（生成器はボコーダーの入力を作るためだけに使う）"""
+    buckets = sorted(buckets or DEFAULT_BUCKETS)
+    out_dir = os.path.join(cache_dir, key)
+    os.makedirs(out_dir, exist_ok=True)
+    f0_wrapper = _F0Feature(F0_model).eval()
+    generator_wrapper = _StarGANGenerator(generator).eval()
+    with torch.no_grad():
+        for length in buckets:
+            print(f"  {length}フレーム用のモデルをトレースしています...")
+            mel = torch.randn(1, 1, num_mels, length, device=device)
+            style = torch.randn(1, style_dim, device=device)
+            f0_feat = f0_wrapper(mel)
+            converted = generator_wrapper(mel, style, f0_feat)
+            traced = {
+                'f0': torch.jit.trace(f0_wrapper, mel, strict=False),
+                    'vocoder': torch.jit.trace(hifigan, converted.squeeze(1), strict=False),
+            }
+            for name, module in traced.items():
+                torch.jit.save(torch.jit.freeze(module.eval()), os.path.join(out_dir, f'{name}_{length}.pt'))
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'buckets': buckets}, f)
+    return out_dir
+
+
+def load(cache_dir, key, F0_model, hifigan, hop_size, device):
+    """
+    保存済みのトレース済みモデルを読み込む。無ければNoneを返す
+
+    Returns:
+        dict: 'f0', 'vocoder' -> BucketedModule
+    """
+    out_dir = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        buckets = json.load(f)['buckets']
+    modules = {name: {} for name in NAMES}
+    for length in buckets:
+        for name in NAMES:
+            modules[name][length] = torch.jit.load(os.path.join(out_dir, f'{name}_{length}.pt'), map_location=device)
+    return {
+        # JDCの特徴量とHiFi-GANは畳み込みのみのため、パディングの影響は末尾の受容野分のフレームに限られる
+        'f0': BucketedModule(modules['f0'], F0_model.get_feature_GAN),
+        'vocoder': BucketedModule(modules['vocoder'], hifigan, out_scale=hop_size),
+    }
+
+
+if __name__ == '__main__':
+    import converter
+
+    parser = argparse.ArgumentParser(description="JDC・HiFi-GANをバケットごとにトレースしてキャッシュに保存する")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('--buckets', type=int, nargs='+', help='トレースするメルのフレーム数（省略時は設定ファイルか既定値）')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    cache_dir = config.get('compiled_dir')
+    if not cache_dir:
+        parser.error("設定ファイルに compiled_dir を指定してください。")
+    # トレースには参照スタイルもノイズ除去も不要なので、読み込みを最小限にする
+    config.update(compiled_dir=None, lazy_styles=True, use_denoiser=False)
+    converter.initialize_models(config)
+
+    key = artifact_key(converter._checkpoint_paths, converter._device)
+    print(f"トレース済みモデルを '{cache_dir}/{key}' に保存します...")
+    export(
+        cache_dir, key, converter.F0_model, converter.starganv2.generator, converter.hifigan,
+        converter._hps_hifigan.num_mels, converter.style_dim,
+        converter._device, args.buckets or config.get('compiled_buckets')
+    )
+    print("保存が完了しました。")
@@ -1,21 +1,31 @@
 # converter.py
 
 import os
-import librosa
+import importlib.util
 import numpy as np
 import torch
 import yaml
 import json
+import threading
+from concurrent.futures import Future
 import soxr
 from munch import Munch
 import const as const
+import style_cache
+import resample_plan
+import compiled_models
+import metrics
+import audio_codec
+import precision
+from style_table import StyleTable, centroid_key, is_centroid_key
 
 # 必要なモジュールをインポート
 from hifigan_fix.meldataset import mel_spectrogram
 from hifigan_fix.models import Generator as Hifigan
 from starganv2_vc.Utils.JDC.model import JDCNet
 from starganv2_vc.models import Generator, MappingNetwork, StyleEncoder
-from frcrn import initialize_frcrn, denoise
+from frcrn import get_denoiser
+from reference_loader import load_reference_waves, length_buckets
 
 # --- グローバル変数 ---
 # このモジュール内でモデルや設定を保持するための変数
@@ -24,10 +34,38 @@ _hps_hifigan = None
 F0_model = None
 starganv2 = None
 hifigan = None
-reference_embeddings = None
+reference_embeddings = None # 参照話者キー -> (スタイル, ラベル) の表（StyleTable）
 min_len_wave = 24000
 use_denoiser = False # ノイズ除去機能が有効かどうかのフラグ
 denoise_samplerate = 16000 # FRCRNが要求するサンプリングレート
+denoise_tile_seconds = 4.0 # FRCRNをトレースする1タイルの長さ（秒）
+denoise_tile_batch = 2 # FRCRNが1回に処理するタイル数
+_denoiser = None # このモデル一式が使うFRCRN（frcrn.Denoiser）
+style_workers = None # 参照音声を読み込むスレッド数（Noneなら論理コア数、上限8）
+style_batch_size = 16 # スタイルエンコーダのバッチサイズ
+style_bucket_seconds = 0.0 # 1バッチ内で許容する参照音声の長さの差（秒）。0なら同じ長さの音声だけをまとめる
+lazy_styles = False # Trueなら参照スタイルを初回参照時に計算する（遅延モード）
+style_lru_size = 32 # 遅延モードで保持する参照スタイルの上限数
+_speaker_dicts = {} # 参照話者キー -> (参照音声のパス, 話者ID)
+_style_cache_dir = None
+_style_model_key = None
+_pinned_styles = set() # LRUから追い出さない参照話者キー
+_style_lock = threading.Lock()
+_loading_styles = {} # 遅延モードで計算中の参照話者キー -> 計算の完了を待つFuture
+_resample_plan = None # 変換処理のリサンプリング経路（resample_plan.make_planの結果）
+_resample_options = None # 経路の品質・モード（入出力のレートが既定と異なる経路を作るときに使う）
+_plans = {} # (入力のレート, 出力のレート) -> 既定以外のリサンプリング経路
+# 長い入力を窓に分けて変換する設定（secondsより長い入力が対象。Noneなら常に一括で変換する）
+# 窓ごとの変換は一括の変換と完全には一致しないため、クライアントが送る通常の発話（最長10秒程度）は対象にしない
+WINDOW_DEFAULTS = Munch(seconds=30.0, frames=256, context_frames=64, crossfade_frames=4, batch=4)
+_window_options = WINDOW_DEFAULTS
+style_dim = None # スタイルベクトルの次元数
+_checkpoint_paths = [] # 読み込んだチェックポイント（HiFi-GAN, JDC, StarGAN）のパス
+_compiled_dir = None
+_compiled = None # トレース済みモデル（'f0', 'generator', 'vocoder' -> BucketedModule）。無ければeagerモード
+_precision = precision.parse('fp32') # モデル名 -> 推論精度（precision.parseの結果）
+_precision_models = {} # fp32以外で実行するモデル名 -> 変換済みのモデル（トレース済みモデルより優先する）
+precision_calibration_count = 8 # 静的量子化のキャリブレーションに使う参照音声の数
 
 def initialize_models(config):
     """
@@ -36,7 +74,9 @@ def initialize_models(config):
     Args:
         config (dict): config.jsonから読み込まれた設定情報
     """
-    global _device, _hps_hifigan, hifigan, use_denoiser
+    global _device, _hps_hifigan, hifigan, use_denoiser, style_workers, style_batch_size, style_bucket_seconds, \
+        lazy_styles, style_lru_size, _resample_plan, _resample_options, _plans, denoise_tile_seconds, denoise_tile_batch, \
+        _checkpoint_paths, _compiled_dir, stream_block_seconds, _window_options, _precision, precision_calibration_count
     
     # 1. 使用するデバイス（GPU/CPU）を決定
     _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -50,28 +90,211 @@ def initialize_models(config):
     hifigan.load_state_dict(torch.load(config['hifigan_model'], map_location=_device)['generator'])
     _ = hifigan.eval()
     hifigan.remove_weight_norm()
+    _checkpoint_paths = [config['hifigan_model']]
     print("HiFi-GANの読み込みが完了しました。")
 
     # 3. StarGANv2-vc本体を初期化
+    style_workers = config.get('style_workers', style_workers)
+    style_batch_size = config.get('style_batch_size', style_batch_size)
+    style_bucket_seconds = config.get('style_bucket_seconds', style_bucket_seconds)
+    lazy_styles = config.get('lazy_styles', False)
+    style_lru_size = config.get('style_lru_size', style_lru_size)
     _initialize_vc(
         _hps_hifigan, _device, 
         config['stargan_model_dir'], config['stargan_model_name'], 
-        config['f0_model'], config['f0_model_key']
+        config['f0_model'], config['f0_model_key'],
+        style_cache_dir=config.get('style_cache_dir'),
+        preload_keys=[config['target_speaker_key']] if lazy_styles else None
     )
     
     # 4. FRCRN（ノイズ除去）を初期化（設定が有効な場合のみ）
     use_denoiser = config.get('use_denoiser', False)
+    denoise_tile_seconds = config.get('denoise_tile_seconds', denoise_tile_seconds)
+    denoise_tile_batch = config.get('denoise_tile_batch', denoise_tile_batch)
     if use_denoiser:
-        print("FRCRNノイズ除去モデルを初期化しています...")
-        # 発話単位の変換では入力長が可変なため、十分なサイズで初期化
-        initialize_frcrn(_device, int(_hps_hifigan.sampling_rate * 10 / _hps_hifigan.sampling_rate * denoise_samplerate))
-        print("FRCRNの初期化が完了しました。")
+        _initialize_denoiser()
+
+    # 5. リサンプリング経路を決定
+    _resample_options = Munch(qualities=config.get('resample_quality'), mode=config.get('resample_plan', 'direct'))
+    _resample_plan = resample_plan.make_plan(
+        client_rate, _hps_hifigan.sampling_rate, denoise_samplerate, use_denoiser,
+        _resample_options.qualities, _resample_options.mode
+    )
+    _plans = {}
+    stream_block_seconds = config.get('stream_block_seconds', stream_block_seconds)
+    _window_options = Munch(
+        seconds=config.get('window_seconds', WINDOW_DEFAULTS.seconds),
+        frames=config.get('window_frames', WINDOW_DEFAULTS.frames),
+        context_frames=config.get('window_context_frames', WINDOW_DEFAULTS.context_frames),
+        crossfade_frames=config.get('window_crossfade_frames', WINDOW_DEFAULTS.crossfade_frames),
+        batch=config.get('window_batch', WINDOW_DEFAULTS.batch),
+    )
+    if _window_options.crossfade_frames > _window_options.context_frames:
+        raise ValueError("window_crossfade_framesはwindow_context_frames以下にしてください。")
+    print(f"リサンプリング経路: {resample_plan.describe(_resample_plan)}")
+
+    # 6. トレース済みモデルがあれば読み込む（無ければeagerモードのまま）
+    _compiled_dir = config.get('compiled_dir')
+    if _compiled_dir:
+        _load_compiled()
+
+    # 7. 推論精度を設定（fp32以外を指定したモデルのみ変換する）
+    _precision = precision.parse(config.get('inference_precision', 'fp32'))
+    precision_calibration_count = config.get('precision_calibration_count', precision_calibration_count)
+    _apply_precision()
 
     print("全てのモデルの初期化が完了しました。")
 
-def _initialize_vc(h, device, model_dir, model_name, f0_model_path, f0_model_key):
-    """StarGANv2-vcの関連モデルを初期化する内部関数"""
-    global F0_model, starganv2, reference_embeddings
+def new_instance():
+    """
+    このモジュールの独立したコピーを作る
+    コピーのinitialize_models()は、このモジュールのモデルに触れずに新しいモデル一式を読み込むため、
+    使用中のモデルで変換を続けながら、別のモデル一式を準備できる（ホットリロード用）
+    """
+    spec = importlib.util.find_spec(__name__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def release_models():
+    """このモジュールが保持するモデルと参照スタイルへの参照を外す（入れ替えた古いモデル一式を解放するため）"""
+    global F0_model, starganv2, hifigan, reference_embeddings, _compiled, _precision_models, _plans, _denoiser
+    F0_model = starganv2 = hifigan = reference_embeddings = _compiled = _denoiser = None
+    _precision_models = {}
+    _plans = {}
+
+def _load_compiled():
+    """compiled_models.pyで保存したトレース済みモデルを読み込む内部関数"""
+    global _compiled
+    key = compiled_models.artifact_key(_checkpoint_paths, _device)
+    _compiled = compiled_models.load(_compiled_dir, key, F0_model, hifigan, _hps_hifigan.hop_size, _device)
+    if _compiled is None:
+        print(f"トレース済みモデル '{_compiled_dir}/{key}' が見つからないため、eagerモードで実行します。")
+    else:
+        print(f"トレース済みモデル '{_compiled_dir}/{key}' を読み込みました。(バケット: {_compiled['vocoder'].buckets})")
+
+def _apply_precision(static_models=None):
+    """_precisionに従って、fp32以外で実行するモデルを作る内部関数（static_modelsはprecision.applyを参照）"""
+    global _precision_models
+    _precision_models = {}
+    if all(mode == 'fp32' for mode in _precision.values()): return
+    print(f"推論精度: {precision.describe(_precision)}")
+    modules = {
+        'f0': compiled_models._F0Feature(F0_model).eval(),
+        'generator': compiled_models._StarGANGenerator(starganv2.generator).eval(),
+        'vocoder': hifigan,
+    }
+    _precision_models = precision.apply(_precision, modules, _device, _calibration_inputs, static_models)
+
+def _calibration_inputs(name):
+    """
+    静的量子化のキャリブレーションに使う、モデルnameへの入力のリスト
+    話者が偏らないよう間隔を空けて選んだ参照音声（無ければ合成した雑音）を、fp32のモデルに通して作る
+    """
+    keys = sorted(_speaker_dicts)
+    keys = keys[::max(1, len(keys) // precision_calibration_count)][:precision_calibration_count]
+    sr = _hps_hifigan.sampling_rate
+    if keys:
+        waves = load_reference_waves([_speaker_dicts[k][0] for k in keys], sr, min_len_wave, workers=style_workers)
+    else:
+        rng = np.random.default_rng(0)
+        waves = [(rng.standard_normal(2 * sr) * 0.1).astype(np.float32) for _ in range(precision_calibration_count)]
+    style = reference_embeddings.get(next(iter(reference_embeddings)))[0]
+    inputs = []
+    with torch.no_grad():
+        for wave in waves:
+            mel = _mel_spectrogram(torch.from_numpy(wave).unsqueeze(0).to(_device)).unsqueeze(1)
+            if name == 'f0':
+                inputs.append((mel,))
+                continue
+            f0_feat = F0_model.get_feature_GAN(mel)
+            if name == 'generator':
+                inputs.append((mel, style, f0_feat))
+                continue
+            inputs.append((starganv2.generator(mel, style, F0=f0_feat).squeeze(1),))
+    return inputs
+
+def _initialize_denoiser():
+    """FRCRN（ノイズ除去）を初期化する内部関数"""
+    global _denoiser
+    print("FRCRNノイズ除去モデルを初期化しています...")
+    # 発話単位の変換では入力長が可変なため、固定長のタイルでトレースし、長い入力はタイルに分けて処理する
+    # 新旧のモデル一式で同時に使われても互いに影響しないよう、モデル一式ごとにDenoiserを持つ
+    # （設定が同じならfrcrn.get_denoiserが使用中のものを返すため、再トレースはしない）
+    _denoiser = get_denoiser(_device, int(denoise_tile_seconds * denoise_samplerate), batch_size=denoise_tile_batch)
+    print("FRCRNの初期化が完了しました。")
+
+def denoise(wave):
+    """このモデル一式のFRCRNで、FRCRNのレートの波形をノイズ除去する"""
+    return _denoiser(wave)
+
+def export_model_set():
+    """
+    読み込み済みのモデル一式と参照スタイルを共有メモリに移し、ワーカープロセスへ渡せる形で返す
+    share_memory()はその場でストレージを移すため、このプロセスのモデルも同じメモリを使い続ける
+    """
+    for module in (F0_model, hifigan, *starganv2.values()):
+        module.share_memory()
+    reference_embeddings.share_memory_()
+    return Munch(
+        device=_device, hps_hifigan=_hps_hifigan,
+        F0_model=F0_model, starganv2=starganv2, hifigan=hifigan,
+        reference_embeddings=reference_embeddings, use_denoiser=use_denoiser,
+        lazy_styles=lazy_styles, style_lru_size=style_lru_size, pinned_styles=_pinned_styles,
+        speaker_dicts=_speaker_dicts, style_cache_dir=_style_cache_dir, style_model_key=_style_model_key,
+        resample_plan=_resample_plan, resample_options=_resample_options, window_options=_window_options, denoise_tile_seconds=denoise_tile_seconds, denoise_tile_batch=denoise_tile_batch,
+        style_dim=style_dim, checkpoint_paths=_checkpoint_paths, compiled_dir=_compiled_dir, precision=_precision,
+        # 静的量子化はキャリブレーションに時間がかかるため、このプロセスで量子化したモデルをそのまま渡す
+        static_models={name: m for name, m in _precision_models.items() if _precision[name] == 'int8_static'},
+    )
+
+def install_model_set(model_set):
+    """
+    export_model_set()で作られたモデル一式をこのプロセスのモデルとして使う（ワーカープロセス用）
+    FRCRN・トレース済みモデル・bf16や動的量子化のモデルは共有できないため、このプロセスで初期化・読み込み・変換する
+    静的量子化のモデルは、親プロセスでキャリブレーション・量子化したものを使う
+    ワーカープロセスは割り当てられたコアだけを使うため、参照音声は並列にせず1件ずつ読み込む
+    """
+    global _device, _hps_hifigan, F0_model, starganv2, hifigan, reference_embeddings, use_denoiser, style_workers, \
+        lazy_styles, style_lru_size, _pinned_styles, _speaker_dicts, _style_cache_dir, _style_model_key, _resample_plan, \
+        _resample_options, _plans, _window_options, denoise_tile_seconds, denoise_tile_batch, style_dim, _checkpoint_paths, _compiled_dir, _precision
+    _device = model_set.device
+    _hps_hifigan = model_set.hps_hifigan
+    F0_model = model_set.F0_model
+    starganv2 = model_set.starganv2
+    hifigan = model_set.hifigan
+    reference_embeddings = model_set.reference_embeddings
+    style_workers = 1
+    lazy_styles = model_set.lazy_styles
+    style_lru_size = model_set.style_lru_size
+    _pinned_styles = model_set.pinned_styles
+    _speaker_dicts = model_set.speaker_dicts
+    _style_cache_dir = model_set.style_cache_dir
+    _style_model_key = model_set.style_model_key
+    _resample_plan = model_set.resample_plan
+    _resample_options = model_set.resample_options
+    _plans = {}
+    _window_options = model_set.window_options
+    denoise_tile_seconds = model_set.denoise_tile_seconds
+    denoise_tile_batch = model_set.denoise_tile_batch
+    style_dim = model_set.style_dim
+    _checkpoint_paths = model_set.checkpoint_paths
+    _compiled_dir = model_set.compiled_dir
+    use_denoiser = model_set.use_denoiser
+    if use_denoiser:
+        _initialize_denoiser()
+    if _compiled_dir:
+        _load_compiled()
+    _precision = model_set.precision
+    _apply_precision(model_set.get('static_models'))
+
+def _initialize_vc(h, device, model_dir, model_name, f0_model_path, f0_model_key, style_cache_dir=None, preload_keys=None):
+    """
+    StarGANv2-vcの関連モデルを初期化する内部関数
+
+    preload_keysを指定すると遅延モードになり、起動時にはそのキーのスタイルだけを計算する
+    """
+    global F0_model, starganv2, reference_embeddings, _speaker_dicts, _style_cache_dir, _style_model_key, _pinned_styles, style_dim
     vc_dir_path = os.path.dirname(os.path.abspath(__file__))
 
     print("F0予測モデルを読み込んでいます...")
@@ -80,12 +303,15 @@ def _initialize_vc(h, device, model_dir, model_name, f0_model_path, f0_model_key
     params = torch.load(full_f0_path, weights_only=False)[f0_model_key]
     F0_model.load_state_dict(params)
     _ = F0_model.eval()
+    _checkpoint_paths.append(full_f0_path)
 
     print("StarGANv2モデルを読み込んでいます...")
     model_path = os.path.join(vc_dir_path, 'starganv2_vc', 'Models', model_dir, model_name)
     with open(os.path.join(vc_dir_path, 'starganv2_vc', 'Configs', 'config.yml')) as f:
         starganv2_config = yaml.safe_load(f)
     starganv2 = build_model(model_params=starganv2_config['model_params'])
+    style_dim = starganv2_config['model_params']['style_dim']
+    _checkpoint_paths.append(model_path)
     params = torch.load(model_path, map_location='cpu')['model_ema']
     _ = [starganv2[key].load_state_dict(params[key]) for key in starganv2]
     _ = [starganv2[key].eval().to(device) for key in starganv2]
@@ -97,9 +323,25 @@ def _initialize_vc(h, device, model_dir, model_name, f0_model_path, f0_model_key
             path = os.path.join(vc_dir_path, 'starganv2_vc', 'Data', 'ITA-corpus', s, f'recitation{r:03}.wav')
             speaker_id = const.speakers.index(s) + 1
             speaker_dicts[f'{s}{r:03}'] = (path, speaker_id)
-            
-    reference_embeddings = _compute_style(speaker_dicts)
-    print(f"スタイル辞書の作成が完了しました。{len(reference_embeddings.keys())}件の話者をロードしました。")
+
+    _speaker_dicts = speaker_dicts
+    _style_cache_dir = style_cache_dir
+    _style_model_key = _make_style_cache_key(model_path) if style_cache_dir else None
+    if preload_keys is None:
+        reference_embeddings = StyleTable.from_dict(_load_styles(speaker_dicts), style_dim, device)
+        # 話者ごとの重心（'zundamon*' など）も、通常の参照話者キーと同じように使えるようにする
+        reference_embeddings.add_centroids({i + 1: s for i, s in enumerate(const.speakers)})
+    else:
+        missing = [k for k in preload_keys if not has_reference(k)]
+        if missing: raise ValueError(f"参照話者キー {missing} が見つかりません。")
+        _pinned_styles = set(preload_keys)
+        regular = [k for k in preload_keys if k in speaker_dicts]
+        reference_embeddings = StyleTable.from_dict(_load_styles({k: speaker_dicts[k] for k in regular}), style_dim, device)
+        for key in preload_keys:
+            if key not in reference_embeddings: _load_reference(key)
+        print(f"遅延モード: 起動時は{len(preload_keys)}件のみ計算し、その他は初回参照時に計算します。(上限: {style_lru_size}件)")
+    print(f"スタイル辞書の作成が完了しました。{len(reference_embeddings)}件の話者をロードしました。"
+          f"({reference_embeddings.nbytes / 1024:.0f}KB)")
 
 def build_model(model_params):
     """StarGANv2の各コンポーネントを構築する"""
@@ -110,76 +352,603 @@ def build_model(model_params):
         style_encoder=StyleEncoder(args.dim_in, args.style_dim, args.num_domains, args.max_conv_dim)
     )
 
-def _compute_style(speaker_dicts):
-    """参照音声ファイル群から、話者ごとの声質（スタイル）を抽出する"""
-    local_ref_embeddings = {}
+def _make_style_cache_key(model_path):
+    """スタイルキャッシュのキーを作る（StarGANのチェックポイントとメルのパラメータを含む）"""
+    mel_params = {k: _hps_hifigan[k] for k in ('n_fft', 'num_mels', 'sampling_rate', 'hop_size', 'win_size', 'fmin', 'fmax')}
+    mel_params['min_len_wave'] = min_len_wave
+    # パディングした長さでスタイルが変わるため、長さの差を許容する設定で計算したものとは混ぜない
+    mel_params['style_bucket_seconds'] = style_bucket_seconds
+    return style_cache.make_model_key(model_path, mel_params)
+
+def _load_styles(speaker_dicts):
+    """
+    ディスクキャッシュを使って参照スタイルを揃える
+    キャッシュが無効なら全件、有効なら参照音声が変わったエントリだけを再計算する
+    """
+    if not _style_cache_dir:
+        return _compute_style(speaker_dicts)
+
+    cache_dir = _style_cache_dir
+    cached, table = style_cache.load_style_cache(cache_dir, _style_model_key)
+
+    # 今回対象外のエントリもキャッシュに残す
+    entries = {key: (hit['digest'], table[hit['row']], hit['speaker']) for key, hit in cached.items()}  # キー -> (digest, embedding, speaker_id)
+    stale = {}
     for key, (path, speaker) in speaker_dicts.items():
-        wave, sr = librosa.load(path, sr=24000, res_type='soxr_vhq')
-        wave, _ = librosa.effects.trim(wave, top_db=30)
-        if len(wave) < min_len_wave: wave = np.pad(wave, (0, min_len_wave - len(wave)))
-        
-        wave_tensor = torch.from_numpy(wave).float().unsqueeze(0).to(_device)
-        mel_tensor = mel_spectrogram(
+        digest = style_cache.file_digest(path)
+        hit = entries.get(key)
+        if hit is None or hit[0] != digest or hit[2] != speaker:
+            stale[key] = (path, speaker, digest)
+
+    computed = {}
+    if stale:
+        print(f"{len(stale)}件の参照スタイルを計算します。(キャッシュ済み: {len(speaker_dicts) - len(stale)}件)")
+        computed = _compute_style({key: (path, speaker) for key, (path, speaker, _) in stale.items()})
+        for key, (ref, _) in computed.items():
+            entries[key] = (stale[key][2], ref.squeeze(0).cpu().numpy(), stale[key][1])
+        style_cache.save_style_cache(cache_dir, _style_model_key, entries)
+        print(f"スタイルキャッシュを '{cache_dir}' に保存しました。")
+    else:
+        print(f"スタイルキャッシュ '{cache_dir}' から{len(speaker_dicts)}件を読み込みました。")
+
+    local_ref_embeddings = {}
+    for key in speaker_dicts:
+        if key in computed:
+            local_ref_embeddings[key] = computed[key]
+        else:
+            _, emb, speaker = entries[key]
+            ref = torch.from_numpy(emb).unsqueeze(0).to(_device)
+            local_ref_embeddings[key] = (ref, torch.LongTensor([speaker]).to(_device))
+    return local_ref_embeddings
+
+def _compute_style(speaker_dicts):
+    """
+    参照音声ファイル群から、話者ごとの声質（スタイル）を抽出する
+    デコード・トリム・リサンプリングはスレッドプールで並列に行い、
+    スタイルエンコーダには同じ長さの音声をまとめたバッチで入力する（1件ずつ入力した場合と同じスタイルになる）
+    style_bucket_secondsを指定すると長さの近い音声もまとめるが、パディングした無音の分だけスタイルが変わる
+    """
+    keys = list(speaker_dicts.keys())
+    sr = _hps_hifigan.sampling_rate
+    waves = load_reference_waves([speaker_dicts[k][0] for k in keys], sr, min_len_wave, workers=style_workers)
+
+    computed = {}
+    buckets = length_buckets([len(w) for w in waves], style_batch_size, int(style_bucket_seconds * sr))
+    for bucket in buckets:
+        # バケット内の最長に合わせて無音でパディング（style_bucket_secondsが0なら全て同じ長さのためパディングされない）
+        max_len = max(len(waves[i]) for i in bucket)
+        batch = np.stack([np.pad(waves[i], (0, max_len - len(waves[i]))) for i in bucket])
+
+        wave_tensor = torch.from_numpy(batch).float().to(_device)
+        mel_tensor = _mel_spectrogram(wave_tensor)
+        with torch.no_grad():
+            labels = torch.LongTensor([speaker_dicts[keys[i]][1] for i in bucket]).to(_device)
+            refs = starganv2.style_encoder(mel_tensor.unsqueeze(1), labels)
+        for j, i in enumerate(bucket):
+            computed[keys[i]] = (refs[j:j + 1], labels[j:j + 1])
+
+    return {key: computed[key] for key in keys}
+
+def _mel_spectrogram(wave_tensor):
+    """HiFi-GANの設定で音声 [B, T] をメルスペクトログラム [B, num_mels, T/hop] に変換する"""
+    with metrics.timer('mel'):
+        return mel_spectrogram(
             wave_tensor, _hps_hifigan.n_fft, _hps_hifigan.num_mels, _hps_hifigan.sampling_rate,
             _hps_hifigan.hop_size, _hps_hifigan.win_size, _hps_hifigan.fmin, _hps_hifigan.fmax
         )
-        with torch.no_grad():
-            label = torch.LongTensor([speaker]).to(_device)
-            ref = starganv2.style_encoder(mel_tensor.unsqueeze(1), label)
-        local_ref_embeddings[key] = (ref, label)
-    return local_ref_embeddings
 
-def _internal_conversion(mel, ref_emb_key):
-    """メルスペクトログラムを変換する内部関数"""
-    f0_feat = F0_model.get_feature_GAN(mel.unsqueeze(1))
+def _centroid_speaker(key):
+    """'zundamon*' のような重心のキーなら話者名を、そうでなければNoneを返す"""
+    if not is_centroid_key(key): return None
+    name = key[:-len(centroid_key(''))]
+    return name if name in const.speakers else None
+
+def has_reference(key):
+    """参照話者キーが使えるか（遅延モードで未計算のものも含む）"""
+    if key in _speaker_dicts or _centroid_speaker(key) is not None: return True
+    return reference_embeddings is not None and key in reference_embeddings
+
+def _get_reference(ref_emb_key):
+    """
+    参照話者キーに対応する (スタイル [1, style_dim], ラベル [1]) を返す
+    'zundamon*' のようなキーは、その話者の全参照音声のスタイルの重心を表す
+    遅延モードでは初回参照時に計算し、上限数を超えたら最も長く使われていないものから破棄する
+    """
+    while True:
+        with _style_lock:
+            ref_tuple = _lookup_reference(ref_emb_key)
+            # 遅延モードでは破棄した行が再利用されるため、表のビューではなくコピーを返す
+            if ref_tuple is not None: return tuple(t.clone() for t in ref_tuple) if lazy_styles else ref_tuple
+        _load_reference(ref_emb_key)
+
+def _get_styles(ref_emb_keys):
+    """複数の参照話者キーのスタイルを、1回のインデックス参照で [len(keys), style_dim] にまとめて返す"""
+    while True:
+        with _style_lock:
+            missing = [key for key in dict.fromkeys(ref_emb_keys) if _lookup_reference(key) is None]
+            if not missing: return reference_embeddings.gather(ref_emb_keys)[0]
+        for key in missing:
+            _load_reference(key, protect=ref_emb_keys)
+
+def _lookup_reference(ref_emb_key):
+    """表にあるスタイルを返す（_style_lockを取得してから呼ぶ）。遅延モードで未計算ならNoneを返す"""
     ref_tuple = reference_embeddings.get(ref_emb_key)
-    if ref_tuple is None: raise ValueError(f"参照話者キー '{ref_emb_key}' が見つかりません。")
-    
-    out = starganv2.generator(mel.unsqueeze(1), ref_tuple[0], F0=f0_feat)
-    return out.squeeze(1)
+    if ref_tuple is not None:
+        if lazy_styles: reference_embeddings.touch(ref_emb_key)
+        return ref_tuple
+    if not lazy_styles or (ref_emb_key not in _speaker_dicts and _centroid_speaker(ref_emb_key) is None):
+        raise ValueError(f"参照話者キー '{ref_emb_key}' が見つかりません。")
+    return None
 
-def convert_voice(audio_data_bytes, speaker_key):
+def _load_reference(ref_emb_key, protect=()):
     """
-    音声バイトデータを受け取り、変換後の音声バイトデータを返す全工程（リサンプリング含む）
+    遅延モードで未計算の参照スタイルを計算して表に加える。protectのキーは破棄しない
+    参照音声の読み込みとスタイルエンコーダは_style_lockの外で実行し、他の変換を待たせない
+    同じキーを複数のスレッドが同時に要求した場合は、最初のスレッドの計算結果を待つ
     """
-    client_rate = 48000
-    model_rate = _hps_hifigan.sampling_rate
+    with _style_lock:
+        if ref_emb_key in reference_embeddings: return
+        future = _loading_styles.get(ref_emb_key)
+        owner = future is None
+        if owner: future = _loading_styles[ref_emb_key] = Future()
+    if not owner:
+        future.result()
+        return
+
+    try:
+        speaker_name = _centroid_speaker(ref_emb_key)
+        if speaker_name is not None:
+            # 重心は話者の全参照音声から求める（スタイルキャッシュがあればそこから読む）。数が少ないため破棄しない
+            print(f"話者 '{speaker_name}' のスタイルの重心を計算しています...")
+            speaker_id = const.speakers.index(speaker_name) + 1
+            refs = _load_styles({k: v for k, v in _speaker_dicts.items() if v[1] == speaker_id})
+            ref_tuple = (torch.cat([ref for ref, _ in refs.values()]).mean(dim=0, keepdim=True), torch.LongTensor([speaker_id]))
+        else:
+            print(f"参照話者 '{ref_emb_key}' のスタイルを計算しています...")
+            ref_tuple = _load_styles({ref_emb_key: _speaker_dicts[ref_emb_key]})[ref_emb_key]
+    except Exception as e:
+        with _style_lock:
+            del _loading_styles[ref_emb_key]
+        future.set_exception(e)
+        raise
 
-    # 1. バイト -> float配列 (48kHz)
-    audio_int16 = np.frombuffer(audio_data_bytes, dtype=np.int16)
-    audio_float_48k = audio_int16.astype(np.float32) / 32768.0
+    with _style_lock:
+        reference_embeddings.put(ref_emb_key, *ref_tuple)
+        if speaker_name is not None: _pinned_styles.add(ref_emb_key)
+        evictable = [k for k in reference_embeddings if k not in _pinned_styles and k != ref_emb_key and k not in protect]
+        while len(reference_embeddings) > style_lru_size and evictable:
+            reference_embeddings.remove(evictable.pop(0))
+        del _loading_styles[ref_emb_key]
+    future.set_result(None)
 
-    # 2. 48kHz -> 24kHz (モデルのレート) へリサンプリング
-    audio_float_24k = soxr.resample(audio_float_48k, client_rate, model_rate, 'VHQ')
+def _f0_features(mel):
+    """メル [B, num_mels, T] からF0特徴量を求める（トレース済みモデルがあればそちらを使う）"""
+    with metrics.timer('f0'):
+        if 'f0' in _precision_models: return _precision_models['f0'](mel.unsqueeze(1))
+        if _compiled is not None: return _compiled['f0'](mel.unsqueeze(1))
+        return F0_model.get_feature_GAN(mel.unsqueeze(1))
+
+def _generate(mel, style, f0_feat):
+    """メル [B, num_mels, T] を目標話者のスタイルに変換する（生成器はトレース済みモデルを持たず、常にeagerモードで実行する）"""
+    with metrics.timer('generator'):
+        if 'generator' in _precision_models: return _precision_models['generator'](mel.unsqueeze(1), style, f0_feat).squeeze(1)
+        return starganv2.generator(mel.unsqueeze(1), style, F0=f0_feat).squeeze(1)
+
+def _vocode(mel):
+    """メル [B, num_mels, T] を音声 [B, 1, T * hop] に変換する（トレース済みモデルがあればそちらを使う）"""
+    with metrics.timer('vocoder'):
+        if 'vocoder' in _precision_models: return _precision_models['vocoder'](mel)
+        if _compiled is not None: return _compiled['vocoder'](mel)
+        return hifigan(mel)
+
+def _internal_conversion(mel, ref_emb_key):
+    """メルスペクトログラムを変換する内部関数"""
+    f0_feat = _f0_features(mel)
+    ref_tuple = _get_reference(ref_emb_key)
     
-    # 3. (オプション) ノイズ除去
-    if use_denoiser:
-        print("ノイズ除去を実行しています...")
-        # frcrnは16kHzを想定しているためリサンプリング
-        audio_for_denoise = soxr.resample(audio_float_24k, model_rate, denoise_samplerate, 'VHQ')
-        denoised_wave = denoise(audio_for_denoise)
-        # 再びモデルのレートに戻す
-        audio_float_24k = soxr.resample(denoised_wave, denoise_samplerate, model_rate, 'VHQ')
+    return _generate(mel, ref_tuple[0], f0_feat)
+
+client_rate = 48000 # クライアントとやり取りする音声のサンプリングレート
+
+def _plan_for(fmt):
+    """入出力のサンプリングレートに応じたリサンプリング経路。レートがモデルと同じ段は省略される"""
+    key = (fmt.sample_rate, fmt.output_sample_rate)
+    if key == (client_rate, client_rate): return _resample_plan
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = resample_plan.make_plan(
+            fmt.sample_rate, _hps_hifigan.sampling_rate, denoise_samplerate, use_denoiser,
+            _resample_options.qualities, _resample_options.mode, output_rate=fmt.output_sample_rate
+        )
+    return plan
+
+def _decode(audio_data_bytes, fmt):
+    # 1. バイト -> float配列 (既定は48kHz int16)
+    with metrics.timer('decode'):
+        return audio_codec.decode(audio_data_bytes, fmt.encoding)
+
+def _front(wave, fmt):
+    """クライアントのレートのfloat配列を、モデルのレートに変換する（ノイズ除去含む）"""
+    # 2-3. 48kHz -> 24kHz (モデルのレート) へリサンプリング、(オプション) ノイズ除去
+    # ノイズ除去が有効な場合は、48kHzから直接FRCRNの16kHzへ変換してから24kHzへ戻す
+    if use_denoiser: print("ノイズ除去を実行しています...")
+    for step in _plan_for(fmt).front:
+        with metrics.timer('denoise' if step[0] == 'denoise' else f'resample_{step[4]}'):
+            wave = resample_plan.run_steps(wave, [step], denoise)
+    return wave
+
+def _back(output_wav_24k_np, fmt):
+    """モデルのレートの変換結果を、クライアントのレートに変換する"""
+    # 7. 24kHz -> 48kHz (クライアントのレート) へリサンプリング
+    with metrics.timer('resample_output'):
+        return resample_plan.run_steps(output_wav_24k_np, _plan_for(fmt).back)
+
+def _encode(output_wave, fmt):
+    # 8. float配列 -> バイト
+    with metrics.timer('encode'):
+        return audio_codec.encode(output_wave, fmt.output_encoding, fmt.output_sample_rate)
+
+def _to_model_rate(audio_data_bytes, fmt=None):
+    """クライアントの音声データを、モデルのレートのfloat配列に変換する（ノイズ除去含む）"""
+    fmt = fmt or audio_codec.DEFAULT_FORMAT
+    return _front(_decode(audio_data_bytes, fmt), fmt)
+
+def _to_client_bytes(output_wav_24k_np, fmt=None):
+    """モデルのレートの変換結果を、クライアントが要求した形式の音声データに変換する"""
+    fmt = fmt or audio_codec.DEFAULT_FORMAT
+    return _encode(_back(output_wav_24k_np, fmt), fmt)
 
+def convert_voice(audio_data_bytes, speaker_key, fmt=None):
+    """
+    音声バイトデータを受け取り、変換後の音声バイトデータを返す全工程（リサンプリング含む）
+    fmtで入出力の形式（audio_codec.negotiateの結果）を指定できる。省略時は48kHz int16
+    """
+    audio_float_24k = _to_model_rate(audio_data_bytes, fmt)
+    if _use_windows(len(audio_float_24k)):
+        with torch.no_grad():
+            output_wav_24k = _convert_windowed(audio_float_24k, _get_reference(speaker_key)[0])
+        return _to_client_bytes(output_wav_24k, fmt)
     input_wav_tensor = torch.from_numpy(audio_float_24k).unsqueeze(0).to(_device)
 
     with torch.no_grad():
         # 4. 音声 -> メルスペクトログラム (24kHz)
-        input_mel = mel_spectrogram(
-            input_wav_tensor, _hps_hifigan.n_fft, _hps_hifigan.num_mels, _hps_hifigan.sampling_rate,
-            _hps_hifigan.hop_size, _hps_hifigan.win_size, _hps_hifigan.fmin, _hps_hifigan.fmax
-        )
+        input_mel = _mel_spectrogram(input_wav_tensor)
         
         # 5. メルスペクトログラムを声質変換
         converted_mel = _internal_conversion(input_mel, speaker_key)
         
         # 6. 変換後メルスペクトログラム -> 音声 (24kHz)
-        output_wav_24k = hifigan(converted_mel)
+        output_wav_24k = _vocode(converted_mel)
     
-    # 7. 24kHz -> 48kHz (クライアントのレート) へリサンプリング
-    output_wav_24k_np = output_wav_24k.squeeze().cpu().numpy()
-    output_wav_48k_np = soxr.resample(output_wav_24k_np, model_rate, client_rate, 'VHQ')
+    return _to_client_bytes(output_wav_24k.squeeze().cpu().numpy(), fmt)
 
-    # 8. float配列 -> バイト
-    output_wav_int16 = (output_wav_48k_np * 32767.0).astype(np.int16)
-    return output_wav_int16.tobytes()
+def convert_voice_batch(audio_data_list, speaker_keys, formats=None):
+    """
+    複数の発話をまとめて変換する。メル計算・F0抽出・生成器・ボコーダーは1回のバッチで実行する
+    短い発話は無音でパディングし、出力はそれぞれ単体で変換した場合と同じ長さに切り戻す
+
+    Args:
+        audio_data_list (list): 音声バイトデータのリスト
+        speaker_keys (list): 各発話の目標話者キー
+        formats (list): 各発話の入出力の形式（省略時は全て48kHz int16）
+    """
+    formats = formats or [None] * len(audio_data_list)
+    waves = [_to_model_rate(a, fmt) for a, fmt in zip(audio_data_list, formats)]
+    outputs = _convert_model_waves(waves, speaker_keys)
+    return [_to_client_bytes(y, fmt) for y, fmt in zip(outputs, formats)]
+
+def _convert_model_waves(waves, speaker_keys):
+    """
+    モデルのレートの波形のリストを1回のバッチで変換し、それぞれ単体で変換した場合と同じ長さで返す
+    窓に分けて変換する長さの波形は、バッチに含めずに1つずつ窓ごとに変換する
+    """
+    long = [i for i, w in enumerate(waves) if _use_windows(len(w))]
+    if long:
+        outputs = [None] * len(waves)
+        with torch.no_grad():
+            for i in long:
+                outputs[i] = _convert_windowed(waves[i], _get_reference(speaker_keys[i])[0])
+        rest = [i for i in range(len(waves)) if outputs[i] is None]
+        if rest:
+            for i, y in zip(rest, _convert_model_waves([waves[i] for i in rest], [speaker_keys[i] for i in rest])):
+                outputs[i] = y
+        return outputs
+
+    hop = _hps_hifigan.hop_size
+    max_len = max(len(w) for w in waves)
+    batch = np.stack([np.pad(w, (0, max_len - len(w))) for w in waves]).astype(np.float32)
+
+    with torch.no_grad():
+        input_mel = _mel_spectrogram(torch.from_numpy(batch).to(_device))
+        f0_feat = _f0_features(input_mel)
+        refs = _get_styles(speaker_keys)
+        converted_mel = _generate(input_mel, refs, f0_feat)
+        output_wav_24k = _vocode(converted_mel).squeeze(1).cpu().numpy()
+
+    # メルのフレーム数は floor(長さ / hop) になるため、単体変換と同じ長さに切り戻す
+    return [y[:len(w) // hop * hop] for w, y in zip(waves, output_wav_24k)]
+
+def _use_windows(n_samples):
+    """モデルのレートでn_samplesの入力を、窓に分けて変換するか"""
+    seconds = _window_options.seconds
+    return seconds is not None and n_samples > seconds * _hps_hifigan.sampling_rate
+
+def _convert_windowed(wave, style):
+    """
+    モデルのレートの波形を、重なりのある固定長の窓に分けて変換する（torch.no_grad()内で呼ぶ）
+    styleは1話者分 [1, style_dim]。複数の話者へ同時に変換する場合は_convert_windowed_multiを使う
+    """
+    return _convert_windowed_multi(wave, style)[0]
+
+def _convert_windowed_multi(wave, styles):
+    """
+    _convert_windowedを複数の目標話者について同時に行う。メル計算・F0抽出は窓ごとに1回だけ行う
+
+    各窓は受け持つframesフレームの両側にcontext_framesフレームの文脈を付けた長さで、
+    メル計算・F0抽出・生成器・ボコーダーをbatch個の窓ずつまとめて実行する。
+    出力は各窓の受け持ち部分をつなぎ、境界はcrossfade_frames分を文脈側の出力とクロスフェードする。
+    ボコーダーは畳み込みのみのため文脈が受容野より長ければ一括の変換と一致するが、生成器のInstanceNorm・AdaINは
+    窓ごとの統計を使うため、一括の変換とは一致しない（文脈は窓の境界での不連続を抑えるためのもの）。
+    一括の変換との差はtest_windowed.pyで確かめられる。
+    先頭・末尾の窓は入力の範囲内に収まるようずらすため、全ての窓が同じ長さになり、
+    作業メモリは入力の長さによらず一定になる（出力の波形自体を除く）。
+
+    Args:
+        styles (torch.Tensor): 目標話者のスタイル [S, style_dim]
+    Returns:
+        np.ndarray: 変換後の波形 [S, T]。長さは一括で変換した場合と同じ (len(wave) // hop * hop)
+    """
+    opts = _window_options
+    n_styles = styles.shape[0]
+    hop = _hps_hifigan.hop_size
+    n_frames = len(wave) // hop
+    core, context, xf = opts.frames, opts.context_frames, opts.crossfade_frames
+    length = core + 2 * context
+    if n_frames <= length:
+        # 1つの窓に収まる場合は一括で変換する
+        mel = _mel_spectrogram(torch.from_numpy(wave.astype(np.float32)).unsqueeze(0).to(_device))
+        return _generate_styles(mel, _f0_features(mel), styles)[:, :n_frames * hop]
+
+    n_windows = -(-n_frames // core)
+    starts = [min(max(0, k * core - context), n_frames - length) for k in range(n_windows)]
+    output = np.zeros((n_styles, n_frames * hop), dtype=np.float32)
+    fade = np.hanning(xf * hop * 2).astype(np.float32)
+    fade_in, fade_out = fade[:xf * hop], fade[xf * hop:]
+    # 1回に生成器・ボコーダーに通す数（窓の数 × 話者の数）がbatchを超えないようにする
+    windows_per_batch = max(1, opts.batch // n_styles)
+    for first in range(0, n_windows, windows_per_batch):
+        ks = range(first, min(n_windows, first + windows_per_batch))
+        batch = np.stack([wave[starts[k] * hop:(starts[k] + length) * hop] for k in ks]).astype(np.float32)
+        mel = _mel_spectrogram(torch.from_numpy(batch).to(_device))
+        # [窓, 話者] の順に並ぶ
+        ys = _generate_styles(mel, _f0_features(mel), styles).reshape(len(ks), n_styles, -1)
+
+        for k, y_styles in zip(ks, ys):
+            # 受け持ち部分 [a, b) と、次の窓とのクロスフェード部分 [b, b + xf)
+            a, b = k * core, min(n_frames, (k + 1) * core)
+            end = min(n_frames, b + xf) if k < n_windows - 1 else b
+            segment = y_styles[:, (a - starts[k]) * hop:(end - starts[k]) * hop].copy()
+            if k > 0:
+                n = min(segment.shape[1], len(fade_in))
+                segment[:, :n] *= fade_in[:n]
+            if k < n_windows - 1:
+                tail = segment[:, (b - a) * hop:]
+                tail *= fade_out[:tail.shape[1]]
+            output[:, a * hop:end * hop] += segment
+    return output
+
+def _generate_styles(mel, f0_feat, styles):
+    """
+    メル [B, num_mels, T] の各要素を、styles [S, style_dim] の全ての話者に変換して音声にする
+    生成器とボコーダーはB×Sのバッチで1回だけ実行し、[要素, 話者] の順に並んだ音声 [B*S, T * hop] を返す
+    """
+    n_styles = styles.shape[0]
+    if n_styles > 1:
+        mel = mel.repeat_interleave(n_styles, dim=0)
+        f0_feat = f0_feat.repeat_interleave(n_styles, dim=0)
+    styles = styles.repeat(mel.shape[0] // n_styles, 1)
+    return _vocode(_generate(mel, styles, f0_feat)).squeeze(1).cpu().numpy()
+
+def convert_voice_multi(audio_data_bytes, speaker_keys, fmt=None):
+    """
+    1つの発話を複数の目標話者に変換し、speaker_keysと同じ順に変換後の音声バイトデータのリストを返す
+    デコード・リサンプリング・ノイズ除去・メル計算・F0抽出は1回だけ行い、
+    生成器とボコーダーは目標話者の数のバッチで実行する
+    """
+    fmt = fmt or audio_codec.DEFAULT_FORMAT
+    wave = _to_model_rate(audio_data_bytes, fmt)
+    styles = _get_styles(speaker_keys)
+    with torch.no_grad():
+        if _use_windows(len(wave)):
+            outputs = _convert_windowed_multi(wave, styles)
+        else:
+            mel = _mel_spectrogram(torch.from_numpy(wave).unsqueeze(0).to(_device))
+            outputs = _generate_styles(mel, _f0_features(mel), styles)
+    return [_to_client_bytes(y, fmt) for y in outputs]
+
+span_fade_seconds = 0.005 # 発話区間の変換結果の両端に掛けるフェードの長さ（秒）
+span_bucket_seconds = 0.25 # 1回のバッチにまとめる発話区間の長さの差の上限（秒）
+span_batch_size = 8 # 1回のバッチにまとめる発話区間の数の上限
+
+def convert_voice_spans(audio_data_bytes, speaker_key, spans, fmt=None):
+    """
+    発話区間だけを変換し、区間の外は無音にして元の長さでつなぎ直す
+    リサンプリングとノイズ除去は入力全体に1回だけ行い、生成器・ボコーダーは発話区間だけに行う
+    生成器のInstanceNormは時間軸全体の統計を使うため、長さの近い区間同士だけをバッチにまとめ、
+    それ以外の区間は1つずつ変換する（短い区間が長い区間に合わせた無音のパディングで変わらないようにする）
+
+    Args:
+        spans (list): 入力のサンプリングレートでの発話区間 [(開始, 終了), ...]（サンプル位置、重なり無し）
+    """
+    fmt = fmt or audio_codec.DEFAULT_FORMAT
+    wave = _front(_decode(audio_data_bytes, fmt), fmt)
+    model_rate = _hps_hifigan.sampling_rate
+    ratio = model_rate / fmt.sample_rate
+    segments = [(int(start * ratio), min(len(wave), int(end * ratio))) for start, end in spans]
+    segments = [(start, end) for start, end in segments if end > start]
+
+    result = np.zeros(len(wave), dtype=np.float32)
+    fade_len = int(span_fade_seconds * model_rate)
+    fade = np.hanning(fade_len * 2).astype(np.float32)
+    lengths = [end - start for start, end in segments]
+    for bucket in length_buckets(lengths, span_batch_size, int(span_bucket_seconds * model_rate)):
+        outputs = _convert_model_waves([wave[segments[i][0]:segments[i][1]] for i in bucket], [speaker_key] * len(bucket))
+        for i, y in zip(bucket, outputs):
+            # 区間の境界でクリックノイズが出ないよう、両端をフェードする
+            y = y.astype(np.float32)
+            if len(y) >= fade_len * 2 > 0:
+                y[:fade_len] *= fade[:fade_len]
+                y[-fade_len:] *= fade[fade_len:]
+            start = segments[i][0]
+            result[start:start + len(y)] = y[:len(result) - start]
+    return _to_client_bytes(result, fmt)
+
+
+stream_block_seconds = 1.0 # ストリーミング応答で1回に変換するブロックの長さ（秒）
+
+def convert_voice_stream(audio_data_bytes, speaker_key, fmt=None):
+    """
+    convert_voiceと同じ入出力で、変換できたブロックから順に出力形式のバイト列をyieldするジェネレータ
+    ノイズ除去まではconvert_voiceと同じく発話全体に適用し、それ以降をStreamingSessionと同じ
+    [左文脈 | ブロック | 先読み] のウィンドウで変換するため、最初のチャンクは最初のウィンドウの変換だけで返せる
+    FLACの場合、各チャンクはそれぞれ独立したFLACデータになる
+    """
+    fmt = fmt or audio_codec.DEFAULT_FORMAT
+    wave = _to_model_rate(audio_data_bytes, fmt)
+    model_rate = _hps_hifigan.sampling_rate
+    session = StreamingSession(
+        speaker_key, client_rate=model_rate, output_rate=fmt.output_sample_rate,
+        block_frames=max(1, int(stream_block_seconds * model_rate / _hps_hifigan.hop_size))
+    )
+    for start in range(0, len(wave), session.block_samples):
+        out = session.feed_wave(wave[start:start + session.block_samples])
+        if len(out): yield audio_codec.encode(out, fmt.output_encoding, fmt.output_sample_rate)
+    out = session.flush_wave()
+    if len(out): yield audio_codec.encode(out, fmt.output_encoding, fmt.output_sample_rate)
+
+
+class StreamingSession:
+    """
+    int16のチャンクを逐次受け取り、変換済みのint16チャンクを返すストリーミング変換セッション
+
+    モデルレートの入力を [左文脈 | ブロック | 先読み] の固定長ウィンドウで保持し、
+    ブロック分の入力が溜まるごとにウィンドウ全体を変換してブロック部分だけを出力する。
+    ブロック境界は、前のウィンドウが先読み部分で予測した波形とクロスフェードでつなぐ。
+    リサンプラーの状態・ウィンドウ・クロスフェード用の末尾はセッションが保持するため、
+    作業メモリは入力全体の長さに依存しない。
+    出力は入力と時刻がそろうよう先頭の遅延分を捨てており、flush()後の合計長は入力と同じになる。
+    output_rateを指定すると、出力はclient_rateではなくそのレートで返す。モデルと同じレートの側はリサンプリングしない。
+
+    ノイズ除去（FRCRN）は固定長でトレースされているため、このセッションでは適用しない。
+    """
+
+    def __init__(self, speaker_key, client_rate=48000, block_frames=16, context_frames=32,
+                 lookahead_frames=8, crossfade_frames=2, quality='VHQ', output_rate=None):
+        hop = _hps_hifigan.hop_size
+        if crossfade_frames > lookahead_frames or crossfade_frames > context_frames:
+            raise ValueError("crossfade_framesはlookahead_frames・context_frames以下にしてください。")
+        self.speaker_key = speaker_key
+        self.client_rate = client_rate
+        self.output_rate = output_rate or client_rate
+        self.model_rate = _hps_hifigan.sampling_rate
+        self._ref = _get_reference(speaker_key)[0]
+
+        self._context = context_frames * hop
+        self._block = block_frames * hop
+        self._lookahead = lookahead_frames * hop
+        self._crossfade = crossfade_frames * hop
+        self._window = np.zeros(self._context + self._block + self._lookahead, dtype=np.float32)
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._tail = None
+        fade = np.hanning(self._crossfade * 2).astype(np.float32)
+        self._fade_in, self._fade_out = fade[:self._crossfade], fade[self._crossfade:]
+
+        self._in_resampler = None
+        if client_rate != self.model_rate:
+            self._in_resampler = soxr.ResampleStream(client_rate, self.model_rate, 1, dtype='float32', quality=quality)
+        self._out_resampler = None
+        if self.output_rate != self.model_rate:
+            self._out_resampler = soxr.ResampleStream(self.model_rate, self.output_rate, 1, dtype='float32', quality=quality)
+
+        # 先読み分だけ出力が遅れるため、先頭のその分を捨てて入力と時刻をそろえる
+        self._drop = self._lookahead
+        self._fed = 0 # 受け取った入力サンプル数（client_rate）
+        self._emitted = 0 # 返した出力サンプル数（output_rate）
+        self.max_latency = 0.0 # 実測した入力と出力の時刻差の最大値（秒）
+
+    @property
+    def algorithmic_latency(self):
+        """ブロックの蓄積と先読みによる理論上の遅延（秒）。リサンプラーの遅延は含まない"""
+        return (self._block + self._lookahead) / self.model_rate
+
+    @property
+    def block_samples(self):
+        """1回の変換で進むモデルレートのサンプル数"""
+        return self._block
+
+    def feed(self, audio_data_bytes):
+        """int16のチャンクを受け取り、出力できるようになった分の変換済みint16バイト列を返す"""
+        audio_int16 = np.frombuffer(audio_data_bytes, dtype=np.int16)
+        return self._to_bytes(self.feed_wave(audio_int16.astype(np.float32) / 32768.0))
+
+    def flush(self):
+        """残りの入力を無音で押し出し、最後の出力を返す。以後このセッションは使用できない"""
+        return self._to_bytes(self.flush_wave())
+
+    def feed_wave(self, wave):
+        """float32の波形 (client_rate) を受け取り、出力できるようになった分の変換済み波形 (output_rate) を返す"""
+        self._fed += len(wave)
+        out = self._resample(self._out_resampler, self._convert_pending(self._resample(self._in_resampler, wave)))
+        self._emitted += len(out)
+        self.max_latency = max(self.max_latency, self._fed / self.client_rate - self._emitted / self.output_rate)
+        return out
+
+    def flush_wave(self):
+        """flush()の波形版"""
+        wave = self._resample(self._in_resampler, np.zeros(0, dtype=np.float32), last=True)
+        # 未処理の入力と先読み分が出力されるまで無音を足す
+        remaining = len(self._pending) + len(wave) + self._lookahead
+        padding = np.zeros(-remaining % self._block + self._lookahead, dtype=np.float32)
+        model_wave = self._convert_pending(np.concatenate([wave, padding]))
+        out = self._resample(self._out_resampler, model_wave, last=True)
+        # 無音の押し出しで余分に出た分を切り落とし、入力と同じ長さにする
+        out = out[:max(0, self._fed * self.output_rate // self.client_rate - self._emitted)]
+        self._emitted += len(out)
+        return out
+
+    @staticmethod
+    def _resample(resampler, wave, last=False):
+        if resampler is None: return wave.astype(np.float32)
+        return resampler.resample_chunk(wave.astype(np.float32), last=last)
+
+    def _convert_pending(self, wave):
+        """ブロック単位で変換し、モデルレートの出力波形を返す"""
+        self._pending = np.concatenate([self._pending, wave.astype(np.float32)])
+        outputs = []
+        while len(self._pending) >= self._block:
+            block, self._pending = self._pending[:self._block], self._pending[self._block:]
+            self._window = np.concatenate([self._window[self._block:], block])
+            outputs.append(self._convert_window())
+        out = np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.float32)
+        if self._drop:
+            dropped = min(self._drop, len(out))
+            out, self._drop = out[dropped:], self._drop - dropped
+        return out
+
+    def _convert_window(self):
+        with torch.no_grad():
+            wave_tensor = torch.from_numpy(self._window).unsqueeze(0).to(_device)
+            mel = _mel_spectrogram(wave_tensor)
+            converted_mel = _generate(mel, self._ref, _f0_features(mel))
+            y = _vocode(converted_mel).squeeze().cpu().numpy()
+
+        start, end = self._context, self._context + self._block
+        block = y[start:end].copy()
+        if self._tail is not None:
+            block[:self._crossfade] = self._tail * self._fade_out + block[:self._crossfade] * self._fade_in
+        # 次のブロックの先頭に当たる部分を、クロスフェード用に保持する
+        self._tail = y[end:end + self._crossfade].copy()
+        return block
+
+    def _to_bytes(self, wave):
+        return (wave * 32767.0).astype(np.int16).tobytes()
@@ -1,14 +1,17 @@
 # https://github.com/modelscope/modelscope/blob/master/modelscope/pipelines/audio/ans_pipeline.py
 # https://github.com/modelscope/modelscope/blob/master/modelscope/models/audio/ans/frcrn.py
+import threading
+import weakref
 import numpy as np
 import torch
 from modelscope.models import Model
 from modelscope.utils.audio.audio_utils import audio_norm
 
-_device = None
-model = None
 window = 16000
 stride = int(window * 0.75)
+_default = None # initialize_frcrn()で作り、denoise()が使うDenoiser
+_instances = weakref.WeakValueDictionary() # (デバイス, タイル長, 重なり, バッチ) -> 使用中のDenoiser
+_instances_lock = threading.Lock()
 
 
 def padding(wave, nsamples):
@@ -23,24 +26,94 @@ def padding(wave, nsamples):
     return wave
 
 
-def initialize_frcrn(device, nsamples):
-    global _device, model
-    _device = device
-    model = Model.from_pretrained('damo/speech_frcrn_ans_cirm_16k').model.to(device).eval()
+def _trace(base, batch_size, tile_samples, device):
     with torch.no_grad():
-        wave = np.random.random_sample((nsamples,)).astype(np.float32)
-        wave = padding(wave[None], nsamples)
+        wave = np.random.random_sample((batch_size, tile_samples)).astype(np.float32)
         wave = torch.from_numpy(wave).to(device)
-        model = torch.jit.trace(model, wave, strict=False)
-        model = torch.jit.freeze(model)
+        return torch.jit.freeze(torch.jit.trace(base, wave, strict=False))
+
+
+class Denoiser:
+    """
+    [batch_size, タイル長] と [1, タイル長] の固定形状でトレースしたFRCRN
+    タイル長はnsamplesをwindow/strideの格子に切り上げた長さになる
+    作成後は状態を変えないため、複数のスレッド・モデル一式から同時に使える
+    """
+
+    def __init__(self, device, nsamples, overlap=window // 2, batch_size=1):
+        self.device = device
+        self.tile_samples = padding(np.zeros((1, nsamples), np.float32), nsamples).shape[1]
+        if not 0 < overlap < self.tile_samples:
+            raise ValueError(f"overlapは0より大きくタイル長({self.tile_samples})未満にしてください。")
+        self.tile_overlap = overlap
+        self.tile_batch = batch_size
+        base = Model.from_pretrained('damo/speech_frcrn_ans_cirm_16k').model.to(device).eval()
+        self.model = _trace(base, batch_size, self.tile_samples, device)
+        # tile_batchに満たない残りのタイル用
+        self.model_single = self.model if batch_size == 1 else _trace(base, 1, self.tile_samples, device)
+
+    def __call__(self, wave):
+        """
+        任意の長さの音声をタイルに分けてノイズ除去する
+        タイルはtile_batch個ずつ、残りは1個ずつトレース時と同じ形状で処理し、重なり部分はクロスフェードで足し合わせるため、
+        入力の長さに関わらず再トレースは起きず、1回の呼び出しのメモリ使用量も一定になる
+        短い入力（タイル1つ分）でも、無音のタイルでバッチを埋めて余分に計算することはない
+        """
+        tile_samples, tile_overlap, tile_batch = self.tile_samples, self.tile_overlap, self.tile_batch
+        scale = np.amax(wave)
+        wave = audio_norm(wave)
+        scale /= np.amax(wave)
+        nsamples = len(wave)
+
+        hop = tile_samples - tile_overlap
+        n_tiles = max(1, -(-(nsamples - tile_overlap) // hop))
+        total = (n_tiles - 1) * hop + tile_samples
+        padded = np.zeros(total, np.float32)
+        padded[:nsamples] = wave
+        tiles = np.lib.stride_tricks.sliding_window_view(padded, tile_samples)[::hop]
+
+        # 重なり部分で和が1になる上昇・下降の窓
+        fade_in = (0.5 - 0.5 * np.cos(np.pi * (np.arange(tile_overlap) + 0.5) / tile_overlap)).astype(np.float32)
+        fade_out = 1.0 - fade_in
+
+        output = np.zeros(total, np.float32)
+        start = 0
+        while start < n_tiles:
+            n = tile_batch if n_tiles - start >= tile_batch else 1
+            batch = tiles[start:start + n]
+            with torch.no_grad():
+                denoised = (self.model if n == tile_batch else self.model_single)(
+                    torch.from_numpy(np.ascontiguousarray(batch)).to(self.device))[4].cpu().numpy()
+            for i in range(n):
+                k = start + i
+                tile = denoised[i]
+                if k > 0: tile[:tile_overlap] *= fade_in
+                if k < n_tiles - 1: tile[-tile_overlap:] *= fade_out
+                output[k * hop:k * hop + tile_samples] += tile
+            start += n
+        return output[:nsamples] * scale
+
+
+def get_denoiser(device, nsamples, overlap=window // 2, batch_size=1):
+    """
+    設定に合うDenoiserを返す。同じ設定のDenoiserが使用中ならそれを共有し、再トレースしない
+    （モデル一式のリロードでノイズ除去の設定が変わらなければ、新旧のモデル一式で同じものを使う）
+    """
+    key = (str(device), nsamples, overlap, batch_size)
+    with _instances_lock:
+        denoiser = _instances.get(key)
+        if denoiser is None:
+            denoiser = _instances[key] = Denoiser(device, nsamples, overlap, batch_size)
+        return denoiser
+
+
+def initialize_frcrn(device, nsamples, overlap=window // 2, batch_size=1):
+    """denoise()で使うDenoiserを作る（モデル一式ごとにDenoiserを持つ場合はget_denoiserを使う）"""
+    global _default
+    _default = get_denoiser(device, nsamples, overlap, batch_size)
+    return _default
 
 
 def denoise(wave):
-    scale = np.amax(wave)
-    wave = audio_norm(wave)
-    scale /= np.amax(wave)
-    nsamples = len(wave)
-    wave = padding(wave[None], nsamples)
-    wave = torch.from_numpy(wave).to(_device)
-    wave = model(wave)[4][0].cpu().numpy()
-    return wave[:nsamples] * scale
+    """initialize_frcrn()で作ったDenoiserでノイズ除去する"""
+    return _default(wave)
@@ -0,0 +1,207 @@
+# metrics.py
+# 処理時間のヒストグラム・カウンタを集計し、Prometheus形式のテキストで公開する
+# 要求ごとの各段の処理時間は、任意でJSONLファイルにも書き出せる
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+_trace_file = None
+_trace_lock = threading.Lock()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs: return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {} # ラベル -> [各バケットの件数, 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", le)])} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+def _get_or_create(cls, name, help_text, labelnames):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help_text, labelnames)
+        return metric
+
+
+def counter(name, help_text, labelnames=()):
+    return _get_or_create(Counter, name, help_text, labelnames)
+
+
+def histogram(name, help_text, labelnames=()):
+    return _get_or_create(Histogram, name, help_text, labelnames)
+
+
+def reset():
+    """全メトリクスの値を消去する（ウォームアップ中の計測を除くために使う）"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        with metric._lock:
+            metric._values.clear()
+
+
+def render():
+    """登録済みの全メトリクスをPrometheusのテキスト形式で返す"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# --- 要求ごとのトレース ---
+
+@contextmanager
+def tracing(trace):
+    """このスレッドで計測した処理時間を、trace（dict）にも記録する"""
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def suppressed():
+    """このスレッドで計測した処理時間を集計しない（サーバー稼働中のウォームアップ用）"""
+    previous = getattr(_local, 'suppressed', False)
+    _local.suppressed = True
+    try:
+        yield
+    finally:
+        _local.suppressed = previous
+
+
+def record(name, seconds, hist=None, **labels):
+    """処理時間をヒストグラムと、このスレッドのトレースに記録する"""
+    if getattr(_local, 'suppressed', False): return
+    if hist is not None: hist.observe(seconds, **labels)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None: trace[name] = trace.get(name, 0.0) + seconds
+
+
+_stage_seconds = histogram('zvrvc_stage_seconds', 'Time spent in each conversion stage.', ('stage',))
+
+# サーバー共通のメトリクス
+receive_seconds = histogram('zvrvc_receive_seconds', 'Time to receive one request from the client.')
+vad_seconds = histogram('zvrvc_vad_seconds', 'Time spent in voice activity detection.')
+queue_wait_seconds = histogram('zvrvc_queue_wait_seconds', 'Time a request waited for an inference worker.')
+inference_seconds = histogram('zvrvc_inference_seconds', 'Total conversion time of one request.')
+first_audio_seconds = histogram('zvrvc_first_audio_seconds', 'Time from the end of a request to the first byte of its response.')
+send_seconds = histogram('zvrvc_send_seconds', 'Time to send the converted audio to the client.')
+requests_total = counter('zvrvc_requests_total', 'Number of received requests.')
+skipped_total = counter('zvrvc_skipped_total', 'Number of requests skipped because no speech was detected.')
+errors_total = counter('zvrvc_errors_total', 'Number of requests that failed.')
+reloads_total = counter('zvrvc_reloads_total', 'Number of model reloads.', ('result',))
+
+
+@contextmanager
+def timer(stage):
+    """変換処理の1段の処理時間を計測する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, _stage_seconds, stage=stage)
+
+
+def enable_trace(path):
+    """要求ごとのトレースをJSONL形式でpathに追記するようにする"""
+    global _trace_file
+    _trace_file = open(path, 'a', buffering=1)
+
+
+def write_trace(trace):
+    if _trace_file is None: return
+    line = json.dumps(trace, ensure_ascii=False)
+    with _trace_lock:
+        _trace_file.write(line + '\n')
+
+
+# --- HTTPエンドポイント ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    """http://host:port/metrics でメトリクスを公開するスレッドを起動する"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    print(f"メトリクスを http://{host}:{port}/metrics で公開しています。")
+    return server
@@ -0,0 +1,111 @@
+# precision.py
+# 生成器・JDC・HiFi-GANの推論精度（fp32 / bf16 autocast / int8の動的・静的量子化）を切り替える
+#
+# config.jsonの "inference_precision" に、全モデル共通の文字列か、モデルごとのdictで指定する
+#   "inference_precision": "bf16"
+#   "inference_precision": {"generator": "int8_static", "f0": "fp32", "vocoder": "bf16"}
+
+import torch
+
+MODES = ('fp32', 'bf16', 'int8_dynamic', 'int8_static')
+NAMES = ('f0', 'generator', 'vocoder')
+
+
+def parse(setting):
+    """
+    inference_precisionの設定を、モデル名 -> 精度のdictにする
+
+    Args:
+        setting (str | dict): 全モデル共通の精度か、'f0'・'generator'・'vocoder' -> 精度（省略したモデルはfp32）
+    """
+    if setting is None: setting = 'fp32'
+    if isinstance(setting, str):
+        modes = {name: setting for name in NAMES}
+    else:
+        unknown = set(setting) - set(NAMES)
+        if unknown:
+            raise ValueError(f"inference_precisionのモデル名 {sorted(unknown)} は未対応です。({', '.join(NAMES)} のいずれか)")
+        modes = {name: setting.get(name, 'fp32') for name in NAMES}
+    for name, mode in modes.items():
+        if mode not in MODES:
+            raise ValueError(f"{name}の精度 '{mode}' は未対応です。({', '.join(MODES)} のいずれか)")
+    return modes
+
+
+def describe(modes):
+    return ', '.join(f'{name}={modes[name]}' for name in NAMES)
+
+
+class Autocast:
+    """モデルをbf16のautocastで実行し、出力をfp32に戻す"""
+
+    def __init__(self, fn, device_type):
+        self.fn = fn
+        self.device_type = device_type
+
+    def __call__(self, *args):
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16):
+            out = self.fn(*args)
+        return out.float()
+
+
+def quantize_dynamic(module):
+    """
+    Linear・LSTM・GRUの重みをint8に量子化する（活性化は実行時に量子化する）
+    畳み込み層は対象外のため、畳み込みが主体の生成器・ボコーダーでは効果が小さい
+    """
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}, dtype=torch.qint8)
+
+
+def quantize_static(module, calibration_inputs, backend='x86'):
+    """
+    FXグラフモードで重みと活性化をint8に量子化する。活性化の範囲はcalibration_inputsで推定する
+
+    Args:
+        calibration_inputs (list): moduleに渡す引数のタプルのリスト（先頭をトレースの入力例にも使う）
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(module.eval(), get_default_qconfig_mapping(backend), calibration_inputs[0])
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            prepared(*inputs)
+    return convert_fx(prepared)
+
+
+def apply(modes, modules, device, calibration_inputs=None, static_models=None):
+    """
+    精度の設定に従ってモデルを変換する
+
+    Args:
+        modes (dict): parse()の結果
+        modules (dict): モデル名 -> fp32のモジュール（converterの呼び出し方に合わせた引数を取るもの）
+        calibration_inputs (callable): モデル名を受け取り、静的量子化のキャリブレーション入力のリストを返す関数
+        static_models (dict): 別のプロセスで静的量子化済みのモデル名 -> モジュール。指定すると、int8_staticのモデルは
+                              キャリブレーションせずにこれを使い、含まれないモデルはfp32で実行する（ワーカープロセス用）
+    Returns:
+        dict: fp32以外を指定したモデル名 -> 実行する関数。変換できなかったモデルは含めない（fp32で実行する）
+    """
+    converted = {}
+    for name in NAMES:
+        mode = modes[name]
+        if mode == 'fp32': continue
+        if mode.startswith('int8') and device.type != 'cpu':
+            print(f"{name}: int8量子化はCPUでのみ使えるため、fp32で実行します。")
+            continue
+        if mode == 'int8_static' and static_models is not None:
+            if name in static_models: converted[name] = static_models[name]
+            continue
+        try:
+            if mode == 'bf16':
+                converted[name] = Autocast(modules[name], device.type)
+            elif mode == 'int8_dynamic':
+                converted[name] = quantize_dynamic(modules[name])
+            else:
+                converted[name] = quantize_static(modules[name], calibration_inputs(name))
+            print(f"{name}: {mode}で実行します。")
+        except Exception as e:
+            print(f"{name}を{mode}に変換できなかったため、fp32で実行します: {e}")
+    return converted
@@ -0,0 +1,89 @@
+# protocol.py
+# 発話単位の変換サーバーとクライアントの通信プロトコル
+#
+# v1: 1接続につき1発話。[長さ >I][int16音声] を送り、[長さ >I][int16音声] を受け取る（長さ0は再生不要）
+# v2: 接続を維持したまま、要求IDを付けた複数の発話を並行して送れる
+#     接続直後にクライアントが MAGIC + [長さ >I][JSON] を送り、サーバーも [長さ >I][JSON] で応答する
+#     以降は要求・応答ともに [要求ID >I][フラグ B][長さ >I][データ] のフレームでやり取りする
+#     応答は要求の順に届くとは限らない。FLAG_ENDの付いたフレームでその要求への応答が完了する
+#     ハンドシェイクで targets（目標話者キーのリスト）を指定すると、各要求への応答は話者ごとに1フレームずつ
+#     targetsの順に届く（最後の話者のフレームにFLAG_ENDが付く。発話が検出されなかった場合は長さ0のフレーム1つ）
+
+import json
+import struct
+
+MAGIC = b'ZVC2' # v1の長さとして読むと約1.5GBになるため、v1の要求と区別できる
+VERSION = 2
+FLAG_END = 1   # この要求への最後のフレーム
+FLAG_ERROR = 2 # 変換に失敗した（データはUTF-8のエラーメッセージ）
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>IBI') # 要求ID, フラグ, データ長
+MAX_HANDSHAKE_BYTES = 64 * 1024
+
+
+def recv_into_exact(conn, view):
+    """viewが埋まるまで直接受信する。途中で切断された場合はFalseを返す"""
+    while len(view):
+        n = conn.recv_into(view)
+        if n == 0: return False
+        view = view[n:]
+    return True
+
+
+def recv_exact(conn, size):
+    """
+    sizeバイトを、あらかじめ確保したバッファに直接受信する
+    受信済みのデータを連結し直さないため、長い発話でもコピーは1回で済む
+
+    Returns:
+        bytearray: 受信したデータ。途中で切断された場合はNone
+    """
+    buf = bytearray(size)
+    if not recv_into_exact(conn, memoryview(buf)): return None
+    return buf
+
+
+def send_json(conn, obj):
+    data = json.dumps(obj, ensure_ascii=False).encode()
+    conn.sendall(LENGTH.pack(len(data)) + data)
+
+
+def recv_json(conn):
+    head = recv_exact(conn, LENGTH.size)
+    if head is None: return None
+    size = LENGTH.unpack(head)[0]
+    if size > MAX_HANDSHAKE_BYTES:
+        raise ValueError(f"ハンドシェイクが大きすぎます。({size}バイト)")
+    data = recv_exact(conn, size)
+    if data is None: return None
+    return json.loads(data.decode())
+
+
+def send_frame(conn, request_id, payload, flags=0):
+    conn.sendall(HEADER.pack(request_id, flags, len(payload)))
+    if payload: conn.sendall(payload)
+
+
+def recv_frame(conn):
+    """
+    Returns:
+        tuple: (要求ID, フラグ, データ)。接続が閉じられた場合はNone
+    """
+    head = recv_exact(conn, HEADER.size)
+    if head is None: return None
+    request_id, flags, size = HEADER.unpack(head)
+    payload = recv_exact(conn, size)
+    if payload is None: return None
+    return request_id, flags, payload
+
+
+def client_handshake(conn, options=None):
+    """v2のハンドシェイクを行い、サーバーの応答（dict）を返す"""
+    conn.sendall(MAGIC)
+    send_json(conn, dict(options or {}, version=VERSION))
+    reply = recv_json(conn)
+    if reply is None:
+        raise ConnectionError("ハンドシェイク中にサーバーが接続を閉じました。")
+    if 'error' in reply:
+        raise ValueError(f"サーバーがハンドシェイクを拒否しました: {reply['error']}")
+    return reply
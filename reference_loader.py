@@ -0,0 +1,82 @@
+# reference_loader.py
+# 参照音声のデコード・トリム・リサンプリングを複数スレッドで並列に行う
+# bulk_convert.pyのワーカープロセスでも読み込まれるため、torchやモデル関連のモジュールはインポートしない
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import librosa
+import numpy as np
+
+MAX_DEFAULT_WORKERS = 8 # 参照音声を読み込むスレッド数の既定の上限
+
+
+def load_reference_wave(path, sr, min_len):
+    """参照音声を1ファイル読み込み、前後の無音をトリムして最小長までパディングする"""
+    wave, _ = librosa.load(path, sr=sr, res_type='soxr_vhq')
+    wave, _ = librosa.effects.trim(wave, top_db=30)
+    if len(wave) < min_len: wave = np.pad(wave, (0, min_len - len(wave)))
+    return wave.astype(np.float32)
+
+
+def load_wave(path, sr):
+    """音声ファイルを1つ、トリムやパディングをせずにsrで読み込む"""
+    wave, _ = librosa.load(path, sr=sr, res_type='soxr_vhq')
+    return wave.astype(np.float32)
+
+
+def load_wave_batch(paths, sr):
+    """複数の音声ファイルをload_waveで読み込む。読めなかったファイルはNoneにする"""
+    waves = []
+    for path in paths:
+        try:
+            waves.append(load_wave(path, sr))
+        except Exception as e:
+            print(f"'{path}' を読み込めませんでした: {e}")
+            waves.append(None)
+    return waves
+
+
+def audio_duration(path):
+    """音声ファイルの長さ（秒）。ヘッダーだけを読むため、デコードはしない。読めなければNoneを返す"""
+    try:
+        return librosa.get_duration(path=path)
+    except Exception as e:
+        print(f"'{path}' の長さを取得できませんでした: {e}")
+        return None
+
+
+def load_reference_waves(paths, sr, min_len, workers=None):
+    """
+    参照音声をスレッドプールで並列に読み込む。返り値の順序はpathsと同じ
+    デコード（soundfile）とリサンプリング（soxr）はGILを解放するため、スレッドでも並列に実行される。
+    プロセスプールと違い、子プロセスがサーバーのモジュール（torchやモデル）を読み込み直すことはない
+
+    Args:
+        workers (int): スレッド数。Noneなら論理コア数（上限MAX_DEFAULT_WORKERS）、1ならプールを使わない
+    """
+    if workers == 1 or len(paths) < 2:
+        return [load_reference_wave(p, sr, min_len) for p in paths]
+    workers = workers or min(MAX_DEFAULT_WORKERS, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return list(executor.map(partial(load_reference_wave, sr=sr, min_len=min_len), paths))
+
+
+def length_buckets(lengths, max_batch, max_spread):
+    """
+    長さの近いもの同士をまとめたバッチ（インデックスのリスト）に分ける
+
+    Args:
+        lengths (list): 各要素の長さ
+        max_batch (int): 1バッチの最大要素数
+        max_spread (int): 1バッチ内の最長と最短の差の上限（パディング量の上限）
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    buckets, current = [], []
+    for i in order:
+        if current and (len(current) >= max_batch or lengths[i] - lengths[current[0]] > max_spread):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current: buckets.append(current)
+    return buckets
@@ -0,0 +1,117 @@
+# resample_plan.py
+# 変換処理のリサンプリング経路（どのレート間を、どの品質で変換するか）を組み立てる
+
+import argparse
+import json
+import time
+import numpy as np
+import soxr
+from munch import Munch
+
+# 品質を個別に設定できるリサンプリングの段
+#   input:       クライアントのレート -> モデル（またはFRCRN）のレート
+#   denoise_in:  モデルのレート -> FRCRNのレート（legacy経路のみ）
+#   denoise_out: FRCRNのレート -> モデルのレート
+#   output:      モデルのレート -> クライアントのレート
+STAGES = ('input', 'denoise_in', 'denoise_out', 'output')
+DEFAULT_QUALITY = 'VHQ'
+PLAN_MODES = ('direct', 'legacy')
+
+
+def make_plan(client_rate, model_rate, denoise_rate, use_denoiser, qualities=None, mode='direct', output_rate=None):
+    """
+    リサンプリング経路を作る
+
+    direct: ノイズ除去が有効なら、クライアントの音声から直接FRCRNのレートへ変換する
+            (48k -> 16k -> FRCRN -> 24k -> 48k)
+    legacy: 従来どおり一度モデルのレートを経由する
+            (48k -> 24k -> 16k -> FRCRN -> 24k -> 48k)
+    入出力のレートが同じ段は省略する。
+    output_rateを指定すると、出力はclient_rateではなくそのレートに変換する。
+
+    Returns:
+        Munch(front=[...], back=[...]): 各要素は ('resample', src, dst, quality, stage) または ('denoise',)
+    """
+    if mode not in PLAN_MODES:
+        raise ValueError(f"リサンプリング経路 '{mode}' は未対応です。({', '.join(PLAN_MODES)} のいずれか)")
+    quality = {stage: DEFAULT_QUALITY for stage in STAGES}
+    quality.update(qualities or {})
+
+    def step(src, dst, stage):
+        return [('resample', src, dst, quality[stage], stage)] if src != dst else []
+
+    if not use_denoiser:
+        front = step(client_rate, model_rate, 'input')
+    elif mode == 'direct':
+        front = step(client_rate, denoise_rate, 'input') + [('denoise',)] + step(denoise_rate, model_rate, 'denoise_out')
+    else:
+        front = (step(client_rate, model_rate, 'input') + step(model_rate, denoise_rate, 'denoise_in')
+                 + [('denoise',)] + step(denoise_rate, model_rate, 'denoise_out'))
+    back = step(model_rate, output_rate or client_rate, 'output')
+    return Munch(front=front, back=back)
+
+
+def run_steps(wave, steps, denoise_fn=None):
+    """経路の各段を順に適用する"""
+    for s in steps:
+        if s[0] == 'denoise':
+            if denoise_fn is not None: wave = denoise_fn(wave)
+        else:
+            _, src, dst, quality, _ = s
+            wave = soxr.resample(wave, src, dst, quality)
+    return wave
+
+
+def describe(plan):
+    """経路を 48000->16000(HQ) -> denoise -> ... の形の文字列にする"""
+    parts = []
+    for s in plan.front + plan.back:
+        parts.append('denoise' if s[0] == 'denoise' else f'{s[1]}->{s[2]}({s[3]})')
+    return ' -> '.join(parts)
+
+
+def benchmark(client_rate=48000, model_rate=24000, denoise_rate=16000, seconds=5.0, repeat=20, presets=None):
+    """
+    各経路と品質の組み合わせについて、リサンプリングだけにかかる時間と往復後の音質(SNR)を測る
+    ノイズ除去の段は恒等変換として扱うため、FRCRNのモデルは不要
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(client_rate * seconds)) / client_rate
+    # 音声帯域に収まる正弦波の和に少量の雑音を加えた合成信号
+    wave = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((140, 440, 1250, 3100, 6800)))
+    wave = (0.2 * wave / np.max(np.abs(wave)) + 0.001 * rng.standard_normal(len(t))).astype(np.float32)
+
+    presets = presets or {
+        'VHQ': {stage: 'VHQ' for stage in STAGES},
+        'HQ': {stage: 'HQ' for stage in STAGES},
+        'HQ-inner': {'input': 'VHQ', 'denoise_in': 'HQ', 'denoise_out': 'HQ', 'output': 'VHQ'},
+        'MQ': {stage: 'MQ' for stage in STAGES},
+    }
+    results = []
+    for mode in PLAN_MODES:
+        for name, qualities in presets.items():
+            plan = make_plan(client_rate, model_rate, denoise_rate, True, qualities, mode)
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                out = run_steps(run_steps(wave, plan.front), plan.back)
+                timings.append(time.perf_counter() - start)
+            # FRCRNのレートの帯域外は往復で失われるため、比較はその帯域に制限した信号と行う
+            reference = soxr.resample(soxr.resample(wave, client_rate, denoise_rate, 'VHQ'), denoise_rate, client_rate, 'VHQ')
+            n = min(len(out), len(reference))
+            snr = 10 * np.log10(np.sum(reference[:n] ** 2) / max(np.sum((reference[:n] - out[:n]) ** 2), 1e-20))
+            results.append({
+                'mode': mode, 'quality': name, 'plan': describe(plan),
+                'conversions': sum(1 for s in plan.front + plan.back if s[0] == 'resample'),
+                'mean_ms': 1000 * float(np.mean(timings)), 'p95_ms': 1000 * float(np.percentile(timings, 95)),
+                'rtf': float(np.mean(timings)) / seconds, 'snr_db': float(snr),
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="リサンプリング経路のベンチマーク")
+    parser.add_argument('--seconds', type=float, default=5.0, help='合成する発話の長さ（秒）')
+    parser.add_argument('--repeat', type=int, default=20, help='各経路の計測回数')
+    args = parser.parse_args()
+    print(json.dumps(benchmark(seconds=args.seconds, repeat=args.repeat), indent=2, ensure_ascii=False))
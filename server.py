@@ -7,6 +7,7 @@ import time
 
 # FreeVCディレクトリ内のconvert_rtモジュールを、「convert_rt」という名前でインポートする
 import FreeVC.convert_rt as convert_rt
+import metrics
 
 # --- ネットワーク設定 ---
 HOST = '0.0.0.0'  # 利用可能な全てのネットワークインターフェースで待機
@@ -40,7 +41,9 @@ def handle_client_connection(conn, addr):
 
             while True:
                 try:
+                    receive_start = time.perf_counter()
                     data = conn.recv(CHUNK) 
+                    metrics.record('receive', time.perf_counter() - receive_start, metrics.receive_seconds)
                     if not data:
                         print("クライアントが接続を正常に閉じました。ループを抜けます。")
                         break 
@@ -52,18 +55,27 @@ def handle_client_connection(conn, addr):
                     while len(data_buffer) >= CHUNK:
                         process_chunk = data_buffer[:CHUNK]
                         data_buffer = data_buffer[CHUNK:]
+                        metrics.requests_total.inc()
+                        trace = {'time': time.time(), 'client': f'{addr[0]}:{addr[1]}'}
                         
                         # --- 無音検出(VAD)処理 ---
+                        vad_start = time.perf_counter()
                         input_wave_for_vad = np.frombuffer(process_chunk, dtype=np.int16)
                         rms = np.sqrt(np.mean(np.square(input_wave_for_vad.astype(np.float64))))
+                        trace['vad'] = time.perf_counter() - vad_start
+                        metrics.vad_seconds.observe(trace['vad'])
 
                         if rms < VAD_THRESHOLD:
                             # 無音と判断した場合、AIモデルをバイパスして無音データをそのまま返す
                             processed_bytes = process_chunk 
+                            metrics.skipped_total.inc()
                         else:
                             # --- FreeVC声質変換処理 ---
                             # ノイズ除去を行わず、直接変換する
-                            processed_bytes = convert_rt.convert_voice(process_chunk)
+                            with metrics.tracing(trace):
+                                inference_start = time.perf_counter()
+                                processed_bytes = convert_rt.convert_voice(process_chunk)
+                                metrics.record('inference', time.perf_counter() - inference_start, metrics.inference_seconds)
                         
                         current_wave = np.frombuffer(processed_bytes, dtype=np.int16).astype(np.float32)
 
@@ -77,7 +89,12 @@ def handle_client_connection(conn, addr):
                         ))
                         
                         output_bytes = output_wave.astype(np.int16).tobytes()
+                        send_start = time.perf_counter()
                         conn.sendall(output_bytes)
+                        trace['send'] = time.perf_counter() - send_start
+                        metrics.send_seconds.observe(trace['send'])
+                        trace['skipped'] = rms < VAD_THRESHOLD
+                        metrics.write_trace(trace)
 
                         previous_processed_wave = current_wave
                 
@@ -129,8 +146,13 @@ if __name__ == "__main__":
     parser.add_argument("--hpfile", type=str, default="FreeVC/configs/freevc-s.json", help="JSON設定ファイルへのパス")
     parser.add_argument("--ptfile", type=str, default="FreeVC/checkpoints/G_190000.pth", help="モデルチェックポイントファイルへのパス")
     parser.add_argument("--tgtwav", type=str, default="FreeVC/inputs/zundamon/recitation001.wav", help="目標話者のWAVファイルへのパス")
+    parser.add_argument("--metrics-port", type=int, help="指定したポートの /metrics で処理時間のメトリクスを公開します。")
+    parser.add_argument("--trace", type=str, help="チャンクごとの処理時間をJSONL形式で追記するファイル")
     args = parser.parse_args()
 
+    if args.metrics_port: metrics.serve(args.metrics_port)
+    if args.trace: metrics.enable_trace(args.trace)
+
     print("声質変換モデルを初期化しています...")
     try:
         convert_rt.load_models(args.hpfile, args.ptfile, args.tgtwav)
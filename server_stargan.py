@@ -1,102 +1,594 @@
 # server.py
 
+import gc
 import socket
+import signal
 import argparse
-import numpy as np
 import torch
-import struct
 import json
 import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from munch import Munch
 
 # 手順1で作成した変換エンジンをインポート
+import const
 import converter
+import metrics
+import protocol
+import audio_codec
+from batching import BatchScheduler
+from worker_pool import WorkerPool
+from warmup import UtteranceHistogram, warm_up
 
-# VAD（発話検出）関連
-try:
-    vad_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad', force_reload=False)
-    (get_speech_timestamps, _, _, _, _) = utils
-    VAD_ENABLED = True
-    print("Silero VADモデルの読み込みに成功しました。")
-    import torchaudio
-except Exception as e:
-    VAD_ENABLED = False
-    print(f"警告: Silero VADモデルの読み込みに失敗しました。: {e}")
+# VAD（発話検出）関連。start_server()で読み込む
+# （推論ワーカープロセスはspawnでこのモジュールを読み込み直すため、モジュールの読み込み時には読み込まない）
+vad_model = None
+get_speech_timestamps = None
+torchaudio = None
+VAD_ENABLED = False
+# Silero VADは呼び出しごとに内部状態をリセットしてチャンクを順に処理するため、複数の推論ワーカースレッドから
+# 同時に呼ぶと互いの状態を壊す。1回の検出は数ミリ秒で終わるため、ロックで1つずつ実行する
+_vad_lock = threading.Lock()
 
 # --- グローバル変数 ---
 HOST = '0.0.0.0'
 PORT = 8080
 config = None
+config_path = None # リロード時に読み直す設定ファイル
+job_queue = None # 推論待ちのジョブ（上限付き）。推論ワーカースレッドが順に取り出す
+serving = None # 変換に使うモデル一式（converter・scheduler・worker_pool）。リロード時に丸ごと入れ替える
+histogram = None # 受信した発話長の分布（ウォームアップする長さの決定に使う）
+_serving_cond = threading.Condition() # servingの入れ替えと、一式ごとの処理中の要求数を保護する
+_reload_lock = threading.Lock()
+_n_inference_threads = 0
+
+_vad_resamplers = {} # 入力のサンプリングレート -> 16kHzへのResample（カーネルの再計算を避けるため使い回す）
+
+def load_vad():
+    """Silero VADを読み込む。失敗した場合はVADを無効にして全体を変換する"""
+    global vad_model, get_speech_timestamps, VAD_ENABLED, torchaudio
+    try:
+        vad_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad', force_reload=False)
+        (get_speech_timestamps, _, _, _, _) = utils
+        import torchaudio
+        VAD_ENABLED = True
+        print("Silero VADモデルの読み込みに成功しました。")
+    except Exception as e:
+        VAD_ENABLED = False
+        print(f"警告: Silero VADモデルの読み込みに失敗しました。: {e}")
+
+def _vad_resampler(sample_rate):
+    resampler = _vad_resamplers.get(sample_rate)
+    if resampler is None:
+        resampler = _vad_resamplers[sample_rate] = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)
+    return resampler
+
+def detect_speech(input_data, fmt):
+    """
+    VADで発話区間を検出する
+
+    Returns:
+        list: 入力のサンプリングレートでの発話区間 [(開始, 終了), ...]。発話が無ければ空のリスト
+              VADが無効な場合やエラー時は、全体を変換するためNoneを返す
+    """
+    if not VAD_ENABLED:
+        # VADが無効な場合は常に変換
+        return None
+    start = time.perf_counter()
+    try:
+        # クライアントの形式の音声データをTensorに変換
+        input_wave_tensor = torch.from_numpy(audio_codec.decode(input_data, fmt.encoding))
+
+        # VADモデルが要求する16kHzにリサンプリング
+        resampled_tensor = input_wave_tensor
+        if fmt.sample_rate != 16000:
+            with torch.no_grad():
+                resampled_tensor = _vad_resampler(fmt.sample_rate)(input_wave_tensor)
+
+        # 発話区間を検出
+        with _vad_lock:
+            speech_timestamps = get_speech_timestamps(resampled_tensor, vad_model, sampling_rate=16000)
+
+        if speech_timestamps:
+            print(f"VAD: 発話を検出しました。({len(speech_timestamps)}区間)")
+            scale = fmt.sample_rate / 16000
+            return [(int(t['start'] * scale), int(t['end'] * scale)) for t in speech_timestamps]
+        print("VAD: 発話を検出できませんでした。変換をスキップします。")
+        return []
+    except Exception as e:
+        print(f"VAD処理中にエラーが発生しました: {e}")
+        return None # エラー時は安全のため全体を変換
+    finally:
+        metrics.record('vad', time.perf_counter() - start, metrics.vad_seconds)
+
+def speech_spans(timestamps, n_samples, sample_rate, cfg=None):
+    """
+    VADの発話区間の前後に余白を付け、間の短い区間同士をまとめる
+    まとめた区間が入力のほぼ全体を覆う場合は、区切っても変換量が減らないためNoneを返す
+    cfgは要求を処理するモデル一式の設定（省略時は現在の設定）
+    """
+    cfg = cfg or config
+    padding = int(cfg.get('vad_span_padding_ms', 100) * sample_rate / 1000)
+    min_gap = int(cfg.get('vad_min_gap_ms', 300) * sample_rate / 1000)
+    spans = []
+    for start, end in timestamps:
+        start, end = max(0, start - padding), min(n_samples, end + padding)
+        if spans and start - spans[-1][1] < min_gap:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    covered = sum(end - start for start, end in spans)
+    if covered > cfg.get('vad_span_max_coverage', 0.8) * n_samples:
+        return None
+    return spans
+
+def process_utterance(input_data, fmt=audio_codec.DEFAULT_FORMAT, emit=None, targets=None):
+    """
+    1発話分の音声を変換する。発話が検出されなければ空のバイト列を返す
+    発話区間が録音の一部だけの場合は、その区間だけを変換して元の長さでつなぎ直す
+    emitを渡すと、変換できたチャンクから順にemitに渡し、Noneを返す（発話区間だけを変換する場合は一括で返す）
+    targets（話者キーのリスト）を渡すと、全ての話者に変換した結果をその順のリストで返す
+    """
+    timestamps = detect_speech(input_data, fmt)
+    if timestamps == []:
+        metrics.skipped_total.inc()
+        return b''
+    # 変換中にリロードされても、この要求は受け付けた時点のモデル一式で最後まで処理する
+    with _use_serving() as s:
+        return _convert(s, input_data, fmt, emit, targets, timestamps)
+
+def _convert(s, input_data, fmt, emit, targets, timestamps):
+    vc, worker_pool, scheduler = s.converter, s.worker_pool, s.scheduler
+    if targets:
+        # 共通の前処理を1回で済ませるため、区間の切り出しは行わずに全体を変換する
+        if worker_pool is not None:
+            return worker_pool.convert_voice_multi(input_data, targets, fmt)
+        return vc.convert_voice_multi(input_data, targets, fmt)
+    speaker_key = s.config['target_speaker_key']
+    spans = None
+    # ストリーミング応答でも、区間だけを変換できる場合はそちらを優先し、結果を一括で返す
+    if timestamps is not None and s.config.get('vad_spans', True):
+        n_samples = int(round(audio_codec.duration(input_data, fmt.encoding, fmt.sample_rate) * fmt.sample_rate))
+        spans = speech_spans(timestamps, n_samples, fmt.sample_rate, s.config)
+    if spans is not None:
+        # 区間同士は発話の中でバッチにまとめるため、バッチスケジューラは通さない
+        print(f"発話区間のみを変換します。({len(spans)}区間, {sum(end - start for start, end in spans) / fmt.sample_rate:.2f}秒"
+              f" / {n_samples / fmt.sample_rate:.2f}秒)")
+        if worker_pool is not None:
+            return worker_pool.convert_voice_spans(input_data, speaker_key, spans, fmt)
+        return vc.convert_voice_spans(input_data, speaker_key, spans, fmt)
+    if worker_pool is not None:
+        return worker_pool.convert_voice(input_data, speaker_key, fmt)
+    if scheduler is not None:
+        return scheduler.convert_voice(input_data, speaker_key, fmt)
+    if emit is not None:
+        for chunk in vc.convert_voice_stream(input_data, speaker_key, fmt):
+            emit(chunk)
+        return None
+    return vc.convert_voice(input_data, speaker_key, fmt)
+
+@contextmanager
+def _use_serving():
+    """現在のモデル一式を取り出し、使い終わるまで処理中の要求として数える"""
+    with _serving_cond:
+        s = serving
+        s.active += 1
+    try:
+        yield s
+    finally:
+        with _serving_cond:
+            s.active -= 1
+            if s.active == 0: _serving_cond.notify_all()
+
+def submit(input_data, trace=None, fmt=audio_codec.DEFAULT_FORMAT, emit=None, targets=None):
+    """
+    推論ジョブをキューに入れ、(変換結果, キュー待ち時間, 推論時間) を受け取るFutureを返す
+    キューが満杯の場合は空きができるまで待つ（待つのはこの接続のスレッドだけ）
+    traceを渡すと、推論中に計測した各段の処理時間がそこに記録される
+    """
+    future = Future()
+    job_queue.put((future, input_data, time.perf_counter(), trace, fmt, emit, targets))
+    return future
+
+def inference_worker():
+    """キューからジョブを取り出して推論する（推論ワーカースレッド）"""
+    while True:
+        future, input_data, enqueued_at, trace, fmt, emit, targets = job_queue.get()
+        started_at = time.perf_counter()
+        with metrics.tracing(trace):
+            metrics.record('queue_wait', started_at - enqueued_at, metrics.queue_wait_seconds)
+            try:
+                result = process_utterance(input_data, fmt, emit, targets)
+            except Exception as e:
+                metrics.errors_total.inc()
+                future.set_exception(e)
+                continue
+            inference_time = time.perf_counter() - started_at
+            metrics.record('inference', inference_time, metrics.inference_seconds)
+        future.set_result((result, started_at - enqueued_at, inference_time))
+
+def _start_request(input_data, addr, receive_start, request_id=None, fmt=audio_codec.DEFAULT_FORMAT, emit=None, targets=None):
+    """受信した1発話を記録して推論キューに投入し、(Future, trace) を返す"""
+    metrics.requests_total.inc()
+    seconds = audio_codec.duration(input_data, fmt.encoding, fmt.sample_rate)
+    trace = {'time': time.time(), 'client': f'{addr[0]}:{addr[1]}', 'seconds': seconds}
+    if request_id is not None: trace['request_id'] = request_id
+    if targets: trace['targets'] = len(targets)
+    with metrics.tracing(trace):
+        metrics.record('receive', time.perf_counter() - receive_start, metrics.receive_seconds)
+    histogram.record(trace['seconds'])
+    return submit(input_data, trace, fmt, emit, targets), trace
+
+def _finish_request(trace, skipped, send_start):
+    with metrics.tracing(trace):
+        metrics.record('send', time.perf_counter() - send_start, metrics.send_seconds)
+    trace['skipped'] = skipped
+    metrics.write_trace(trace)
+
+def _receive_payload(conn, size, fmt=audio_codec.DEFAULT_FORMAT):
+    """長さヘッダーの分だけ確保したバッファに発話を受信する。上限を超える長さは受け付けない"""
+    # FLACは圧縮前の大きさを超えないものとして、PCM16と同じ上限を使う
+    max_bytes = int(config.get('max_request_seconds', 60.0) * fmt.sample_rate) * 2
+    if size > max_bytes:
+        raise ValueError(f"発話が長すぎます。({size}バイト, 上限{max_bytes}バイト)")
+    return protocol.recv_exact(conn, size)
+
+def _serve_v1(conn, addr, input_len):
+    """v1: 1発話を受信し、変換結果を返して接続を終える"""
+    receive_start = time.perf_counter()
+    input_data = _receive_payload(conn, input_len)
+    if input_data is None:
+        print(f"クライアント {addr} が受信途中で切断しました。")
+        return
+
+    print(f"音声受信完了。変換処理を開始します...")
+    future, trace = _start_request(input_data, addr, receive_start)
+
+    # 推論キューに投入した結果を待つ
+    processed_bytes, queue_wait, inference_time = future.result()
+    print(f"処理完了。(キュー待ち: {queue_wait * 1000:.1f}ms, 推論: {inference_time * 1000:.1f}ms)")
+
+    send_start = time.perf_counter()
+    if processed_bytes:
+        metrics.first_audio_seconds.observe(send_start - receive_start - trace['receive'])
+        print(f"クライアントに送信します... (サイズ: {len(processed_bytes)} バイト)")
+        conn.sendall(protocol.LENGTH.pack(len(processed_bytes)))
+        conn.sendall(processed_bytes)
+    else:
+        # 発話が検出されなかった場合は、データ長0を送信してスキップ
+        conn.sendall(protocol.LENGTH.pack(0))
+    _finish_request(trace, not processed_bytes, send_start)
+    print("送信完了。")
+
+def _send_responses(conn, responses, inflight):
+    """
+    v2: 応答フレームを送る（接続ごとの送信スレッド）
+    ストリーミング応答のチャンクは変換でき次第、各要求の最後のフレームは変換が終わった順に送る
+    """
+    broken = False
+    started = {} # 最初のフレームを送った要求ID -> 送り始めた時刻
+    while True:
+        item = responses.get()
+        if item is None: return
+        kind, request_id, data, trace, received_at = item
+        try:
+            if broken: continue
+            if kind == 'chunk':
+                if request_id not in started:
+                    started[request_id] = time.perf_counter()
+                    metrics.first_audio_seconds.observe(started[request_id] - received_at)
+                protocol.send_frame(conn, request_id, data)
+                continue
+
+            try:
+                processed_bytes, queue_wait, inference_time = data.result()
+            except Exception as e:
+                print(f"要求 {request_id} の変換中にエラーが発生しました: {e}")
+                protocol.send_frame(conn, request_id, str(e).encode(), protocol.FLAG_END | protocol.FLAG_ERROR)
+                continue
+            streamed = request_id in started
+            send_start = started.pop(request_id, time.perf_counter())
+            # 複数の話者への変換では、話者ごとに1フレームずつ送る
+            outputs = processed_bytes if isinstance(processed_bytes, list) else [processed_bytes or b'']
+            print(f"要求 {request_id} 処理完了。(キュー待ち: {queue_wait * 1000:.1f}ms, 推論: {inference_time * 1000:.1f}ms"
+                  + (", ストリーミング送信)" if streamed else f", サイズ: {sum(len(o) for o in outputs)} バイト)"))
+            if processed_bytes: metrics.first_audio_seconds.observe(send_start - received_at)
+            for output in outputs[:-1]:
+                protocol.send_frame(conn, request_id, output)
+            # 最後のフレーム。ストリーミング送信済みの場合と、発話が検出されなかった場合はデータ長0
+            protocol.send_frame(conn, request_id, outputs[-1], protocol.FLAG_END)
+            _finish_request(trace, processed_bytes == b'', send_start)
+        except OSError as e:
+            broken = True
+            print(f"クライアントへの送信に失敗しました: {e}")
+        finally:
+            if kind == 'done': inflight.release()
+
+def _negotiate_targets(targets):
+    """ハンドシェイクで要求された目標話者キーのリストを検証する。省略時はNone（config.jsonの話者に変換する）"""
+    if targets is None: return None
+    if not isinstance(targets, list) or not targets or not all(isinstance(k, str) for k in targets):
+        raise ValueError("targetsには目標話者キーのリストを指定してください。")
+    max_targets = config.get('max_targets', 8)
+    if len(targets) > max_targets:
+        raise ValueError(f"目標話者が多すぎます。({len(targets)}件, 上限{max_targets}件)")
+    unknown = [k for k in targets if not serving.converter.has_reference(k)]
+    if unknown:
+        raise ValueError(f"参照話者キー {unknown} が見つかりません。")
+    return targets
+
+def _serve_v2(conn, addr):
+    """v2: 接続を維持し、要求IDの付いた発話を並行して受け付ける"""
+    options = protocol.recv_json(conn)
+    if options is None: return
+    try:
+        fmt = audio_codec.negotiate(options)
+    except (TypeError, ValueError) as e:
+        protocol.send_json(conn, {'error': str(e)})
+        print(f"クライアント {addr} のハンドシェイクを拒否しました: {e}")
+        return
+    try:
+        targets = _negotiate_targets(options.get('targets'))
+    except (TypeError, ValueError) as e:
+        protocol.send_json(conn, {'error': str(e)})
+        print(f"クライアント {addr} のハンドシェイクを拒否しました: {e}")
+        return
+    max_inflight = config.get('max_inflight', 4)
+    # ストリーミング応答は推論ワーカースレッドで1話者に変換する場合のみ（マルチプロセス推論・バッチ推論では一括で返す）
+    stream = bool(options.get('stream', False)) and serving.worker_pool is None and serving.scheduler is None and not targets
+    reply = dict(fmt, version=protocol.VERSION, max_inflight=max_inflight, stream=stream)
+    if targets: reply['targets'] = targets
+    protocol.send_json(conn, reply)
+    print(f"プロトコルv2で接続を維持します。(同時要求数の上限: {max_inflight}, ストリーミング応答: {'有効' if stream else '無効'}, "
+          f"入力: {fmt.sample_rate}Hz {fmt.encoding}, 出力: {fmt.output_sample_rate}Hz {fmt.output_encoding}"
+          + (f", 目標話者: {', '.join(targets)})" if targets else ")"))
+
+    # 同時に受け付ける要求数を制限し、上限に達したら応答を送り終えるまで次の受信を待つ
+    inflight = threading.BoundedSemaphore(max_inflight)
+    responses = queue.Queue()
+    sender = threading.Thread(target=_send_responses, args=(conn, responses, inflight), daemon=True)
+    sender.start()
+    try:
+        while True:
+            # 要求の合間は長めに待ち、受信が始まったら通常のタイムアウトに戻す
+            conn.settimeout(config.get('idle_timeout', 600.0))
+            head = protocol.recv_exact(conn, protocol.HEADER.size)
+            if head is None: break
+            conn.settimeout(config.get('client_timeout', 30.0))
+            receive_start = time.perf_counter()
+            request_id, _, size = protocol.HEADER.unpack(head)
+            input_data = _receive_payload(conn, size, fmt)
+            if input_data is None: break
+
+            received_at = time.perf_counter()
+            inflight.acquire()
+            emit = None
+            if stream:
+                emit = lambda chunk, rid=request_id, t=received_at: responses.put(('chunk', rid, chunk, None, t))
+            try:
+                future, trace = _start_request(input_data, addr, receive_start, request_id, fmt, emit, targets)
+            except Exception:
+                inflight.release()
+                raise
+            future.add_done_callback(
+                lambda f, rid=request_id, tr=trace, t=received_at: responses.put(('done', rid, f, tr, t)))
+    finally:
+        # 受信済みの要求の応答を送り終えてから接続を閉じる
+        for _ in range(max_inflight):
+            inflight.acquire()
+        responses.put(None)
+        sender.join()
 
 def handle_client(conn, addr):
-    """クライアントを処理する"""
+    """クライアントを処理する（接続ごとのスレッドで実行される）"""
     print(f"\nクライアントが接続しました: {addr}")
     try:
         with conn:
-            # 1. データ受信
-            len_data = conn.recv(4)
-            if not len_data: return
-            input_len = struct.unpack('>I', len_data)[0]
-            input_data = b''
-            while len(input_data) < input_len:
-                packet = conn.recv(4096)
-                if not packet: break
-                input_data += packet
-            
-            print(f"音声受信完了。変換処理を開始します...")
-            
-            is_speech = False
-            if VAD_ENABLED:
-                try:
-                    # 48kHzの音声データをTensorに変換
-                    input_wave_tensor = torch.from_numpy(np.frombuffer(input_data, dtype=np.int16)).float() / 32768.0
-                    
-                    # VADモデルが要求する16kHzにリサンプリング
-                    resampler = torchaudio.transforms.Resample(orig_freq=48000, new_freq=16000)
-                    resampled_tensor = resampler(input_wave_tensor)
-
-                    # 発話区間を検出
-                    speech_timestamps = get_speech_timestamps(resampled_tensor, vad_model, sampling_rate=16000)
-                    
-                    if speech_timestamps:
-                        is_speech = True
-                        print(f"VAD: 発話を検出しました。")
-                    else:
-                        is_speech = False # 発話がなければFalse
-                        print("VAD: 発話を検出できませんでした。変換をスキップします。")
-
-                except Exception as e:
-                    print(f"VAD処理中にエラーが発生しました: {e}")
-                    is_speech = True # エラー時は安全のため変換を実行
-            else:
-                # VADが無効な場合は常に変換
-                is_speech = True
-
-            if is_speech:
-                processed_bytes = converter.convert_voice(input_data, config['target_speaker_key'])
-                print(f"処理完了。クライアントに送信します... (サイズ: {len(processed_bytes)} バイト)")
-                conn.sendall(struct.pack('>I', len(processed_bytes)))
-                conn.sendall(processed_bytes)
+            # 応答しないクライアントがスレッドを占有し続けないようにタイムアウトを設定
+            conn.settimeout(config.get('client_timeout', 30.0))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # 最初の4バイトで、v2のハンドシェイクかv1の長さヘッダーかを判別する
+            head = protocol.recv_exact(conn, 4)
+            if head is None: return
+            if head == protocol.MAGIC:
+                _serve_v2(conn, addr)
             else:
-                # 発話が検出されなかった場合は、データ長0を送信してスキップ
-                conn.sendall(struct.pack('>I', 0))
-            print("送信完了。")
+                _serve_v1(conn, addr, protocol.LENGTH.unpack(head)[0])
     except Exception as e:
         print(f"クライアント {addr} との通信中にエラーが発生しました: {e}")
     finally:
         print(f"クライアント {addr} との接続処理を終了します。")
 
+def _warm_up(cfg, vc):
+    """
+    converter（モジュール）をウォームアップする（記録済みの発話長の分布に合わせた長さで、処理時間が安定するまで）
+    ワーカープロセスを使う場合は、変換するのは各ワーカーのため、_build_servingで起動した各ワーカーが行う
+    """
+    if cfg.get('worker_processes', 0) > 0: return
+    warm_up(cfg, lambda data: vc.convert_voice(data, cfg['target_speaker_key']), histogram, compiled=vc._compiled is not None)
+
+def _build_serving(cfg, vc, generation=0):
+    """初期化・ウォームアップ済みのconverter（モジュール）から、変換に使うモデル一式を作る"""
+    worker_pool = scheduler = None
+    if cfg.get('worker_processes', 0) > 0:
+        print(f"推論ワーカープロセスを{cfg['worker_processes']}個起動しています...")
+        warmup = Munch(config=cfg, speaker_key=cfg['target_speaker_key'],
+                       lengths=histogram.top_lengths(cfg.get('warmup_max_buckets', 4)) or None)
+        worker_pool = WorkerPool(cfg['worker_processes'], cfg.get('worker_cores'), model_set=vc.export_model_set(),
+                                 job_timeout=cfg.get('worker_job_timeout', 120.0), warmup=warmup)
+    elif cfg.get('use_batching', False):
+        scheduler = BatchScheduler(
+            max_batch=cfg.get('batch_max_size', 4),
+            max_wait_ms=cfg.get('batch_max_wait_ms', 20),
+            bucket_seconds=cfg.get('batch_bucket_seconds', 0.25),
+            vc=vc
+        )
+        print(f"バッチ推論を有効にしました。(最大{scheduler.max_batch}件, 待ち時間上限{cfg.get('batch_max_wait_ms', 20)}ms)")
+    return Munch(converter=vc, worker_pool=worker_pool, scheduler=scheduler, config=cfg, generation=generation, active=0)
+
+def _start_inference_workers(s):
+    """モデル一式が同時に受け取れるジョブ数に合わせて、推論ワーカースレッドを（足りない分だけ）起動する"""
+    global _n_inference_threads
+    n_workers = s.config.get('inference_workers', 1)
+    if s.worker_pool is not None:
+        # 全てのワーカープロセスに同時にジョブを渡せるようにする
+        n_workers = max(n_workers, s.config['worker_processes'])
+    elif s.scheduler is not None:
+        # バッチを組めるよう、最大バッチサイズ以上のジョブを同時にスケジューラへ渡す
+        n_workers = max(n_workers, s.scheduler.max_batch)
+    for i in range(_n_inference_threads, n_workers):
+        threading.Thread(target=inference_worker, name=f'inference-{i}', daemon=True).start()
+    if n_workers > _n_inference_threads:
+        _n_inference_threads = n_workers
+        print(f"推論ワーカーを{n_workers}個起動しました。(キュー上限: {job_queue.maxsize})")
+
+def _release_serving(s):
+    """入れ替えた古いモデル一式のワーカー・スケジューラを止め、モデルを解放する"""
+    if s.worker_pool is not None: s.worker_pool.shutdown()
+    if s.scheduler is not None: s.scheduler.shutdown()
+    s.converter.release_models()
+    gc.collect()
+    if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+def _memory_mb():
+    """このプロセスの現在の使用メモリ（RSS、MB）と、GPUの確保済みメモリ（MB）。取得できなければNone"""
+    rss = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    gpu = torch.cuda.memory_allocated() / 1024 / 1024 if torch.cuda.is_available() else None
+    return {'rss_mb': rss, 'gpu_mb': gpu}
+
+def reload_models():
+    """
+    設定ファイルを読み直し、新しいモデル一式をバックグラウンドで読み込み・ウォームアップしてから入れ替える
+    入れ替え前に変換を始めた要求は古いモデル一式で最後まで処理し、それが終わってから古いモデル一式を解放する
+    読み込みに失敗した場合は、現在のモデル一式で処理を続ける
+
+    Returns:
+        dict: 結果と、読み込み前・新旧両方を保持している間・解放後の使用メモリ
+    """
+    global config, serving
+    if not _reload_lock.acquire(blocking=False):
+        return {'ok': False, 'error': 'リロード中です。'}
+    try:
+        start = time.perf_counter()
+        report = {'memory_before': _memory_mb()}
+        print(f"\n設定ファイル '{config_path}' を読み直し、新しいモデル一式を準備しています...")
+        try:
+            with open(config_path, 'r') as f:
+                new_config = json.load(f)
+            vc = converter.new_instance()
+            vc.initialize_models(new_config)
+            # ウォームアップ中の計測は、稼働中のメトリクスに含めない
+            with metrics.suppressed():
+                _warm_up(new_config, vc)
+            new_serving = _build_serving(new_config, vc, serving.generation + 1)
+        except Exception as e:
+            metrics.reloads_total.inc(result='error')
+            print(f"リロードに失敗しました。現在のモデル一式で処理を続けます: {e}")
+            return {'ok': False, 'error': str(e)}
+        report['memory_both'] = _memory_mb()
+
+        with _serving_cond:
+            old, serving = serving, new_serving
+            config = new_config
+        _start_inference_workers(new_serving)
+        print(f"モデル一式を入れ替えました。(世代 {old.generation} -> {new_serving.generation}, "
+              f"古いモデル一式で処理中の要求: {old.active}件)")
+
+        with _serving_cond:
+            drained = _serving_cond.wait_for(lambda: old.active == 0, timeout=new_config.get('reload_drain_timeout', 300.0))
+        if drained:
+            _release_serving(old)
+        else:
+            print(f"警告: 古いモデル一式で処理中の要求が残っているため、解放せずに残します。({old.active}件)")
+        report['memory_after'] = _memory_mb()
+        report.update(ok=True, generation=new_serving.generation, released=drained, seconds=time.perf_counter() - start)
+        metrics.reloads_total.inc(result='ok')
+        before, both, after = (report[k]['rss_mb'] for k in ('memory_before', 'memory_both', 'memory_after'))
+        if before is not None:
+            print(f"リロード完了。({report['seconds']:.1f}秒, RSS: 読み込み前 {before:.0f}MB / "
+                  f"入れ替え時 {both:.0f}MB / 解放後 {after:.0f}MB)")
+        else:
+            print(f"リロード完了。({report['seconds']:.1f}秒)")
+        return report
+    finally:
+        _reload_lock.release()
+
+def _reload_in_background(signum=None, frame=None):
+    threading.Thread(target=reload_models, name='reload', daemon=True).start()
+
+def _handle_control(conn, addr):
+    """制御ポートの要求（{"command": "reload" | "status"}）を処理し、結果をJSONで返す"""
+    try:
+        with conn:
+            conn.settimeout(config.get('client_timeout', 30.0))
+            request = protocol.recv_json(conn)
+            if request is None: return
+            command = request.get('command')
+            if command == 'reload':
+                print(f"制御ポート {addr} からリロードを要求されました。")
+                conn.settimeout(None) # 読み込みとウォームアップが終わるまで応答を待たせる
+                reply = reload_models()
+            elif command == 'status':
+                with _serving_cond:
+                    reply = {'ok': True, 'generation': serving.generation, 'active': serving.active,
+                             'reloading': _reload_lock.locked(), 'memory': _memory_mb()}
+            else:
+                reply = {'ok': False, 'error': f"不明なコマンドです: {command}"}
+            protocol.send_json(conn, reply)
+    except Exception as e:
+        print(f"制御ポート {addr} との通信中にエラーが発生しました: {e}")
+
+def _serve_control(port, host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen()
+        while True:
+            conn, addr = s.accept()
+            threading.Thread(target=_handle_control, args=(conn, addr), daemon=True).start()
+
+def send_control(command, port=const.PORT_CTRL, host='127.0.0.1'):
+    """稼働中のサーバーの制御ポートにコマンドを送り、応答（dict）を返す"""
+    with socket.create_connection((host, port)) as conn:
+        protocol.send_json(conn, {'command': command})
+        return protocol.recv_json(conn)
+
 def start_server():
+    global job_queue, serving, histogram
+    load_vad()
+    if config.get('metrics_port'): metrics.serve(config['metrics_port'])
+    if config.get('trace_path'): metrics.enable_trace(config['trace_path'])
+
     print("モデルを初期化しています...")
     converter.initialize_models(config)
     
-    # ウォームアップ
-    if config.get('warmup', 0) > 0:
-        print(f"AIモデルを{config['warmup']}回ウォームアップしています...")
-        dummy_wav_bytes = (np.random.randn(48000) * 10000).astype(np.int16).tobytes()
-        for i in range(config['warmup']):
-            print(f"  ウォームアップ実行中... ({i+1}/{config['warmup']})")
-            _ = converter.convert_voice(dummy_wav_bytes, config['target_speaker_key'])
-        print("ウォームアップ完了。")
+    # ウォームアップ（記録済みの発話長の分布に合わせた長さで、処理時間が安定するまで）
+    histogram = UtteranceHistogram(config.get('utterance_histogram', './cache/utterance_histogram.json'))
+    _warm_up(config, converter)
+
+    # 推論ワーカーを起動（ワーカープロセスはそれぞれウォームアップしてから準備完了になる）
+    job_queue = queue.Queue(maxsize=config.get('max_queue', 16))
+    serving = _build_serving(config, converter)
+    metrics.reset()
+    _start_inference_workers(serving)
+
+    # リロードの受け付け（SIGHUPと制御ポート）
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, _reload_in_background)
+    if config.get('control_port'):
+        control_host = config.get('control_host', '127.0.0.1')
+        threading.Thread(target=_serve_control, args=(config['control_port'], control_host), name='control', daemon=True).start()
+        print(f"制御ポート {control_host}:{config['control_port']} でリロードを受け付けます。")
 
     # サーバー待機
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -109,17 +601,28 @@ def start_server():
             while True:
                 try:
                     conn, addr = s.accept()
-                    handle_client(conn, addr)
+                    # 受信・送信は接続ごとのスレッドで行い、遅いクライアントが他を待たせないようにする
+                    threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
                 except socket.timeout:
                     continue
         except KeyboardInterrupt:
             print("\n停止信号を受信しました。")
+        finally:
+            histogram.save()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="発話単位の声質変換サーバー")
     parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('--control', choices=['reload', 'status'],
+                        help='サーバーを起動せず、稼働中のサーバーの制御ポートにコマンドを送る')
+    parser.add_argument('--control-port', type=int, default=const.PORT_CTRL, help='--controlの送り先のポート')
     args = parser.parse_args()
-    
+
+    if args.control:
+        print(json.dumps(send_control(args.control, args.control_port), indent=2, ensure_ascii=False))
+        exit()
+    config_path = args.config
+
     try:
         with open(args.config, 'r') as f:
             config = json.load(f)
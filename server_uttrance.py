@@ -9,6 +9,7 @@ import time
 
 import FreeVC.convert_rt as convert_rt
 from frcrn import initialize_frcrn, denoise
+import metrics
 
 try:
     vad_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
@@ -34,6 +35,7 @@ def handle_client(conn, addr):
             if not len_data:
                 print(f"クライアント {addr} がデータ長を送らずに切断しました。")
                 return
+            receive_start = time.perf_counter()
             
             input_len = struct.unpack('>I', len_data)[0]
             print(f"受信予定のデータサイズ: {input_len} バイト")
@@ -49,8 +51,13 @@ def handle_client(conn, addr):
                 print(f"警告: 受信データサイズが一致しませんでした (期待値:{input_len}, 実際:{len(input_data)})")
 
             print(f"音声受信完了。変換処理を開始します...")
+            metrics.requests_total.inc()
+            trace = {'time': time.time(), 'client': f'{addr[0]}:{addr[1]}', 'seconds': len(input_data) / 2 / 16000}
+            with metrics.tracing(trace):
+                metrics.record('receive', time.perf_counter() - receive_start, metrics.receive_seconds)
 
             is_speech = False
+            vad_start = time.perf_counter()
             if VAD_ENABLED:
                 try:
                     input_wave_tensor = torch.from_numpy(
@@ -69,28 +76,41 @@ def handle_client(conn, addr):
                     is_speech = True
             else:
                 is_speech = True
+            with metrics.tracing(trace):
+                metrics.record('vad', time.perf_counter() - vad_start, metrics.vad_seconds)
             
             # ▼▼▼ 変更点: is_speech の結果に応じて処理を分岐 ▼▼▼
             if is_speech:
                 # 発話が検出された場合、通常通り変換
-                if FRCRN_ENABLED:
-                    input_wave_for_vad = np.frombuffer(input_data, dtype=np.int16)
-                    input_wave_float = input_wave_for_vad.astype(np.float32) / 32768.0
-                    denoised_wave_float = denoise(input_wave_float.copy())
-                    denoised_chunk_bytes = (denoised_wave_float * 32767.0).astype(np.int16).tobytes()
-                    processed_bytes = convert_rt.convert_voice(denoised_chunk_bytes)
-                else:
-                    processed_bytes = convert_rt.convert_voice(input_data)
+                inference_start = time.perf_counter()
+                with metrics.tracing(trace):
+                    if FRCRN_ENABLED:
+                        with metrics.timer('denoise'):
+                            input_wave_for_vad = np.frombuffer(input_data, dtype=np.int16)
+                            input_wave_float = input_wave_for_vad.astype(np.float32) / 32768.0
+                            denoised_wave_float = denoise(input_wave_float.copy())
+                            denoised_chunk_bytes = (denoised_wave_float * 32767.0).astype(np.int16).tobytes()
+                        processed_bytes = convert_rt.convert_voice(denoised_chunk_bytes)
+                    else:
+                        processed_bytes = convert_rt.convert_voice(input_data)
+                    metrics.record('inference', time.perf_counter() - inference_start, metrics.inference_seconds)
                 
                 print(f"処理完了。クライアントに送信します... (サイズ: {len(processed_bytes)} バイト)")
+                send_start = time.perf_counter()
                 conn.sendall(struct.pack('>I', len(processed_bytes)))
                 conn.sendall(processed_bytes)
 
             else:
                 # 発話が検出されなかった場合は、データ長0を送信
                 print("処理完了。クライアントに再生不要の信号（データ長0）を送信します。")
+                metrics.skipped_total.inc()
+                send_start = time.perf_counter()
                 conn.sendall(struct.pack('>I', 0))
             # ▲▲▲ 変更点 ここまで ▲▲▲
+            with metrics.tracing(trace):
+                metrics.record('send', time.perf_counter() - send_start, metrics.send_seconds)
+            trace['skipped'] = not is_speech
+            metrics.write_trace(trace)
 
             print("送信完了。")
 
@@ -143,17 +163,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="発話単位の声質変換サーバー")
     parser.add_argument("--hpfile", type=str, default="FreeVC/configs/freevc-s.json", help="JSON設定ファイルへのパス")
     parser.add_argument("--ptfile", type=str, default="FreeVC/checkpoints/G_190000.pth", help="モデルチェックポイントファイルへのパス")
-    parser.add_gument("--tgtwav", type=str, default="FreeVC/inputs/zundamon/recitation001.wav", help="目標話者のWAVファイルへのパス")
+    parser.add_argument("--tgtwav", type=str, default="FreeVC/inputs/zundamon/recitation001.wav", help="目標話者のWAVファイルへのパス")
     
     parser.add_argument("--use-frcrn", action="store_true", help="FRCRNノイズ除去モデルを有効にします。")
     parser.add_argument("--warmup", type=int, default=10, help="ウォームアップの実行回数を指定します。(デフォルト: 10)")
+    parser.add_argument("--metrics-port", type=int, help="指定したポートの /metrics で処理時間のメトリクスを公開します。")
+    parser.add_argument("--trace", type=str, help="発話ごとの処理時間をJSONL形式で追記するファイル")
     args = parser.parse_args()
 
+    if args.metrics_port: metrics.serve(args.metrics_port)
+    if args.trace: metrics.enable_trace(args.trace)
+
     print("声質変換モデル(FreeVC)を初期化しています...")
     convert_rt.load_models(args.hpfile, args.ptfile, args.tgtwav)
     print("FreeVCの初期化が完了しました。")
     
-    FRCRN_ENABLED = args.use-frcrn
+    FRCRN_ENABLED = args.use_frcrn
     if FRCRN_ENABLED:
         print("ノイズ除去モデル(FRCRN)を初期化しています...")
         initialize_frcrn(torch.device("cuda"), nsamples=MAX_SAMPLES_FOR_FRCRN)
@@ -162,6 +187,7 @@ if __name__ == "__main__":
         print("FRCRNノイズ除去は無効です。")
     
     warm_up_models(FRCRN_ENABLED, args.warmup)
+    metrics.reset()
     
     start_server(args)
     
@@ -0,0 +1,100 @@
+# style_cache.py
+# 参照話者スタイル埋め込みのディスクキャッシュ
+
+import os
+import glob
+import json
+import uuid
+import hashlib
+import numpy as np
+
+CACHE_VERSION = 2
+INDEX_FILE = 'styles.json'
+TABLE_PATTERN = 'styles-*.npy' # 埋め込みテーブルは書き出すごとに別名にし、どれを使うかはインデックスが指す
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ファイル内容のSHA-256ハッシュ値を返す"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block: break
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_model_key(stargan_path, mel_params):
+    """
+    キャッシュ全体の有効性を決めるキーを作る
+    StarGANのチェックポイント内容とメルスペクトログラムのパラメータが変わると別のキーになる
+    """
+    h = hashlib.sha256()
+    h.update(f'v{CACHE_VERSION}'.encode())
+    h.update(file_digest(stargan_path).encode())
+    h.update(json.dumps(mel_params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def load_style_cache(cache_dir, model_key):
+    """
+    キャッシュを読み込む。埋め込みテーブルはmmapで開くため、実際に参照されるまでメモリに載らない
+
+    Returns:
+        (entries, table): entriesは キー -> {'digest', 'row', 'speaker'} の辞書。
+                          キャッシュが無い、またはモデルキーが一致しない場合は ({}, None)
+    """
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {}, None
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != CACHE_VERSION or index.get('model_key') != model_key:
+            print("スタイルキャッシュのモデルキーが一致しないため、キャッシュを破棄します。")
+            return {}, None
+        # 'c'(copy-on-write)で開くとtorch.from_numpyで警告が出ない
+        table = np.load(os.path.join(cache_dir, index['table']), mmap_mode='c')
+        if table.shape != (index['n_rows'], index['style_dim']):
+            raise ValueError(f"埋め込みテーブルの形 {table.shape} がインデックスと一致しません。")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"警告: スタイルキャッシュの読み込みに失敗しました: {e}")
+        return {}, None
+    return index['entries'], table
+
+
+def save_style_cache(cache_dir, model_key, entries):
+    """
+    キャッシュを書き出す。埋め込みテーブルは新しい名前で書き出し、それを指すインデックスを一時ファイルから
+    os.replaceで置き換える。インデックスの置き換え1回で切り替わるため、読み込み側が古いインデックスと
+    新しいテーブル（またはその逆）を組み合わせることはない
+
+    Args:
+        entries (dict): キー -> (digest, embedding(np.ndarray [style_dim]), speaker_id)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    keys = sorted(entries.keys())
+    table = np.stack([np.asarray(entries[k][1], dtype=np.float32) for k in keys]) if keys else np.zeros((0, 0), np.float32)
+    table_name = f'styles-{uuid.uuid4().hex}.npy'
+    index = {
+        'version': CACHE_VERSION,
+        'model_key': model_key,
+        'table': table_name,
+        'n_rows': table.shape[0],
+        'style_dim': table.shape[1],
+        'entries': {k: {'digest': entries[k][0], 'row': i, 'speaker': int(entries[k][2])} for i, k in enumerate(keys)},
+    }
+
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    tmp_index = os.path.join(cache_dir, table_name + '.json.tmp') # 同時に書き出す他のスレッドと重ならない名前
+    np.save(os.path.join(cache_dir, table_name), table)
+    with open(tmp_index, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_index, index_path)
+    # 古いテーブルを消す（消した直後に読もうとした読み込み側は、キャッシュ無しとして再計算する）
+    for path in glob.glob(os.path.join(cache_dir, TABLE_PATTERN)):
+        if os.path.basename(path) != table_name:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
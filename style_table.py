@@ -0,0 +1,128 @@
+# style_table.py
+# 参照話者スタイルを1つの連続したテンソルに詰めて保持する表
+
+from collections import OrderedDict
+import torch
+
+CENTROID_SUFFIX = '*' # 'zundamon*' のように、話者名にこれを付けたキーはその話者の重心を表す
+
+
+def centroid_key(speaker_name):
+    return speaker_name + CENTROID_SUFFIX
+
+
+def is_centroid_key(key):
+    return key.endswith(CENTROID_SUFFIX)
+
+
+class StyleTable:
+    """
+    参照スタイルを [N, style_dim] のテンソル1つと、話者ID（ラベル）の [N] のテンソル1つに詰めて保持する
+
+    キーごとに小さなテンソルを持たないため、エントリ数が多くてもメモリのオーバーヘッドが小さく、
+    バッチ推論で使う複数のスタイルを1回のインデックス参照（gather）で取り出せる。
+    キーの並びは参照の古い順で、遅延モードのLRUの順序としても使う。
+    削除したエントリの行は次に追加するエントリで再利用し、足りなくなったら表を広げる。
+    share_memory_()の後にエントリを追加・削除すると、共有中の表を書き換えないよう先に自分用にコピーする。
+    """
+
+    def __init__(self, style_dim, device, capacity=0):
+        self.styles = torch.zeros(capacity, style_dim, device=device)
+        self.labels = torch.zeros(capacity, dtype=torch.long, device=device)
+        self._index = OrderedDict() # キー -> 行
+        self._free = list(range(capacity - 1, -1, -1)) # 空いている行（末尾から使う）
+        self._shared = False
+
+    @classmethod
+    def from_dict(cls, refs, style_dim, device):
+        """キー -> (スタイル [1, style_dim], ラベル [1]) の辞書から表を作る"""
+        table = cls(style_dim, device)
+        keys = list(refs)
+        if keys:
+            table.styles = torch.cat([refs[k][0] for k in keys]).to(device)
+            table.labels = torch.cat([refs[k][1] for k in keys]).to(device)
+        table._index = OrderedDict((k, i) for i, k in enumerate(keys))
+        return table
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def keys(self):
+        return list(self._index)
+
+    @property
+    def nbytes(self):
+        return self.styles.element_size() * self.styles.nelement() + self.labels.element_size() * self.labels.nelement()
+
+    def get(self, key):
+        """(スタイル [1, style_dim], ラベル [1]) を返す。表のビューのため、行が再利用されると内容が変わる"""
+        row = self._index.get(key)
+        if row is None: return None
+        return self.styles[row:row + 1], self.labels[row:row + 1]
+
+    def gather(self, keys):
+        """複数のキーの (スタイル [len(keys), style_dim], ラベル [len(keys)]) を1回のインデックス参照で返す（コピー）"""
+        rows = torch.tensor([self._index[k] for k in keys], device=self.styles.device)
+        return self.styles.index_select(0, rows), self.labels.index_select(0, rows)
+
+    def touch(self, key):
+        """keyを最も新しく参照したエントリにする"""
+        self._index.move_to_end(key)
+
+    def put(self, key, style, label):
+        """エントリを追加する（既にあれば置き換える）"""
+        if self._shared: self._unshare()
+        row = self._index.pop(key, None)
+        if row is None:
+            if not self._free: self._grow()
+            row = self._free.pop()
+        self.styles[row] = style.reshape(-1)
+        self.labels[row] = label.reshape(-1)[0]
+        self._index[key] = row
+
+    def remove(self, key):
+        self._free.append(self._index.pop(key))
+
+    def add_centroids(self, speaker_names):
+        """
+        話者ごとに、その話者の全エントリのスタイルの平均を '話者名*' のキーで追加する
+
+        Args:
+            speaker_names (dict): 話者ID -> 話者名
+        Returns:
+            list: 追加したキー
+        """
+        rows = torch.tensor([row for key, row in self._index.items() if not is_centroid_key(key)], device=self.styles.device)
+        row_labels = self.labels.index_select(0, rows)
+        added = []
+        for speaker_id, name in speaker_names.items():
+            selected = rows[row_labels == speaker_id]
+            if len(selected) == 0: continue
+            centroid = self.styles.index_select(0, selected).mean(dim=0)
+            self.put(centroid_key(name), centroid, torch.tensor(speaker_id))
+            added.append(centroid_key(name))
+        return added
+
+    def share_memory_(self):
+        self.styles.share_memory_()
+        self.labels.share_memory_()
+        self._shared = True
+        return self
+
+    def _unshare(self):
+        self.styles = self.styles.clone()
+        self.labels = self.labels.clone()
+        self._shared = False
+
+    def _grow(self):
+        n = len(self.styles)
+        extra = max(8, n)
+        self.styles = torch.cat([self.styles, self.styles.new_zeros(extra, self.styles.shape[1])])
+        self.labels = torch.cat([self.labels, self.labels.new_zeros(extra)])
+        self._free.extend(range(n + extra - 1, n - 1, -1))
@@ -0,0 +1,71 @@
+import argparse
+import json
+import sys
+import torch
+
+import converter
+
+
+def _max_diff(a, b):
+    return (a - b).abs().max().item()
+
+
+def main(args):
+    """
+    トレース済みモデル（compiled_models.BucketedModule）とeagerモードの出力を、
+    バケットと一致する長さ・一致しない長さの両方で比較する
+    """
+    print("--- トレース済みモデルの等価性テストを開始します ---")
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    if not config.get('compiled_dir'):
+        print("設定ファイルに compiled_dir を指定してください。")
+        return 1
+    config.update(use_denoiser=False, lazy_styles=True, inference_precision='fp32')
+    converter.initialize_models(config)
+    compiled = converter._compiled
+    if compiled is None:
+        print("トレース済みモデルが見つかりません。先に compiled_models.py を実行してください。")
+        return 1
+
+    buckets = compiled['vocoder'].buckets
+    lengths = sorted(set(args.lengths or [n for b in buckets for n in (b - 7, b, b + 5) if n > 0]))
+    style = converter._get_reference(config['target_speaker_key'])[0]
+    num_mels = converter._hps_hifigan.num_mels
+    failed = False
+    print(f"バケット: {buckets}\n")
+    for length in lengths:
+        torch.manual_seed(length)
+        mel = torch.randn(1, 1, num_mels, length, device=converter._device) - 4.0
+        with torch.no_grad():
+            f0_eager = converter.F0_model.get_feature_GAN(mel)
+            f0_traced = compiled['f0'](mel)
+            gen_eager = converter.starganv2.generator(mel, style, F0=f0_eager)
+            voc_eager = converter.hifigan(gen_eager.squeeze(1))
+            voc_traced = compiled['vocoder'](gen_eager.squeeze(1))
+        # 畳み込みのみのJDC・HiFi-GANは、パディングの影響を受ける末尾の受容野分を除いて比較する
+        edge = args.edge_frames
+        f0_diff = _max_diff(f0_eager[..., :length - edge], f0_traced[..., :length - edge])
+        hop = converter._hps_hifigan.hop_size
+        voc_diff = _max_diff(voc_eager[..., :(length - edge) * hop], voc_traced[..., :(length - edge) * hop])
+        ok = max(f0_diff, voc_diff) <= args.threshold
+        failed |= not ok
+        kind = 'バケット' if length in buckets else '非バケット'
+        print(f"{length:5d}フレーム ({kind}): 最大誤差 F0 {f0_diff:.2e} / ボコーダー {voc_diff:.2e}"
+              f"{'' if ok else '  <- しきい値超過'}")
+
+    if failed:
+        print("\n不合格: トレース済みモデルの出力がeagerモードと一致しません。")
+        return 1
+    print("\n合格")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="トレース済みモデルとeagerモードの等価性テスト")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('--lengths', type=int, nargs='+', help='比較するメルのフレーム数（省略時は各バケットとその前後の長さ）')
+    parser.add_argument('--edge-frames', type=int, default=8, help='JDC・HiFi-GANの比較から除く末尾のフレーム数')
+    parser.add_argument('--threshold', type=float, default=1e-3, help='合格とする最大誤差の上限')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,97 @@
+import argparse
+import json
+import sys
+import time
+import librosa
+import numpy as np
+
+import converter
+import precision
+from test_streaming import mel_distance
+
+
+def parse_precision(text):
+    """'bf16' や 'generator=int8_static,vocoder=bf16' の形式の指定をprecision.parseに渡せる形にする"""
+    if '=' not in text: return text
+    return dict(item.split('=', 1) for item in text.split(','))
+
+
+def f0_error(reference, target, sr):
+    """
+    2つの波形のF0（pYINで推定）を比較する
+
+    Returns:
+        tuple: (両方が有声のフレームのF0誤差のRMS（セント）, 有声/無声の判定が食い違うフレームの割合)
+    """
+    n = min(len(reference), len(target))
+    f0s, voiced = [], []
+    for x in (reference[:n], target[:n]):
+        f0, v, _ = librosa.pyin(x, fmin=librosa.note_to_hz('C2'), fmax=librosa.note_to_hz('C6'), sr=sr)
+        f0s.append(f0)
+        voiced.append(v)
+    both = voiced[0] & voiced[1]
+    cents = 1200 * np.log2(f0s[1][both] / f0s[0][both]) if both.any() else np.zeros(1)
+    return float(np.sqrt(np.mean(cents ** 2))), float(np.mean(voiced[0] != voiced[1]))
+
+
+def main(args):
+    """
+    fp32とinference_precisionの設定で変換した出力を比較し、メル距離とF0誤差がしきい値以内かを確かめる
+    """
+    print("--- 推論精度の品質テストを開始します ---")
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    target = parse_precision(args.precision) if args.precision else config.get('inference_precision', 'fp32')
+    modes = precision.parse(target)
+    # 比較の基準はfp32で、ノイズ除去の影響は除く
+    config.update(use_denoiser=False, inference_precision='fp32')
+    converter.initialize_models(config)
+
+    sr = converter._hps_hifigan.sampling_rate
+    print(f"\n入力ファイル '{args.input}' を読み込んでいます...")
+    wave, _ = librosa.load(args.input, sr=sr)
+    duration = len(wave) / sr
+
+    def convert():
+        converter._convert_model_waves([wave], [args.speaker]) # 1回目はウォームアップ
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            output = converter._convert_model_waves([wave], [args.speaker])[0]
+        return output, (time.perf_counter() - start) / args.repeat
+
+    print("fp32で変換しています...")
+    reference, reference_time = convert()
+    print(f"{precision.describe(modes)} で変換しています...")
+    converter._precision = modes
+    converter._apply_precision()
+    output, output_time = convert()
+
+    to_int16 = lambda w: (np.clip(w, -1.0, 1.0) * 32767.0).astype(np.int16)
+    distance = mel_distance(to_int16(reference), to_int16(output), sr)
+    cents, vuv = f0_error(reference, output, sr)
+    print("\n--- 結果 ---")
+    print(f"メルスペクトログラムの平均L1距離: {distance:.4f} (しきい値: {args.max_mel_distance})")
+    print(f"F0誤差: {cents:.1f}セント (しきい値: {args.max_f0_cents}), 有声/無声の不一致: {vuv * 100:.1f}% (しきい値: {args.max_vuv_error * 100:.1f}%)")
+    print(f"実時間比(RTF): fp32 {reference_time / duration:.3f} / 変換後 {output_time / duration:.3f} "
+          f"({reference_time / output_time:.2f}倍)")
+
+    if distance > args.max_mel_distance or cents > args.max_f0_cents or vuv > args.max_vuv_error:
+        print("不合格: fp32との差がしきい値を超えました。")
+        return 1
+    print("合格")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="推論精度（bf16・int8量子化）の品質テスト")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('-i', '--input', type=str, default='input.wav', help='入力WAVファイル')
+    parser.add_argument('-s', '--speaker', type=str, default='zundamon127', help='目標話者のキー')
+    parser.add_argument('-p', '--precision', type=str,
+                        help="比較する精度。'bf16' や 'generator=int8_static,vocoder=bf16'（省略時は設定ファイルのinference_precision）")
+    parser.add_argument('--repeat', type=int, default=3, help='処理時間の計測回数')
+    parser.add_argument('--max-mel-distance', type=float, default=0.1, help='合格とするメル距離の上限')
+    parser.add_argument('--max-f0-cents', type=float, default=50.0, help='合格とするF0誤差の上限（セント）')
+    parser.add_argument('--max-vuv-error', type=float, default=0.05, help='合格とする有声/無声の不一致率の上限')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,86 @@
+import argparse
+import json
+import sys
+import time
+import librosa
+import numpy as np
+import soxr
+import torch
+
+import converter
+
+
+def mel_distance(a_int16, b_int16, rate):
+    """2つのint16波形のメルスペクトログラム（対数）の平均L1距離を返す"""
+    n = min(len(a_int16), len(b_int16))
+    mels = []
+    for x in (a_int16[:n], b_int16[:n]):
+        x = soxr.resample(x.astype(np.float32) / 32768.0, rate, converter._hps_hifigan.sampling_rate, 'VHQ')
+        with torch.no_grad():
+            mels.append(converter._mel_spectrogram(torch.from_numpy(x).unsqueeze(0).to(converter._device)))
+    return torch.mean(torch.abs(mels[0] - mels[1])).item()
+
+
+def main(args):
+    """
+    ストリーミング変換（StreamingSession）と発話単位の変換（convert_voice）の出力を比較する
+    """
+    print("--- ストリーミング変換の等価性テストを開始します ---")
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    # ストリーミング変換ではノイズ除去を適用しないため、比較対象でも無効にする
+    config['use_denoiser'] = False
+    converter.initialize_models(config)
+
+    client_rate = 48000
+    print(f"\n入力ファイル '{args.input}' を読み込んでいます...")
+    wave, _ = librosa.load(args.input, sr=client_rate)
+    audio_bytes = (wave * 32767.0).astype(np.int16).tobytes()
+    duration = len(wave) / client_rate
+
+    print("発話単位で変換しています...")
+    whole = np.frombuffer(converter.convert_voice(audio_bytes, args.speaker), dtype=np.int16)
+
+    print(f"ストリーミングで変換しています... (チャンク: {args.chunk_ms}ms)")
+    session = converter.StreamingSession(
+        args.speaker, client_rate=client_rate, block_frames=args.block_frames,
+        context_frames=args.context_frames, lookahead_frames=args.lookahead_frames
+    )
+    chunk_bytes = int(client_rate * args.chunk_ms / 1000) * 2
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(audio_bytes), chunk_bytes):
+        outputs.append(session.feed(audio_bytes[i:i + chunk_bytes]))
+    outputs.append(session.flush())
+    elapsed = time.perf_counter() - start
+    stream = np.frombuffer(b''.join(outputs), dtype=np.int16)
+
+    distance = mel_distance(whole, stream, client_rate)
+    print("\n--- 結果 ---")
+    print(f"出力長: 発話単位 {len(whole)} / ストリーミング {len(stream)} サンプル")
+    print(f"メルスペクトログラムの平均L1距離: {distance:.4f} (しきい値: {args.threshold})")
+    print(f"理論上のアルゴリズム遅延: {session.algorithmic_latency * 1000:.1f}ms")
+    print(f"実測の最大遅延（入力時刻と出力時刻の差）: {session.max_latency * 1000:.1f}ms")
+    print(f"実時間比(RTF): {elapsed / duration:.3f}")
+
+    # 発話単位の変換はホップ長の端数を切り捨てるため、1ホップ分までの長さの差は許容する
+    max_len_diff = converter._hps_hifigan.hop_size * client_rate // converter._hps_hifigan.sampling_rate
+    if abs(len(whole) - len(stream)) > max_len_diff or distance > args.threshold:
+        print("不合格: ストリーミング変換の出力が発話単位の変換と一致しません。")
+        return 1
+    print("合格")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ストリーミング変換の等価性テスト")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('-i', '--input', type=str, default='input.wav', help='入力WAVファイル')
+    parser.add_argument('-s', '--speaker', type=str, default='zundamon127', help='目標話者のキー')
+    parser.add_argument('--chunk-ms', type=float, default=20.0, help='1回に渡すチャンクの長さ（ミリ秒）')
+    parser.add_argument('--block-frames', type=int, default=16, help='1回に変換するブロックのフレーム数')
+    parser.add_argument('--context-frames', type=int, default=32, help='左文脈のフレーム数')
+    parser.add_argument('--lookahead-frames', type=int, default=8, help='先読みのフレーム数')
+    parser.add_argument('--threshold', type=float, default=0.15, help='合格とするメル距離の上限')
+    args = parser.parse_args()
+    sys.exit(main(args))
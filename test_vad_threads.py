@@ -0,0 +1,51 @@
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import librosa
+import numpy as np
+
+import audio_codec
+import server_stargan
+
+
+def main(args):
+    """
+    detect_speechを複数のスレッドから同時に呼び、1スレッドで順に呼んだ場合と同じ発話区間になることを確かめる
+    """
+    print("--- VADのスレッド安全性テストを開始します ---")
+    server_stargan.load_vad()
+    if not server_stargan.VAD_ENABLED:
+        print("Silero VADを読み込めなかったため、テストできません。")
+        return 1
+
+    fmt = audio_codec.DEFAULT_FORMAT
+    print(f"\n入力ファイル {args.inputs} を読み込んでいます...")
+    inputs = []
+    for path in args.inputs:
+        wave, _ = librosa.load(path, sr=fmt.sample_rate)
+        inputs.append((wave * 32767.0).astype(np.int16).tobytes())
+    # 長さの違う入力を混ぜ、VADの内部状態を別の入力の途中で壊しやすくする
+    inputs += [x[:len(x) // 2] for x in inputs]
+
+    expected = [server_stargan.detect_speech(x, fmt) for x in inputs]
+    jobs = [i % len(inputs) for i in range(args.repeat * len(inputs))]
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(lambda i: server_stargan.detect_speech(inputs[i], fmt), jobs))
+
+    mismatches = sum(result != expected[i] for i, result in zip(jobs, results))
+    print("\n--- 結果 ---")
+    print(f"{args.threads}スレッドで{len(jobs)}回検出し、1スレッドの結果と異なったのは{mismatches}回でした。")
+    if mismatches:
+        print("不合格: 同時に呼ぶと発話区間が変わります。")
+        return 1
+    print("合格")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="VAD（detect_speech）のスレッド安全性テスト")
+    parser.add_argument('-i', '--inputs', type=str, nargs='+', default=['input.wav'], help='入力WAVファイル（複数可）')
+    parser.add_argument('--threads', type=int, default=8, help='同時に呼ぶスレッド数')
+    parser.add_argument('--repeat', type=int, default=10, help='1つの入力あたりの検出回数')
+    args = parser.parse_args()
+    sys.exit(main(args))
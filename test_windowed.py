@@ -0,0 +1,94 @@
+import argparse
+import json
+import sys
+import time
+import librosa
+import numpy as np
+import torch
+from munch import Munch
+
+import converter
+from test_streaming import mel_distance
+
+
+def _peak_memory_mb(fn):
+    """fnを実行し、(結果, GPUのピークメモリ(MB)) を返す。CPUの場合はNone"""
+    if converter._device.type != 'cuda':
+        return fn(), None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    result = fn()
+    torch.cuda.synchronize()
+    return result, torch.cuda.max_memory_allocated() / 1024 / 1024
+
+
+def main(args):
+    """
+    窓に分けた変換（_convert_windowed）と一括の変換の出力を比較する
+    """
+    print("--- 窓ごとの変換の等価性テストを開始します ---")
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    config['use_denoiser'] = False
+    converter.initialize_models(config)
+
+    model_rate = converter._hps_hifigan.sampling_rate
+    print(f"\n入力ファイル '{args.input}' を読み込んでいます...")
+    wave, _ = librosa.load(args.input, sr=model_rate)
+    # 長い入力での挙動を確かめるため、指定した長さになるまで入力を繰り返す
+    if args.min_seconds and len(wave) < args.min_seconds * model_rate:
+        wave = np.tile(wave, int(np.ceil(args.min_seconds * model_rate / len(wave))))
+    duration = len(wave) / model_rate
+    style = converter._get_reference(args.speaker)[0]
+
+    def single_pass():
+        with torch.no_grad():
+            mel = converter._mel_spectrogram(torch.from_numpy(wave).unsqueeze(0).to(converter._device))
+            return converter._vocode(converter._generate(mel, style, converter._f0_features(mel))).squeeze().cpu().numpy()
+
+    def windowed():
+        with torch.no_grad():
+            return converter._convert_windowed(wave, style)
+
+    converter._window_options = Munch(
+        seconds=0.0, frames=args.window_frames, context_frames=args.context_frames,
+        crossfade_frames=args.crossfade_frames, batch=args.batch
+    )
+    print(f"一括で変換しています... ({duration:.1f}秒)")
+    start = time.perf_counter()
+    whole, whole_peak = _peak_memory_mb(single_pass)
+    whole_time = time.perf_counter() - start
+    print(f"窓ごとに変換しています... (窓: {args.window_frames}フレーム, 文脈: {args.context_frames}フレーム, バッチ: {args.batch})")
+    start = time.perf_counter()
+    split, split_peak = _peak_memory_mb(windowed)
+    split_time = time.perf_counter() - start
+
+    to_int16 = lambda w: (np.clip(w, -1.0, 1.0) * 32767.0).astype(np.int16)
+    distance = mel_distance(to_int16(whole), to_int16(split), model_rate)
+    print("\n--- 結果 ---")
+    print(f"出力長: 一括 {len(whole)} / 窓ごと {len(split)} サンプル")
+    print(f"メルスペクトログラムの平均L1距離: {distance:.4f} (しきい値: {args.threshold})")
+    print(f"処理時間: 一括 {whole_time:.2f}秒 / 窓ごと {split_time:.2f}秒")
+    if whole_peak is not None:
+        print(f"GPUのピークメモリ: 一括 {whole_peak:.0f}MB / 窓ごと {split_peak:.0f}MB")
+
+    if len(whole) != len(split) or distance > args.threshold:
+        print("不合格: 窓ごとの変換の出力が一括の変換と一致しません。")
+        return 1
+    print("合格")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="窓ごとの変換の等価性テスト")
+    parser.add_argument('--config', type=str, default='config.json', help='設定ファイル(JSON)へのパス')
+    parser.add_argument('-i', '--input', type=str, default='input.wav', help='入力WAVファイル')
+    parser.add_argument('-s', '--speaker', type=str, default='zundamon127', help='目標話者のキー')
+    parser.add_argument('--min-seconds', type=float, default=0.0, help='入力を繰り返してこの長さ（秒）以上にする')
+    parser.add_argument('--window-frames', type=int, default=converter.WINDOW_DEFAULTS.frames, help='1つの窓が受け持つフレーム数')
+    parser.add_argument('--context-frames', type=int, default=converter.WINDOW_DEFAULTS.context_frames, help='窓の両側の文脈のフレーム数')
+    parser.add_argument('--crossfade-frames', type=int, default=converter.WINDOW_DEFAULTS.crossfade_frames, help='クロスフェードのフレーム数')
+    parser.add_argument('--batch', type=int, default=converter.WINDOW_DEFAULTS.batch, help='1回に変換する窓の数')
+    parser.add_argument('--threshold', type=float, default=0.05, help='合格とするメル距離の上限')
+    args = parser.parse_args()
+    sys.exit(main(args))
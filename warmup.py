@@ -0,0 +1,108 @@
+# warmup.py
+# 実際の発話長の分布に基づいたウォームアップ
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+DEFAULT_LENGTHS = [1.0, 2.0, 4.0, 8.0] # 発話長の記録が無い場合にウォームアップする長さ（秒）
+
+
+class UtteranceHistogram:
+    """受信した発話の長さ（秒）をbin_seconds刻みで数え、JSONファイルに保存する"""
+
+    def __init__(self, path, bin_seconds=0.5, save_every=20):
+        self.path = path
+        self.bin_seconds = bin_seconds
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.counts = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('bin_seconds') == bin_seconds:
+                self.counts = {int(k): v for k, v in data['counts'].items()}
+
+    def record(self, seconds):
+        with self._lock:
+            b = int(seconds // self.bin_seconds)
+            self.counts[b] = self.counts.get(b, 0) + 1
+            self._unsaved += 1
+            if self._unsaved >= self.save_every: self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self.path: return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'bin_seconds': self.bin_seconds, 'counts': self.counts}, f)
+        os.replace(tmp, self.path)
+        self._unsaved = 0
+
+    def top_lengths(self, max_buckets):
+        """記録の多い順に最大max_buckets個のビンを選び、各ビンの上端の長さ（秒）を短い順に返す"""
+        with self._lock:
+            top = sorted(self.counts, key=self.counts.get, reverse=True)[:max_buckets]
+        return [(b + 1) * self.bin_seconds for b in sorted(top)]
+
+
+def _percentile_ms(latencies, q):
+    return 1000 * float(np.percentile(latencies, q))
+
+
+def warm_up_length(convert_fn, seconds, max_iterations, min_iterations=3, window=3, tolerance=0.05, client_rate=48000):
+    """
+    1つの長さについて、直近window回の中央値の変化がtolerance以下になるまで（最大max_iterations回）変換を繰り返す
+
+    Returns:
+        list: 各回の処理時間（秒）
+    """
+    dummy_wav_bytes = (np.random.randn(int(seconds * client_rate)) * 10000).astype(np.int16).tobytes()
+    latencies = []
+    for i in range(max_iterations):
+        start = time.perf_counter()
+        _ = convert_fn(dummy_wav_bytes)
+        latencies.append(time.perf_counter() - start)
+        if i + 1 >= max(min_iterations, 2 * window):
+            recent = np.median(latencies[-window:])
+            previous = np.median(latencies[-2 * window:-window])
+            if abs(recent - previous) <= tolerance * previous: break
+    return latencies
+
+
+def warm_up(config, convert_fn, histogram=None, compiled=False, lengths=None):
+    """
+    発話長の分布から選んだ長さごとに、処理時間が安定するまでウォームアップする
+
+    Args:
+        config (dict): 設定。warmup（1つの長さあたりの最大回数）、warmup_max_buckets、
+                       warmup_tolerance、skip_warmup_when_compiled を参照する
+        convert_fn: 音声バイトデータを受け取って変換する関数
+        histogram (UtteranceHistogram): 記録済みの発話長の分布。無ければ既定の長さを使う
+        compiled (bool): トレース済みモデルを読み込んでいるか
+        lengths (list): ウォームアップする長さ（秒）。指定するとhistogramの代わりに使う
+    """
+    max_iterations = config.get('warmup', 0)
+    if max_iterations <= 0: return
+    if compiled and config.get('skip_warmup_when_compiled', False):
+        print("トレース済みモデルを読み込んでいるため、ウォームアップをスキップします。")
+        return
+
+    if lengths is None:
+        lengths = histogram.top_lengths(config.get('warmup_max_buckets', 4)) if histogram else []
+    if not lengths:
+        lengths = DEFAULT_LENGTHS
+    print(f"AIモデルをウォームアップしています... (長さ: {', '.join(f'{s:.1f}秒' for s in lengths)}, 各最大{max_iterations}回)")
+    start = time.perf_counter()
+    for seconds in lengths:
+        latencies = warm_up_length(convert_fn, seconds, max_iterations, tolerance=config.get('warmup_tolerance', 0.05))
+        print(f"  {seconds:.1f}秒: {len(latencies)}回, 初回 {latencies[0] * 1000:.1f}ms, "
+              f"p50 {_percentile_ms(latencies, 50):.1f}ms, p95 {_percentile_ms(latencies, 95):.1f}ms")
+    print(f"ウォームアップ完了。({time.perf_counter() - start:.1f}秒)")
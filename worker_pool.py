@@ -0,0 +1,201 @@
+# worker_pool.py
+# 複数の推論ワーカープロセスでモデルの重みと参照スタイルを共有して変換するプール
+
+import os
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+import torch
+import torch.multiprocessing as mp
+from munch import Munch
+
+import converter
+from warmup import warm_up
+
+
+def _worker_main(index, cores, model_set, requests, results, warmup=None):
+    """ワーカープロセスの本体。割り当てられたコアに固定し、ウォームアップしてから要求を順に変換する"""
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores)))
+    converter.install_model_set(model_set)
+    if warmup is not None:
+        warm_up(warmup.config, lambda data: converter.convert_voice(data, warmup.speaker_key),
+                compiled=converter._compiled is not None, lengths=warmup.lengths)
+    results.put((None, index, None)) # 準備完了の通知
+
+    while True:
+        item = requests.get()
+        if item is None: break
+        job_id, audio_data_bytes, speaker_key, fmt, spans = item
+        try:
+            if isinstance(speaker_key, list):
+                output = converter.convert_voice_multi(audio_data_bytes, speaker_key, fmt)
+            elif spans is not None:
+                output = converter.convert_voice_spans(audio_data_bytes, speaker_key, spans, fmt)
+            else:
+                output = converter.convert_voice(audio_data_bytes, speaker_key, fmt)
+            results.put((job_id, output, None))
+        except Exception as e:
+            results.put((job_id, None, f"{type(e).__name__}: {e}"))
+
+
+def _assign_cores(n_workers, cores_per_worker=None):
+    """利用可能なコアを各ワーカーに重ならないよう割り当てる（足りない場合は全コアを共有する）"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    per_worker = cores_per_worker or max(1, len(cpus) // n_workers)
+    return [cpus[i * per_worker:(i + 1) * per_worker] or cpus for i in range(n_workers)]
+
+
+class WorkerPool:
+    """
+    推論ワーカープロセスのプール
+
+    StarGAN・JDC・HiFi-GANの重みと参照スタイルは、親プロセスで共有メモリに移してから
+    ワーカーへ渡すため、ワーカー数に関わらずメモリ上には1組しか存在しない。
+    各ワーカーは専用のコアに固定され、そのコア数をtorchのスレッド数とする。
+    要求は処理中のジョブが最も少ないワーカーに割り振る。
+
+    converter.initialize_models()でモデルを読み込んだ後に作成すること。
+    model_setを渡すと、converterのモデルの代わりにそのモデル一式（export_model_set()の結果）を使う。
+    異常終了したワーカーは起動し直し、そのワーカーに割り振っていたジョブは失敗させる。
+    job_timeout（秒）を指定すると、同期版の変換はその時間を過ぎるとTimeoutErrorを送出する。
+    warmup（Munch(config, speaker_key, lengths)）を渡すと、各ワーカー（起動し直したワーカーも含む）は
+    モデルを読み込んだ後、warmup.warm_upでウォームアップしてから要求を受け付ける。
+    """
+
+    def __init__(self, n_workers, cores_per_worker=None, model_set=None, job_timeout=None, warmup=None):
+        self._ctx = mp.get_context('spawn')
+        self._model_set = model_set or converter.export_model_set()
+        self._warmup = warmup
+        self._job_timeout = job_timeout
+        self._results = self._ctx.Queue()
+        self._workers = [self._start_worker(index, cores) for index, cores in enumerate(_assign_cores(n_workers, cores_per_worker))]
+
+        while not all(w.ready for w in self._workers):
+            try:
+                _, index, _ = self._results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [w.index for w in self._workers if not w.process.is_alive()]
+                if dead:
+                    self._shutdown_workers(self._workers)
+                    raise RuntimeError(f"推論ワーカー{dead}が準備中に終了しました。")
+                continue
+            self._workers[index].ready = True
+            print(f"推論ワーカー{index}の準備が完了しました。(コア: {self._workers[index].cores})")
+
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._closed = False
+        threading.Thread(target=self._collect_results, name='worker-pool-results', daemon=True).start()
+        threading.Thread(target=self._monitor, name='worker-pool-monitor', daemon=True).start()
+
+    def _start_worker(self, index, cores):
+        requests = self._ctx.Queue()
+        process = self._ctx.Process(target=_worker_main, args=(index, cores, self._model_set, requests, self._results, self._warmup),
+                                    name=f'inference-worker-{index}', daemon=True)
+        process.start()
+        return Munch(index=index, process=process, requests=requests, cores=cores, inflight=0, ready=False)
+
+    def submit(self, audio_data_bytes, speaker_key, fmt=None, spans=None):
+        """
+        処理中のジョブが最も少ないワーカーに変換を依頼し、結果を受け取るFutureを返す
+        spansを指定すると、その発話区間だけを変換する（converter.convert_voice_spans）
+        speaker_keyに話者キーのリストを渡すと、全ての話者に変換した結果のリストを返す（converter.convert_voice_multi）
+        """
+        future = Future()
+        with self._lock:
+            if not self._workers: raise RuntimeError("動作中の推論ワーカーがありません。")
+            # 再起動中のワーカーには、他のワーカーが空いていない場合だけ割り振る
+            worker = min(self._workers, key=lambda w: (not w.ready, w.inflight))
+            worker.inflight += 1
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = (future, worker)
+        worker.requests.put((job_id, audio_data_bytes, speaker_key, fmt, spans))
+        return future
+
+    def convert_voice(self, audio_data_bytes, speaker_key, fmt=None):
+        """converter.convert_voiceと同じ形で呼べる同期版"""
+        return self.submit(audio_data_bytes, speaker_key, fmt).result(self._job_timeout)
+
+    def convert_voice_spans(self, audio_data_bytes, speaker_key, spans, fmt=None):
+        """converter.convert_voice_spansと同じ形で呼べる同期版"""
+        return self.submit(audio_data_bytes, speaker_key, fmt, spans).result(self._job_timeout)
+
+    def convert_voice_multi(self, audio_data_bytes, speaker_keys, fmt=None):
+        """converter.convert_voice_multiと同じ形で呼べる同期版"""
+        return self.submit(audio_data_bytes, list(speaker_keys), fmt).result(self._job_timeout)
+
+    def inflight(self):
+        """ワーカーごとの処理中のジョブ数"""
+        with self._lock:
+            return [w.inflight for w in self._workers]
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        self._shutdown_workers(workers)
+        self._results.put(None) # 結果を受け取るスレッドを終了する
+
+    @staticmethod
+    def _shutdown_workers(workers):
+        for worker in workers:
+            if worker.process.is_alive(): worker.requests.put(None)
+        for worker in workers:
+            worker.process.join()
+
+    def _collect_results(self):
+        while True:
+            item = self._results.get()
+            if item is None: return
+            job_id, output, error = item
+            with self._lock:
+                if job_id is None:
+                    # 再起動したワーカーの準備完了の通知（outputはワーカーの番号）
+                    worker = next((w for w in self._workers if w.index == output), None)
+                    if worker is not None:
+                        worker.ready = True
+                        print(f"推論ワーカー{output}の再起動が完了しました。")
+                    continue
+                # 異常終了したワーカーのジョブは、_monitorが既に失敗させている
+                future, worker = self._jobs.pop(job_id, (None, None))
+                if future is None: continue
+                worker.inflight -= 1
+            if error is not None:
+                future.set_exception(RuntimeError(f"推論ワーカー{worker.index}でエラーが発生しました: {error}"))
+            else:
+                future.set_result(output)
+
+    def _monitor(self):
+        """
+        異常終了したワーカープロセス（メモリ不足・セグメンテーション違反など）を検出し、
+        そのワーカーに割り振ったジョブを失敗させてからワーカーを起動し直す
+        準備が完了する前に終了したワーカーは、起動し直しても同じ結果になるため取り除く
+        """
+        while True:
+            with self._lock:
+                if self._closed: return
+                sentinels = {w.process.sentinel: w for w in self._workers}
+            if not sentinels: return
+            for sentinel in wait(list(sentinels), timeout=1.0):
+                worker = sentinels[sentinel]
+                with self._lock:
+                    if self._closed: return
+                    failed = [job_id for job_id, (_, w) in self._jobs.items() if w is worker]
+                    futures = [self._jobs.pop(job_id)[0] for job_id in failed]
+                    self._workers.remove(worker)
+                    replacement = None
+                    if worker.ready:
+                        replacement = self._start_worker(worker.index, worker.cores)
+                        self._workers.append(replacement)
+                print(f"推論ワーカー{worker.index}が異常終了しました。(終了コード: {worker.process.exitcode}, "
+                      f"失敗させたジョブ: {len(futures)}件, {'再起動します' if replacement else 'ワーカーを取り除きます'})")
+                for future in futures:
+                    future.set_exception(RuntimeError(f"推論ワーカー{worker.index}が異常終了しました。"))